@@ -7,18 +7,24 @@ License: See LICENSE for license information
 """
 import json
 import os
+import struct
 import tempfile
 
 from django.conf import settings
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test.client import encode_multipart
 
 from dms_plugins.models import DoccodePluginMapping
 from dms_plugins.workers.validators.hashcode import HashCodeWorker
+from dms_plugins.workers.storage.metadata.manifest import MetadataManifest
+from dms_plugins.workers.storage.local import LocalFilesystemManager
+from dms_plugins.workers.transfer.previews import PREVIEW_SIZES
 
 from adlibre.dms.base_test import DMSTestCase
 from core.models import CoreConfiguration
 from core.models import DocumentTypeRuleManager
+from core.models import Document
 
 # TODO: Test self.rules, self.rules_missing, self.documents_missing
 # TODO: Test with and without correct permissions.
@@ -236,8 +242,10 @@ class APITest(DMSTestCase):
         url = reverse('api_file', kwargs={'code': file_name, 'suggested_format': extension})
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
+        # File must be streamed and not buffered into memory
+        self.assertTrue(response.streaming)
         # Comparing response to actual file using hash codes
-        resp_h = self.hworker.get_hash(response.content, self.hash_method)
+        resp_h = self.hworker.get_hash(''.join(response.streaming_content), self.hash_method)
         file_h = self._get_hash_for_file(file_name)
         if not resp_h == file_h:
             raise self.failureException('Wrong file content returned by DMS: %s' % resp_h)
@@ -256,14 +264,14 @@ class APITest(DMSTestCase):
         url = reverse('api_file', kwargs={'code': first_file_name, 'suggested_format': extension})
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
-        resp_h = self.hworker.get_hash(response.content, self.hash_method)
+        resp_h = self.hworker.get_hash(''.join(response.streaming_content), self.hash_method)
         file_h = self._get_hash_for_file(second_file_name)
         if not resp_h == file_h:
             raise self.failureException('Wrong file content returned by DMS (hash): %s' % resp_h)
 
         rev_url = url + '?r=%s' % 1
         response = self.client.get(rev_url)
-        resp_h = self.hworker.get_hash(response.content, self.hash_method)
+        resp_h = self.hworker.get_hash(''.join(response.streaming_content), self.hash_method)
         file_h = self._get_hash_for_file(first_file_name)
         if not resp_h == file_h:
             raise self.failureException('Wrong file content returned by DMS for previous revision (hash) : %s' % resp_h)
@@ -488,6 +496,147 @@ class APITest(DMSTestCase):
             if not indexing_data[key] in self.doc1_dict.itervalues():
                 raise AssertionError('Value "%s" not present in indexing_data' % value)
 
+    def test_31_api_file_conditional_and_range_requests(self):
+        """Files are served with validators. Answered 304 for up to date copies and 206 for byte ranges"""
+        self.client.login(username=self.username, password=self.password)
+        url = reverse('api_file', kwargs={'code': self.documents_pdf_this_test[1], 'suggested_format': 'pdf'})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+        content = ''.join(response.streaming_content)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"outdated-etag"')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, HTTP_RANGE='bytes=0-7')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 0-7/%s' % len(content))
+        self.assertEqual(''.join(response.streaming_content), content[:8])
+        response = self.client.get(url, HTTP_RANGE='bytes=-8')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(''.join(response.streaming_content), content[-8:])
+        response = self.client.get(url, HTTP_RANGE='bytes=%s-' % (len(content) + 10))
+        self.assertEqual(response.status_code, 416)
+
+    def test_32_api_bulk_fileinfo(self):
+        """Reading file info of many documents in one request"""
+        url = reverse('api_file_info_bulk')
+        codes = list(self.documents_pdf_this_test[1:]) + list(self.documents_missing)
+        response = self.client.post(url, json.dumps({'codes': codes}), content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.post(url, json.dumps({'codes': codes}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(sorted(data.keys()), sorted(codes))
+        for code in self.documents_pdf_this_test[1:]:
+            self.assertEqual(data[code]['document_name'], code)
+            self.assertIn('metadata', data[code])
+        for code in self.documents_missing:
+            self.assertIn('error', data[code])
+        # Comma separated codes are supported too
+        response = self.client.post(url, {'codes': ','.join(self.documents_pdf_this_test[1:])})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)), len(self.documents_pdf_this_test[1:]))
+
+    def test_33_api_files_list_manifest(self):
+        """Files list is served from a docrule manifest, kept in sync on removal and restored with rebuild_index"""
+        self.client.login(username=self.username, password=self.password)
+        docrule = DocumentTypeRuleManager().get_docrule_by_name('Adlibre Invoices')
+        mapping = DoccodePluginMapping.objects.get(doccode=docrule.get_id())
+        url = reverse("api_file_list", kwargs={'id_rule': mapping.pk})
+        names = sorted(d['name'] for d in json.loads(self.client.get(url).content))
+        manifest = MetadataManifest(docrule)
+        self.assertTrue(manifest.exists())
+        # Deleted in test_20
+        self.assertNotIn(self.documents_pdf_this_test[0], names)
+        self.assertIn(self.documents_pdf_this_test[1], names)
+        manifest.drop()
+        call_command('rebuild_index', str(docrule.get_id()), quiet=True)
+        self.assertTrue(manifest.exists())
+        self.assertEqual(sorted(d['name'] for d in json.loads(self.client.get(url).content)), names)
+
+    def test_34_api_files_list_pagination(self):
+        """Files list pages follow each other with cursors of Link header or response body"""
+        self.client.login(username=self.username, password=self.password)
+        docrule = DocumentTypeRuleManager().get_docrule_by_name('Adlibre Invoices')
+        mapping = DoccodePluginMapping.objects.get(doccode=docrule.get_id())
+        url = reverse("api_file_list", kwargs={'id_rule': mapping.pk})
+        names = [d['name'] for d in json.loads(self.client.get(url, {'order': 'name'}).content)]
+        self.assertEqual(names, sorted(names))
+        self.assertTrue(len(names) > 1)
+        # Offset pagination
+        response = self.client.get(url, {'order': 'name', 'start': 1, 'finish': 2})
+        self.assertEqual([d['name'] for d in json.loads(response.content)], names[1:2])
+        # Keyset pagination
+        paged = []
+        response = self.client.get(url, {'order': 'name', 'finish': 1})
+        while True:
+            paged.extend(d['name'] for d in json.loads(response.content))
+            if not response.has_header('Link'):
+                break
+            next_url = response['Link'].split(';')[0].strip('<>')
+            response = self.client.get(next_url)
+        self.assertEqual(paged, names)
+        # Pages with next cursor in response body
+        paged = []
+        cursor = ''
+        while cursor is not None:
+            page = json.loads(self.client.get(url, {'order': 'name', 'finish': 1, 'cursor': cursor}).content)
+            self.assertEqual((page['start'], page['finish']), (0, 1))
+            paged.extend(d['name'] for d in page['files'])
+            cursor = page['next']
+        self.assertEqual(paged, names)
+        response = self.client.get(url, {'order': 'created_date', 'cursor': 'wrong'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {'order': 'unknown'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_35_api_thumbnail_previews(self):
+        """Page previews are served in requested size, page and format. Every size is rendered from one raster."""
+        code = self.documents_pdf_this_test[1]
+        url = reverse('api_thumbnail', kwargs={'code': code})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 401)
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(url, {'size': 200})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('Accept', response['Vary'])
+        # Rounded up to a configured size
+        width, height = struct.unpack('>II', response.content[16:24])
+        self.assertEqual(max(width, height), 256)
+        # Aspect ratio of the A4 page (595x842 points) kept
+        self.assertAlmostEqual(float(width) / height, 595.0 / 842, places=2)
+        document = Document()
+        document.docrule = DocumentTypeRuleManager().find_for_string(code)
+        document.set_filename(code)
+        thumbnails = os.path.join(LocalFilesystemManager().get_document_directory(document), 'thumbnails_storage')
+        previews = os.listdir(thumbnails)
+        self.assertIn('%s.pdf.png' % code, previews)
+        for size in PREVIEW_SIZES[1:]:
+            self.assertIn('%s.pdf_p1_%s.png' % (code, size), previews)
+        response = self.client.get(url, {'size': 64})
+        self.assertEqual(max(struct.unpack('>II', response.content[16:24])), 64)
+        # Format negotiation
+        response = self.client.get(url, HTTP_ACCEPT='image/jpeg,image/*')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        response = self.client.get(url, {'format': 'png'}, HTTP_ACCEPT='image/jpeg')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        response = self.client.get(url, {'revision': 1})
+        self.assertEqual(response.status_code, 200)
+        for params in ({'size': 'big'}, {'page': 0}, {'page': 'x'}, {'revision': 'x'}, {'format': 'gif'}):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+        # No such page
+        self.assertEqual(self.client.get(url, {'page': 99}).status_code, 404)
+
     def test_zz_cleanup(self):
         """Test Cleanup"""
         self.cleanAll()
@@ -44,6 +44,12 @@ urlpatterns = patterns(
         views.FileHandler.as_view(),
         name='api_file',
     ),
+    # /api/file-info/bulk/
+    url(
+        r'^file-info/bulk/$',
+        views.BulkFileInfoHandler.as_view(),
+        name='api_file_info_bulk',
+    ),
     # /api/file-info/ABC1234
     url(
         r'^file-info/(?P<code>[\w_-]+)$',
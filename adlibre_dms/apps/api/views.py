@@ -29,11 +29,13 @@ from api.decorators.group_required import group_required
 from core.document_processor import DocumentProcessor
 from core.parallel_keys import process_pkeys_request
 from core.errors import DmsException
-from core.http import DMSObjectResponse, DMSOBjectRevisionsData
+from core.http import DMSObjectResponse, DMSObjectStreamingResponse, DMSObjectNotModifiedResponse
+from core.http import DMSOBjectRevisionsData, is_conditional_request, document_not_modified
 from dms_plugins.operator import PluginsOperator
 from dms_plugins.models import DoccodePluginMapping
 from mdt_manager import MetaDataTemplateManager
 from dms_plugins.workers.info.tags import TagsPlugin
+from dms_plugins.workers.transfer.previews import negotiate_preview_format, PREVIEW_FORMATS
 from models import API_GROUP_NAME
 
 from mdtui.security import list_permitted_docrules_qs
@@ -43,6 +45,8 @@ log = logging.getLogger('dms.api.handlers')
 
 AUTH_REALM = 'Adlibre DMS'
 
+BULK_MAX_CODES = getattr(settings, 'DMS_API_BULK_MAX_CODES', 1000)
+
 
 class BaseFileHandler(APIView):
     """Typical request parsing task handler"""
@@ -54,6 +58,27 @@ class BaseFileHandler(APIView):
         log.debug('BaseFileHandler._get_info returned: %s : %s : %s.' % (revision, hashcode, extra))
         return revision, hashcode, extra
 
+    def _not_modified_response(self, request, code, options):
+        """Answers conditional GET requests using document revision metadata only (without reading a file)
+
+        @return: 304 response in case client has an up to date copy of the document or None"""
+        if not is_conditional_request(request):
+            return None
+        processor = DocumentProcessor()
+        metadata_options = options.copy()
+        metadata_options['only_metadata'] = True
+        document = processor.read(code, metadata_options)
+        # Errors, deleted documents and permissions are handled with a normal request
+        if processor.errors or document.marked_deleted or not document.get_file_revisions_data():
+            return None
+        if not request.user.is_superuser:
+            if not document.docrule in list_permitted_docrules_qs(request.user):
+                return None
+        if document_not_modified(request, document):
+            log.info('Conditional request for code: %s answered with Not Modified' % code)
+            return DMSObjectNotModifiedResponse(document)
+        return None
+
 
 class FileHandler(BaseFileHandler):
     """CRUD Methods for documents
@@ -140,6 +165,9 @@ class FileHandler(BaseFileHandler):
             'extension': suggested_format,
             'user': request.user,
         }
+        not_modified = self._not_modified_response(request, code, options)
+        if not_modified:
+            return not_modified
         document = processor.read(code, options)
         if not request.user.is_superuser:
             # Hack: Used part of the code from MDTUI Wrong!
@@ -153,7 +181,7 @@ class FileHandler(BaseFileHandler):
             log.error('FileHandler.read request to marked deleted document: %s' % code)
             return Response(status=status.HTTP_404_NOT_FOUND)
         else:
-            response = DMSObjectResponse(document)
+            response = DMSObjectStreamingResponse(document, request=request)
             log.info('FileHandler.read request fulfilled for code: %s, options: %s' % (code, options))
         return response
 
@@ -280,6 +308,9 @@ class OldFileHandler(BaseFileHandler):
             'extension': suggested_format,
             'user': request.user,
         }
+        not_modified = self._not_modified_response(request, code, options)
+        if not_modified:
+            return not_modified
         document = processor.read(code, options)
         if not request.user.is_superuser:
             # Hack: Used part of the code from MDTUI Wrong!
@@ -293,7 +324,7 @@ class OldFileHandler(BaseFileHandler):
             log.error('OldFileHandler.read request to marked deleted document: %s' % code)
             return Response(status=status.HTTP_404_NOT_FOUND)
         else:
-            response = DMSObjectResponse(document)
+            response = DMSObjectStreamingResponse(document, request=request)
             log.info('OldFileHandler.read request fulfilled for code: %s, options: %s' % (code, options))
         return response
 
@@ -339,8 +370,69 @@ class FileInfoHandler(BaseFileHandler):
         return Response(info, status=status.HTTP_200_OK)
 
 
+class BulkFileInfoHandler(APIView):
+    """Returns file info data for many documents in one request
+
+    POST a list of codes, e.g.: {"codes": ["ADL-0001", "ADL-0002"]} or codes=ADL-0001,ADL-0002
+
+    @param codes: list (or comma separated string) of document codes
+    @param indexing_data: return indexing data with file info
+
+    Returns a dict of file info data for each code requested.
+    Codes that could not be read have an {"error": "<message>", "status": <HTTP status code>} value instead.
+    """
+    allowed_methods = ('POST',)
+
+    @method_decorator(logged_in_or_basicauth(AUTH_REALM))
+    @method_decorator(group_required(API_GROUP_NAME))  # FIXME: Should be more granular permissions
+    def post(self, request):
+        codes = request.DATA.get('codes', None)
+        if not codes:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if isinstance(codes, basestring):
+            codes = [code.strip() for code in codes.split(',') if code.strip()]
+        if len(codes) > BULK_MAX_CODES:
+            log.error('BulkFileInfoHandler.create request for %s codes exceeds limit' % len(codes))
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        indexing_data = bool(request.DATA.get('indexing_data', None))
+        processor = DocumentProcessor()
+        options = {
+            'only_metadata': not indexing_data,
+            'indexing_data': indexing_data,
+            'user': request.user,
+        }
+        documents = processor.read_bulk(codes, options)
+        user_permissions = None
+        if not request.user.is_superuser:
+            user_permissions = list_permitted_docrules_qs(request.user)
+        result = {}
+        for code in codes:
+            document = documents.get(code, None)
+            if document is None:
+                error = processor.document_errors.get(code, [DmsException('Document not found', 404)])[0]
+                error_status = getattr(error, 'code', status.HTTP_400_BAD_REQUEST)
+                if not isinstance(error_status, int):
+                    error_status = status.HTTP_500_INTERNAL_SERVER_ERROR
+                result[code] = {'error': unicode(getattr(error, 'parameter', error)), 'status': error_status}
+            elif user_permissions is not None and not document.docrule in user_permissions:
+                result[code] = {'error': 'Unauthorized', 'status': status.HTTP_401_UNAUTHORIZED}
+            elif document.marked_deleted or not (
+                    document.get_file_revisions_data() or document.get_db_info().get('mdt_indexes', None)):
+                result[code] = {'error': 'Document not found', 'status': status.HTTP_404_NOT_FOUND}
+            else:
+                result[code] = DMSOBjectRevisionsData(document).data
+        log.info('BulkFileInfoHandler.create request fulfilled for %s codes' % len(codes))
+        return Response(result, status=status.HTTP_200_OK)
+
+
 class FileListHandler(APIView):
-    """Provides list of documents to be able to browse via document type rule id."""
+    """Provides list of documents to be able to browse via document type rule id.
+
+    Documents from 'start' to 'finish' (index of document to stop at) are listed.
+    Requests with 'cursor' parameter (empty for the first page) are answered with a page
+    {"files": [...], "next": cursor of the next page or null, "start": ..., "finish": ...}
+    and documents are counted from the cursor position then ('start' is ignored).
+    Other requests are answered with a plain list of documents and a Link rel="next" header."""
     allowed_methods = ('GET', )
 
     @method_decorator(logged_in_or_basicauth(AUTH_REALM))
@@ -357,17 +449,27 @@ class FileListHandler(APIView):
         searchword = request.GET.get('q', None)
         tag = request.GET.get('tag', None)
         filter_date = request.GET.get('created_date', None)
+        cursor = request.GET.get('cursor', None)
         if finish:
             finish = int(finish)
-        file_list = operator.get_file_list(
-            mapping,
-            start,
-            finish,
-            order,
-            searchword,
-            tags=[tag],
-            filter_date=filter_date
-        )
+        if cursor:
+            # Counting from the cursor position
+            start = 0
+        try:
+            file_list = operator.get_file_list(
+                mapping,
+                start,
+                finish,
+                order,
+                searchword,
+                tags=[tag],
+                filter_date=filter_date,
+                cursor=cursor,
+            )
+        except ValueError, e:
+            # Wrong cursor or order
+            log.error('FileListHandler.read wrong parameters: %s' % e)
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
         for item in file_list:
             document_name = item['name']
             code, suggested_format = os.path.splitext(document_name)
@@ -387,7 +489,21 @@ class FileListHandler(APIView):
             start %s, finish %s, order %s, searchword %s, tag %s, filter_date %s."""
             % (start, finish, order, searchword, tag, filter_date)
         )
-        return Response(file_list, status=status.HTTP_200_OK)
+        if cursor is not None:
+            page = {'files': file_list, 'next': operator.next_cursor, 'start': start, 'finish': finish}
+            response = Response(page, status=status.HTTP_200_OK)
+        else:
+            response = Response(file_list, status=status.HTTP_200_OK)
+        if operator.next_cursor:
+            # Keyset pagination: next page continues after the last document of this one.
+            # It is counted from the cursor, so it starts at 0 and has the same size as this one.
+            params = request.GET.copy()
+            params['start'] = 0
+            if finish:
+                params['finish'] = finish - start
+            params['cursor'] = operator.next_cursor
+            response['Link'] = '<%s?%s>; rel="next"' % (request.build_absolute_uri(request.path), params.urlencode())
+        return response
 
 
 class TagsHandler(APIView):
@@ -734,7 +850,10 @@ class ParallelKeysHandler(APIView):
 
 
 class ThumbnailsHandler(APIView):
-    """Work with thumbnails of files"""
+    """Work with thumbnails (page previews) of files
+
+    Optional GET params: 'size' (longest side in px, rounded up to a configured size), 'page' (from 1),
+    'revision' and 'format' (negotiated by Accept header if not given)."""
     allowed_methods = ('GET', )
 
     @method_decorator(logged_in_or_basicauth(AUTH_REALM))
@@ -746,10 +865,31 @@ class ThumbnailsHandler(APIView):
                 log.error('ThumbnailsHandler.read attempted with unauthenticated user.')
                 return Response(status=status.HTTP_401_UNAUTHORIZED)
 
+            try:
+                size = int(request.GET.get('size', 0)) or None
+                page = int(request.GET.get('page', 1))
+                revision = int(request.GET.get('revision', 0)) or None
+            except ValueError:
+                return Response(status=status.HTTP_400_BAD_REQUEST)
+            preview_format = request.GET.get('format', None) or negotiate_preview_format(request.META.get('HTTP_ACCEPT'))
+            if page < 1 or preview_format not in PREVIEW_FORMATS:
+                return Response(status=status.HTTP_400_BAD_REQUEST)
+            options = {
+                'user': request.user,
+                'thumbnail': True,
+                'preview_size': size,
+                'preview_page': page,
+                'preview_format': preview_format,
+            }
+            if revision:
+                options['revision'] = revision
             processor = DocumentProcessor()
-            doc = processor.read(code, options={'user': request.user, 'thumbnail': True})
+            doc = processor.read(code, options=options)
             if not processor.errors:
-                return DMSObjectResponse(doc, thumbnail=True)
+                response = DMSObjectResponse(doc, thumbnail=True)
+                # Format depends on Accept header
+                response['Vary'] = 'Accept'
+                return response
             else:
                 return Response(status=status.HTTP_404_NOT_FOUND)
         except:
@@ -780,6 +920,7 @@ class ApiDocs(APIView):
             'viersion': rest_reverse('api_version', request=request, format=format),
             'api_file': rest_reverse('api_file', kwargs={'code': 'code'}, request=request, format=format),
             'api_file_info': reverse('api_file_info', kwargs={'code': 'code'}),
+            'api_file_info_bulk': rest_reverse('api_file_info_bulk', request=request, format=format),
             'api_file_list': reverse('api_file_list', kwargs={'id_rule': 1}),
             'api_revision_count': reverse('api_revision_count', kwargs={'document': 'code'}),
             'api_rules': rest_reverse('api_rules', request=request, format=format),
@@ -74,12 +74,12 @@ class ViewTest(DMSTestCase):
         for d in self.documents_pdf:
             url = '/get/' + d
             response = self.client.get(url)
-            mimetype = mime.from_buffer(response.content)
+            mimetype = mime.from_buffer(''.join(response.streaming_content))
             self.assertEquals(mimetype, 'application/pdf')
         for d in self.documents_pdf:
             url = '/get/' + d + '?extension=pdf'
             response = self.client.get(url)
-            mimetype = mime.from_buffer(response.content)
+            mimetype = mime.from_buffer(''.join(response.streaming_content))
             self.assertEquals(mimetype, 'application/pdf')
         # Check 404 on missing documents
         for d in self.documents_missing:
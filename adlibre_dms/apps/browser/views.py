@@ -26,7 +26,7 @@ from dms_plugins import models, forms, representator
 from dms_plugins.operator import PluginsOperator
 from core.document_processor import DocumentProcessor
 from browser.forms import UploadForm
-from core.http import DMSObjectResponse
+from core.http import DMSObjectStreamingResponse
 
 log = logging.getLogger('')
 
@@ -87,7 +87,7 @@ def get_file(request, code, suggested_format=None):
     if processor.errors:
         response = error_response(processor.errors)
     else:
-        response = DMSObjectResponse(document)
+        response = DMSObjectStreamingResponse(document, request=request)
     return response
 
 
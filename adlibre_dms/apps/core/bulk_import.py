@@ -0,0 +1,256 @@
+"""
+Module: DMS Core bulk documents import engine.
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Imports files from directories with a pool of worker processes.
+Files are grouped into batches of one document type rule. CouchDB metadata of a batch is written at once.
+Each imported file is written into a journal (path, size, mtime, content hash) as soon as it is stored,
+so an interrupted import can be resumed without storing files again.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import traceback
+import itertools
+import multiprocessing
+
+from django.db import connection
+from django.contrib.auth.models import User
+
+from core.models import DocumentTypeRuleManager
+from dmscouch.batch import couch_write_batch
+
+log = logging.getLogger('core.bulk_import')
+
+__all__ = ['BulkImporter', 'ImportJournal']
+
+
+def get_file_hash(path, chunk_size=64 * 1024):
+    """Returns sha1 hex digest of a file's content"""
+    file_hash = hashlib.sha1()
+    file_obj = open(path, 'rb')
+    try:
+        chunk = file_obj.read(chunk_size)
+        while chunk:
+            file_hash.update(chunk)
+            chunk = file_obj.read(chunk_size)
+    finally:
+        file_obj.close()
+    return file_hash.hexdigest()
+
+
+def import_batch(paths, journal_path=None):
+    """Imports a batch of files in a worker process.
+
+    @param paths: list of file paths of one document type rule
+    @param journal_path: path of a journal file stored files are added to
+    @return list of tuples (path, size, mtime, hash, error) where error is None for imported files"""
+    # Imported here so worker processes initialise plugins themselves
+    from core.document_processor import DocumentProcessor
+    admin = User.objects.filter(is_superuser=True)[0]
+    journal = ImportJournal(journal_path, load=False)
+    results = []
+    codes = {}
+    # CouchDB metadata of the batch is written with one request
+    with couch_write_batch() as batch:
+        for path in paths:
+            error = None
+            stat = os.stat(path)
+            file_hash = get_file_hash(path)
+            file_obj = open(path, 'rb')
+            processor = DocumentProcessor()
+            try:
+                document = processor.create(file_obj, {'user': admin})
+                if processor.errors:
+                    error = 'Import error: %s' % processor.errors
+                else:
+                    codes[document.get_code()] = len(results)
+                    journal.add(path, stat.st_size, int(stat.st_mtime), file_hash)
+            except Exception, e:
+                error = '%s\n%s' % (e, traceback.format_exc())
+            finally:
+                file_obj.close()
+            results.append([path, stat.st_size, int(stat.st_mtime), file_hash, error])
+    for code, error in batch.conflicts.iteritems():
+        if code in codes:
+            results[codes[code]][4] = 'CouchDB metadata error: %s' % error
+    return map(tuple, results)
+
+
+def import_batch_job(args):
+    """Pool job of import_batch() with arguments (paths, journal_path)"""
+    return import_batch(*args)
+
+
+class ImportJournal(object):
+    """Append only file of imported paths. Line format: path<TAB>size<TAB>mtime<TAB>sha1"""
+    def __init__(self, path=None, load=True):
+        self.path = path
+        self.entries = {}
+        if load and path and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        journal = open(self.path, 'r')
+        try:
+            for line in journal:
+                parts = line.rstrip('\n').rsplit('\t', 3)
+                if len(parts) == 4:
+                    self.entries[parts[0]] = (int(parts[1]), int(parts[2]), parts[3])
+        finally:
+            journal.close()
+
+    def is_imported(self, path):
+        """Checks a file was imported already with the same content
+
+        Stat data is compared first. Content hash is calculated only for files that were touched since."""
+        entry = self.entries.get(path, None)
+        if entry is None:
+            return False
+        stat = os.stat(path)
+        if (stat.st_size, int(stat.st_mtime)) == entry[:2]:
+            return True
+        return stat.st_size == entry[0] and get_file_hash(path) == entry[2]
+
+    def add(self, path, size, mtime, file_hash):
+        self.entries[path] = (size, mtime, file_hash)
+        if self.path:
+            # Line is appended with one write, so processes can share the journal
+            journal = open(self.path, 'a')
+            try:
+                journal.write('%s\t%s\t%s\t%s\n' % (path, size, mtime, file_hash))
+            finally:
+                journal.close()
+
+
+class BulkImporter(object):
+    """Imports files into DMS with a pool of worker processes"""
+    def __init__(self, workers=1, batch_size=50, journal=None, dry_run=False, stdout=None, stderr=None,
+                 report_every=10):
+        """
+        @param workers: number of worker processes (1 imports in current process)
+        @param batch_size: number of files of one docrule given to a worker at once
+        @param journal: path of a journal file to resume import from or None
+        @param dry_run: only resolve document type rules for files
+        @param stdout: stream for progress reports
+        @param stderr: stream for errors
+        @param report_every: seconds between progress reports
+        """
+        self.workers = max(int(workers), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.journal = ImportJournal(journal)
+        self.dry_run = dry_run
+        self.stdout = stdout
+        self.stderr = stderr
+        self.report_every = report_every
+        self.imported = 0
+        self.skipped = 0
+        self.failed = []
+        self.unresolved = []
+        self.docrule_counts = {}
+
+    def write(self, stream, message):
+        if stream is not None:
+            stream.write(message)
+
+    def collect_files(self, directories):
+        """Returns sorted list of file paths to import from given directories"""
+        paths = []
+        for directory in directories:
+            if not os.path.exists(directory):
+                self.write(self.stderr, 'Could not import %s: no such directory\n' % directory)
+                continue
+            for root, dirs, files in os.walk(directory):
+                if '.svn' in dirs:
+                    dirs.remove('.svn')  # don't visit svn directories
+                for filename in files:
+                    paths.append(os.path.abspath(os.path.join(root, filename)))
+        paths.sort()
+        return paths
+
+    def make_batches(self, paths):
+        """Groups files by document type rule into batches of self.batch_size
+
+        Files without docrule are reported in self.unresolved and left out."""
+        manager = DocumentTypeRuleManager()
+        groups = {}
+        for path in paths:
+            code = os.path.splitext(os.path.basename(path))[0]
+            docrule = manager.find_for_string(code)
+            if docrule is None:
+                self.unresolved.append(path)
+                continue
+            groups.setdefault(docrule.pk, []).append(path)
+            title = docrule.get_title()
+            self.docrule_counts[title] = self.docrule_counts.get(title, 0) + 1
+        batches = []
+        for docrule_pk in sorted(groups):
+            group = groups[docrule_pk]
+            for start in range(0, len(group), self.batch_size):
+                batches.append(group[start:start + self.batch_size])
+        return batches
+
+    def report_progress(self, done, total, started):
+        elapsed = time.time() - started
+        rate = done / elapsed if elapsed else 0.0
+        if rate:
+            seconds = int((total - done) / rate)
+            eta = '%d:%02d:%02d' % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+        else:
+            eta = 'unknown'
+        self.write(self.stdout, 'Processed %s of %s files (%.1f files/s, ETA %s)\n' % (done, total, rate, eta))
+
+    def process_results(self, results):
+        for path, size, mtime, file_hash, error in results:
+            if error:
+                self.failed.append(path)
+                self.write(self.stderr, 'Could not import "%s": %s\n' % (path, error))
+            else:
+                # Already journaled by the worker
+                self.imported += 1
+        return len(results)
+
+    def run(self, directories):
+        """Imports all files from directories. Returns number of imported documents."""
+        paths = self.collect_files(directories)
+        to_import = []
+        for path in paths:
+            if self.journal.is_imported(path):
+                self.skipped += 1
+            else:
+                to_import.append(path)
+        batches = self.make_batches(to_import)
+        for path in self.unresolved:
+            self.write(self.stderr, 'No document type rule found for "%s"\n' % path)
+        if self.dry_run:
+            for title in sorted(self.docrule_counts):
+                self.write(self.stdout, '%s: %s files\n' % (title, self.docrule_counts[title]))
+            return 0
+        total = sum(map(len, batches))
+        started = last_report = time.time()
+        done = 0
+        jobs = [(batch, self.journal.path) for batch in batches]
+        if self.workers == 1:
+            results = itertools.imap(import_batch_job, jobs)
+            pool = None
+        else:
+            # Forked workers must not share DB connection of this process
+            connection.close()
+            pool = multiprocessing.Pool(self.workers)
+            results = pool.imap_unordered(import_batch_job, jobs)
+        try:
+            for result in results:
+                done += self.process_results(result)
+                if time.time() - last_report >= self.report_every or done == total:
+                    self.report_progress(done, total, started)
+                    last_report = time.time()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return self.imported
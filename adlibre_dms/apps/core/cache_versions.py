@@ -0,0 +1,142 @@
+"""
+Module: DMS Core per process caches, invalidated across processes.
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Objects like compiled plugin pipelines or docrules are kept in memory of every process (thread safe dict).
+Every such cache has a version stamp file in DMS_CACHE_VERSIONS_ROOT, shared by all processes of a DMS.
+Bumping the version (e.g. on model save signal) replaces the stamp file,
+so all processes rebuild their copies on their next access after DMS_CACHE_VERSIONS_TTL seconds.
+"""
+
+import os
+import time
+import uuid
+import errno
+import logging
+import tempfile
+import threading
+
+from django.conf import settings
+
+log = logging.getLogger('core.cache_versions')
+
+__all__ = ['get_cache_version', 'bump_cache_version', 'ProcessCache']
+
+VERSIONS_ROOT = getattr(settings, 'DMS_CACHE_VERSIONS_ROOT', None) or \
+    os.path.join(settings.DOCUMENT_ROOT, '.cache_versions')
+# Seconds a process uses a version without checking its stamp file again
+VERSIONS_TTL = getattr(settings, 'DMS_CACHE_VERSIONS_TTL', 1)
+
+# Versions of this process: {name: (version, checked time)}
+_versions = {}
+
+
+def _stamp_path(name):
+    return os.path.join(VERSIONS_ROOT, name)
+
+
+def _read_version(name):
+    """Returns version of a stamp file (changes whenever the file is replaced) or None if there is no stamp"""
+    try:
+        stat = os.stat(_stamp_path(name))
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return '%s-%r-%r' % (stat.st_ino, stat.st_mtime, stat.st_ctime)
+
+
+def get_cache_version(name):
+    """Returns current version of a named cache, creating one if it is not set yet
+
+    @param name: name of a cache e.g. 'dms_plugins_pipelines'"""
+    now = time.time()
+    version, checked = _versions.get(name, (None, 0))
+    if version is not None and now - checked < VERSIONS_TTL:
+        return version
+    version = _read_version(name)
+    if version is None:
+        # Another process might create it in between, that only makes caches reload once more
+        return bump_cache_version(name)
+    _versions[name] = (version, now)
+    return version
+
+
+def bump_cache_version(name):
+    """Marks all the copies of a named cache (in all processes) as outdated
+
+    @param name: name of a cache e.g. 'dms_plugins_pipelines'
+    @return: the new version"""
+    if not os.path.isdir(VERSIONS_ROOT):
+        try:
+            os.makedirs(VERSIONS_ROOT)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    # New file replaces the stamp atomically, with a new inode
+    handle, tmp_path = tempfile.mkstemp(prefix='.%s.' % name, dir=VERSIONS_ROOT)
+    try:
+        os.write(handle, uuid.uuid4().hex)
+    finally:
+        os.close(handle)
+    os.rename(tmp_path, _stamp_path(name))
+    version = _read_version(name)
+    _versions[name] = (version, time.time())
+    return version
+
+
+class ProcessCache(object):
+    """In memory cache of a process, that is dropped when its shared version changes.
+
+    Values are stored as is (not pickled) so they must not be modified by callers.
+    stats counters show how much of the lookups were served from memory.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.version = None
+        self.data = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'resets': 0}
+
+    def validate(self):
+        """Drops local data in case the shared version has changed"""
+        version = get_cache_version(self.name)
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self.data = {}
+                    self.version = version
+                    self.stats['resets'] += 1
+        return version
+
+    def get_or_build(self, key, builder, *args, **kwargs):
+        """Returns cached value for a key or builds it calling builder(*args, **kwargs)
+
+        @param key: hashable key of a value
+        @param builder: callable that returns a value"""
+        version = self.validate()
+        data = self.data
+        if key in data:
+            self.stats['hits'] += 1
+            return data[key]
+        self.stats['misses'] += 1
+        value = builder(*args, **kwargs)
+        with self.lock:
+            # Not storing value if the cache was reset during build (value may be outdated already)
+            if self.version == version:
+                self.data[key] = value
+        return value
+
+    def invalidate(self, *args, **kwargs):
+        """Drops this cache in every process. Can be connected to a model signal directly."""
+        bump_cache_version(self.name)
+        with self.lock:
+            self.data = {}
+            self.version = None
+
+    def reset_stats(self):
+        for key in self.stats:
+            self.stats[key] = 0
@@ -16,7 +16,7 @@ from django.core.files.uploadedfile import UploadedFile
 from dms_plugins import pluginpoints
 from dms_plugins.operator import PluginsOperator
 
-from core.models import Document
+from core.models import Document, DocumentTypeRuleManager
 from core.errors import DmsException
 
 log = logging.getLogger('core.document_processor')
@@ -61,6 +61,7 @@ class DocumentProcessor(object):
     def __init__(self):
         self.errors = []
         self.warnings = []
+        self.document_errors = {}
         self.document_name = ''
         self.document_file = None
 
@@ -150,6 +151,62 @@ class DocumentProcessor(object):
         self.check_errors_in_operator(operator)
         return doc
 
+    def read_bulk(self, document_names, options):
+        """
+        Reads many Document()'s data from DMS in one go.
+
+        Documents are grouped by their docrule. Plugin mapping and retrieval plugins are looked up once per docrule
+        and plugins able to prefetch (e.g. CouchDB metadata) load data for the whole group at once.
+
+        Errors are stored per document name into self.document_errors instead of self.errors.
+
+        @param document_names: iterable of document names (codes)
+        @param options: read options. Same as for read() method.
+        @return: dict of {document_name: Document()} for documents read without errors
+        """
+        log.debug('READ BULK %s Documents with options: %s' % (len(document_names), options))
+        documents = {}
+        groups = {}
+        dman = DocumentTypeRuleManager()
+        for document_name in document_names:
+            if document_name in documents or document_name in self.document_errors:
+                continue
+            docrule = dman.find_for_string(document_name)
+            if docrule is None:
+                self.document_errors[document_name] = [DmsException('No document type rule found', 404)]
+                continue
+            doc = Document()
+            doc.docrule = docrule
+            doc.set_filename(document_name)
+            try:
+                doc = self.init_Document_with_data(options, doc)
+            except DmsException, e:
+                self.document_errors[document_name] = [e]
+                continue
+            documents[document_name] = doc
+            # Plugins may change a document's filename, so results are kept by requested name
+            groups.setdefault(docrule.pk, []).append((document_name, doc))
+        for group in groups.itervalues():
+            try:
+                mapping = group[0][1].get_docrule().get_docrule_plugin_mappings()
+            except DmsException, e:
+                for document_name, doc in group:
+                    self.document_errors[document_name] = [e]
+                    del documents[document_name]
+                continue
+            group_operator = PluginsOperator()
+            plugins = group_operator.get_plugins_from_mapping(mapping, pluginpoints.BeforeRetrievalPluginPoint, None)
+            group_operator.prefetch_for_plugins(plugins, [doc for document_name, doc in group])
+            for document_name, doc in group:
+                operator = PluginsOperator()
+                document = operator.process_plugins(plugins, doc)
+                if operator.plugin_errors:
+                    self.document_errors[document_name] = operator.plugin_errors
+                    del documents[document_name]
+                else:
+                    documents[document_name] = document
+        return documents
+
     # TODO: Update should not delete all the old document's revisions on rename.
     def update(self, document_name, options):
         """
@@ -193,10 +250,15 @@ class DocumentProcessor(object):
             # HACK: Read the data and remove thumbnails in one call
             old_document = self.read(document_name, {'user': user, 'only_metadata': True, 'remove_thumbnails': True})
             # Retrieving file revisions and storing into self for plugins modifications.
-            fr_data = old_document.get_file_revisions_data()
-            for rev_id in fr_data.iterkeys():
-                temp_doc = self.read(document_name, {'user': user, 'revision': rev_id})
-                doc.file_revisions[rev_id] = temp_doc.get_file_obj()
+            # Not needed if stored files can be moved as is (storage plugins move files without revisions given)
+            if not self.files_can_be_moved(doc, operator):
+                fr_data = old_document.get_file_revisions_data()
+                for rev_id in fr_data.iterkeys():
+                    temp_doc = self.read(document_name, {'user': user, 'revision': rev_id})
+                    doc.file_revisions[rev_id] = temp_doc.get_file_obj()
+            # Before update plugins migrate file revision data (e.g. storage plugins journal file moves)
+            plugins = operator.get_plugins_for_point(pluginpoints.UpdatePluginPoint, doc)
+            operator.prepare_update_for_plugins(plugins, doc, old_document)
         # Storing new file revision of an object. It requires content setup from uploaded file.
         if new_file_revision:
             if 'content_type' in new_file_revision.__dict__.iterkeys():
@@ -211,6 +273,21 @@ class DocumentProcessor(object):
         self.check_errors_in_operator(operator)
         return doc
 
+    def files_can_be_moved(self, document, operator):
+        """Checks stored files of a document changing docrule are readable under its new docrule as they are
+
+        That is true when both docrules decode stored files (e.g. decompress) with the same plugins."""
+        old_mapping = document.old_docrule.get_docrule_plugin_mappings()
+        new_mapping = document.get_docrule().get_docrule_plugin_mappings()
+        if not old_mapping or not new_mapping:
+            return False
+        pluginpoint = pluginpoints.BeforeRetrievalPluginPoint
+        decoders = [
+            [plugin.__class__ for plugin in operator.get_plugins_from_mapping(mapping, pluginpoint, 'retrieval_processing')]
+            for mapping in (old_mapping, new_mapping)
+        ]
+        return decoders[0] == decoders[1]
+
     def delete(self, document_name, options):
         """Deletes Document() or it's parts from DMS."""
         log.debug('DELETEE Document %s, options: %s' % (document_name, options) )
@@ -218,6 +295,12 @@ class DocumentProcessor(object):
         doc = self.init_Document_with_data(options, document_name=document_name)
         if self.option_in_options('delete_revision', options):
             doc = self.read(document_name, options)
+        elif not (self.option_in_options('mark_deleted', options) or
+                  self.option_in_options('mark_revision_deleted', options)):
+            # Removal plugins find stored files by file revision data of metadata retrieval plugins.
+            # Read errors are not removal ones (e.g. document without metadata is still removed).
+            stored = DocumentProcessor().read(document_name, dict(options, only_metadata=True))
+            doc.set_file_revisions_data(stored.get_file_revisions_data())
         doc = operator.process_pluginpoint(pluginpoints.BeforeRemovalPluginPoint, document=doc)
         self.check_errors_in_operator(operator)
         return doc
@@ -324,6 +407,9 @@ class DocumentProcessor(object):
                     ]:
                         if value:
                             doc.update_options({property_name: True})
+                    if property_name in ['preview_size', 'preview_page', 'preview_format']:
+                        if value:
+                            doc.update_options({property_name: value})
                     if property_name == 'update_file':
                         doc.set_file_obj(value)
                         if value:
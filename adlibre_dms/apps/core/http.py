@@ -8,6 +8,8 @@ Author: Iurii Garmash
 Desc: Main http objects manipulation methods here.
 """
 
+import os
+import calendar
 import logging
 import json
 import traceback
@@ -17,11 +19,163 @@ from wsgiref.handlers import format_date_time
 from datetime import datetime, timedelta
 from time import mktime
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from django.core.urlresolvers import reverse
+from django.utils import timezone
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
 
 log = logging.getLogger('core.http')
 
+FILE_CHUNK_SIZE = getattr(settings, 'DMS_FILE_CHUNK_SIZE', 64 * 1024)
+SENDFILE_HEADER = getattr(settings, 'DMS_SENDFILE_HEADER', None)
+SENDFILE_URL_PREFIX = getattr(settings, 'DMS_SENDFILE_URL_PREFIX', '/protected_documents/')
+
+
+def get_file_size(file_obj):
+    """Returns size of a given file object in bytes, rewinding it to the start"""
+    file_obj.seek(0, os.SEEK_END)
+    size = file_obj.tell()
+    file_obj.seek(0)
+    return size
+
+
+def file_iterator(file_obj, chunk_size=FILE_CHUNK_SIZE, length=None):
+    """Yields file object content in chunks and closes file object afterwards
+
+    @param file_obj: file object to read from (reading starts from it's current position)
+    @param chunk_size: maximum size of one chunk in bytes
+    @param length: number of bytes to read. Reads till the end of file if not specified."""
+    try:
+        while length is None or length > 0:
+            if length is None:
+                chunk = file_obj.read(chunk_size)
+            else:
+                chunk = file_obj.read(min(chunk_size, length))
+                length -= len(chunk)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        file_obj.close()
+
+
+def parse_range_header(range_header, size):
+    """Parses HTTP 'Range' header value for a single bytes range.
+
+    @param range_header: 'Range' header value, e.g.: 'bytes=0-499', 'bytes=500-' or 'bytes=-500'
+    @param size: size of the file in bytes
+    @return: (first_byte, last_byte) tuple for a proper range,
+        None for a missing, malformed or multiple ranges header (entire file should be sent)
+        and False for a range that can not be satisfied"""
+    if not range_header or not range_header.startswith('bytes='):
+        return None
+    ranges = range_header[6:].split(',')
+    if len(ranges) != 1:
+        return None
+    start, separator, end = ranges[0].strip().partition('-')
+    if not separator:
+        return None
+    try:
+        if not start:
+            # Suffix range. Last N bytes of file requested.
+            suffix_length = int(end)
+            if suffix_length <= 0 or not size:
+                return False
+            return max(size - suffix_length, 0), size - 1
+        start = int(start)
+        if end:
+            end = int(end)
+        else:
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def get_document_validators(document):
+    """Returns ETag and Last-Modified timestamp for a Document() current revision
+
+    Validators are taken from stored revision metadata ('hashcode' and 'created_date'),
+    so the file itself is not read.
+
+    @param document: DMS Document() instance
+    @return: (etag, last_modified) tuple. Any of them may be None in case revision metadata lacks data."""
+    revision_data = document.get_current_file_revision_data() or {}
+    etag = None
+    hashcode = revision_data.get('hashcode', None)
+    if hashcode:
+        etag = '%s-%s' % (hashcode, document.get_revision())
+        # File converted into another format is a different entity
+        if document.get_requested_extension():
+            etag = '%s-%s' % (etag, document.get_requested_extension())
+    last_modified = None
+    created_date = revision_data.get('created_date', None)
+    if created_date:
+        try:
+            # Revision dates are stored in TIME_ZONE. HTTP dates are UTC.
+            created = timezone.make_aware(
+                datetime.strptime(created_date, settings.DATETIME_FORMAT), timezone.get_default_timezone()
+            )
+            last_modified = calendar.timegm(created.utctimetuple())
+        except Exception, e:
+            # Wrong date format or local time that does not exist (or is ambiguous) at DST changes
+            log.debug('No Last-Modified for %s: %s' % (document.get_code(), e))
+    return etag, last_modified
+
+
+def set_document_validators(response, document):
+    """Sets ETag and Last-Modified headers for a response with Document() file"""
+    etag, last_modified = get_document_validators(document)
+    if etag:
+        response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def is_conditional_request(request):
+    """Checks if request has conditional GET headers"""
+    return 'HTTP_IF_NONE_MATCH' in request.META or 'HTTP_IF_MODIFIED_SINCE' in request.META
+
+
+def document_not_modified(request, document):
+    """Checks conditional GET headers of a request against Document() validators
+
+    @param request: Django request object
+    @param document: DMS Document() instance
+    @return: True in case client has an up to date copy of the document"""
+    etag, last_modified = get_document_validators(document)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag in etags
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE', None)
+    if if_modified_since and last_modified is not None:
+        modified_since = parse_http_date_safe(if_modified_since)
+        return modified_since is not None and last_modified <= modified_since
+    return False
+
+
+def get_response_filename(document):
+    """Returns file name for a Document() returned in HTTP response
+
+    Renames returned document in case we have certain revision request."""
+    current_revision = document.get_revision()
+    file_revision_data = document.get_file_revisions_data()
+    revisions_count = file_revision_data.__len__()
+    if current_revision < revisions_count:
+        filename = document.get_filename_with_revision()
+    else:
+        filename = document.get_full_filename()
+    return filename
+
 
 class DMSObjectResponse(HttpResponse):
     """
@@ -47,7 +201,11 @@ class DMSObjectResponse(HttpResponse):
         super(DMSObjectResponse, self).__init__(content=content, content_type=content_type)
         if content is not None:
             self["Content-Length"] = len(content)
-            if thumbnail:
+            if thumbnail and document.thumbnail_pending:
+                self["Content-Type"] = content_type
+                # Placeholder of a thumbnail being generated
+                self["Cache-Control"] = 'no-cache'
+            elif thumbnail:
                 self["Content-Type"] = content_type
                 # Cache thumbnails for 1 day
                 now = datetime.now()
@@ -63,21 +221,15 @@ class DMSObjectResponse(HttpResponse):
         document.get_file_obj().seek(0)
         content = document.get_file_obj().read()
         content_type = document.get_mimetype()
-        # Renaming returned document in case we have certain revision request
-        current_revision = document.get_revision()
-        file_revision_data = document.get_file_revisions_data()
-        revisions_count = file_revision_data.__len__()
-        if current_revision < revisions_count:
-            filename = document.get_filename_with_revision()
-        else:
-            filename = document.get_full_filename()
+        filename = get_response_filename(document)
         return content, content_type, filename
 
     def retieve_thumbnail(self, document):
         # Getting thumbnail details
         content = document.thumbnail
-        content_type = 'image/png'
-        filename = document.get_full_filename() + '.png'
+        preview_format = document.thumbnail_format or 'png'
+        content_type = 'image/%s' % preview_format
+        filename = document.get_full_filename() + '.' + preview_format
         return content, content_type, filename
 
     def httpdate(self, dt):
@@ -94,6 +246,109 @@ class DMSObjectResponse(HttpResponse):
             dt.year, dt.hour, dt.minute, dt.second)
 
 
+class DMSObjectStreamingResponse(StreamingHttpResponse):
+    """
+    StreamingHttpResponse() object sending DMSObject()'s file in chunks.
+
+    Unlike DMSObjectResponse() document file is never read into memory as a whole.
+    Sends a stored revision with the front end web server (X-Sendfile/X-Accel-Redirect) if DMS_SENDFILE_HEADER is set
+    and file is served unmodified from DOCUMENT_ROOT.
+    Falls back to a chunked file iterator in case plugins (e.g. gzip or convert) have changed the file object.
+
+    Supports single range 'Range' requests (206 Partial Content) in case request is provided.
+
+    e.g. (django app's view):
+
+        def read_file_from_dms(request, filename):
+            document = DocumentProcessor().read(request, filename)
+            response = DMSObjectStreamingResponse(document, request=request)
+            return response
+    """
+    def __init__(self, document, request=None, chunk_size=FILE_CHUNK_SIZE):
+        file_obj = document.get_file_obj()
+        content_type = document.get_mimetype()
+        sendfile_path = self.get_sendfile_path(document)
+        if sendfile_path:
+            # Web server handles ranges by itself
+            file_obj.close()
+            super(DMSObjectStreamingResponse, self).__init__(content_type=content_type)
+            self[SENDFILE_HEADER] = sendfile_path
+            log.debug('DMSObjectStreamingResponse offloaded file %s with %s' % (sendfile_path, SENDFILE_HEADER))
+        else:
+            size = get_file_size(file_obj)
+            byte_range = None
+            if request is not None and self.range_allowed(request, document):
+                byte_range = parse_range_header(request.META.get('HTTP_RANGE', None), size)
+            if byte_range is False:
+                file_obj.close()
+                super(DMSObjectStreamingResponse, self).__init__(content_type=content_type, status=416)
+                self["Content-Range"] = 'bytes */%s' % size
+            elif byte_range:
+                start, end = byte_range
+                length = end - start + 1
+                file_obj.seek(start)
+                super(DMSObjectStreamingResponse, self).__init__(
+                    streaming_content=file_iterator(file_obj, chunk_size, length),
+                    content_type=content_type,
+                    status=206
+                )
+                self["Content-Range"] = 'bytes %s-%s/%s' % (start, end, size)
+                self["Content-Length"] = length
+            else:
+                super(DMSObjectStreamingResponse, self).__init__(
+                    streaming_content=file_iterator(file_obj, chunk_size),
+                    content_type=content_type
+                )
+                self["Content-Length"] = size
+        self["Accept-Ranges"] = 'bytes'
+        self["Content-Disposition"] = 'filename=%s' % get_response_filename(document)
+        set_document_validators(self, document)
+
+    def range_allowed(self, request, document):
+        """Checks 'If-Range' header. Range must be ignored in case client has an outdated copy of document."""
+        if_range = request.META.get('HTTP_IF_RANGE', None)
+        if not if_range:
+            return True
+        etag, last_modified = get_document_validators(document)
+        if etag and if_range == quote_etag(etag):
+            return True
+        if last_modified is not None and if_range == http_date(last_modified):
+            return True
+        return False
+
+    def get_sendfile_path(self, document):
+        """Returns path for a sendfile header or None in case file can not be sent by the web server
+
+        @param document: DMS Document() instance"""
+        if not SENDFILE_HEADER:
+            return None
+        fullpath = document.get_fullpath()
+        # File object must be the stored revision itself. Not decompressed or converted one.
+        if not fullpath or getattr(document.get_file_obj(), 'name', None) != fullpath:
+            return None
+        if document.get_current_file_revision_data().get('compression_type', None):
+            return None
+        root = os.path.abspath(settings.DOCUMENT_ROOT)
+        path = os.path.abspath(fullpath)
+        if not path.startswith(root + os.sep):
+            return None
+        if SENDFILE_HEADER == 'X-Accel-Redirect':
+            relative_path = os.path.relpath(path, root).replace(os.sep, '/')
+            return SENDFILE_URL_PREFIX.rstrip('/') + '/' + relative_path
+        return path
+
+
+class DMSObjectNotModifiedResponse(HttpResponseNotModified):
+    """
+    HttpResponseNotModified() object for conditional requests of DMSObject()'s file.
+
+    Made from DMSObject() populated with metadata only, so the file is not read.
+    """
+    def __init__(self, document):
+        super(DMSObjectNotModifiedResponse, self).__init__()
+        set_document_validators(self, document)
+
+
 class DMSOBjectRevisionsData(dict):
     """Base object for DMS Object file data dict for HTTP responses"""
 
@@ -24,6 +24,7 @@ from optparse import make_option
 
 #from core.document_processor import DocumentProcessor
 from dmscouch.models import CouchDocument
+from dmscouch.batch import couch_write_batch
 import core
 
 
@@ -58,17 +59,21 @@ class Command(BaseCommand):
         if codes or revisions:
             processor = core.document_processor.DocumentProcessor()
             user = User.objects.filter(is_superuser=True)[0]
-            for code in codes:
-                processor.delete(code, {'user': user})
-                if not processor.errors:
-                    if not quiet:
-                        self.stdout.write('Permanently deleted object with code: %s' % code)
-                else:
-                    if not quiet:
-                        self.stdout.write(processor.errors)
-                    raise(Exception, processor.errors)
-            for rev in revisions:
-                processor.delete(rev[0], {'user': user, 'delete_revision': rev[1]})
+            # CouchDB documents are written with _bulk_docs requests
+            with couch_write_batch() as batch:
+                for code in codes:
+                    processor.delete(code, {'user': user})
+                    if not processor.errors:
+                        if not quiet:
+                            self.stdout.write('Permanently deleted object with code: %s' % code)
+                    else:
+                        if not quiet:
+                            self.stdout.write(processor.errors)
+                        raise(Exception, processor.errors)
+                for rev in revisions:
+                    processor.delete(rev[0], {'user': user, 'delete_revision': rev[1]})
+            if batch.conflicts and not quiet:
+                self.stdout.write('Could not update CouchDB documents: %s \n' % batch.conflicts)
 
     def get_codes(self):
         deleted_codes = CouchDocument.view('dmscouch/deleted')
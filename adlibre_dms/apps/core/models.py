@@ -15,11 +15,15 @@ import magic
 import mimetypes
 import time
 import logging
+import threading
 
 from django.conf import settings
-from django.db import models
-from django.db.models import ForeignKey, CharField
+from django.db import models, transaction
+from django.db.models import ForeignKey, CharField, F
+from django.db.models import signals
 from core.errors import DmsException
+from core.cache_versions import ProcessCache, get_cache_version, bump_cache_version
+from core.streams import run_stream_stages, abort_stream_stages
 
 from django.core.cache import get_cache
 from django.contrib.auth.models import Permission
@@ -31,7 +35,25 @@ import dms_plugins
 
 log = logging.getLogger('core')
 
-__all__ = ['DocumentTypeRule', 'DocumentTypeRuleManager', 'DocumentTypeRulePermission', 'Document', 'DocTags']
+__all__ = [
+    'DocumentTypeRule',
+    'DocumentTypeRuleManager',
+    'DocumentTypeRuleResolver',
+    'DocumentBarcodeAllocator',
+    'DocumentTypeRulePermission',
+    'Document',
+    'DocTags'
+]
+
+# Characters of a regex that can not be a part of it's literal prefix
+REGEX_SPECIAL_CHARS = '.^$*+?{}[]\\|()'
+REGEX_QUANTIFIERS = '*?{'
+
+# Barcodes reserved at once by a process for every docrule.
+BARCODE_BLOCK_SIZE = getattr(settings, 'DMS_BARCODE_BLOCK_SIZE', 1)
+
+# Bytes of a file libmagic needs to guess its mimetype
+MIMETYPE_SNIFF_SIZE = 8 * 1024
 
 
 def get_doctypes():
@@ -107,12 +129,25 @@ class DocumentTypeRule(models.Model):
     def __unicode__(self):
         return unicode(self.get_title())
 
+    def __init__(self, *args, **kwargs):
+        super(DocumentTypeRule, self).__init__(*args, **kwargs)
+        # Barcodes allocated by other processes change sequence_last in DB after it is loaded
+        self._loaded_sequence_last = self.sequence_last
+
     def save(self, *args, **kwargs):
         """Overriding save method to add permissions into admin
 
+        sequence_last is saved only if it was changed on this instance (e.g. in admin),
+        so a stale value does not overwrite barcodes allocated meanwhile.
+
         @param args: arguments
         @param kwargs arguments
         """
+        if not self._state.adding and kwargs.get('update_fields', None) is None and not kwargs.get('force_insert', False) \
+                and self.sequence_last == self._loaded_sequence_last:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.local_fields if not field.primary_key and field.name != 'sequence_last'
+            ]
         content_type, created = ContentType.objects.get_or_create(
             app_label='rule',
             model='',
@@ -124,6 +159,7 @@ class DocumentTypeRule(models.Model):
             content_type=content_type
         )
         super(DocumentTypeRule, self).save(*args, **kwargs)
+        self._loaded_sequence_last = self.sequence_last
 
     def validate(self, document_name):
         """Validates DocumentTypeRule against available "document_name" string.
@@ -213,23 +249,27 @@ class DocumentTypeRule(models.Model):
     def set_last_document_number(self, number):
         """SET last document number for this instance.
 
+        Drops barcodes reserved by all processes, so next allocated barcode follows this number.
+
         @param number: number to be set in format int()
         """
         self.sequence_last = int(number)
-        self.save()
+        self.save(update_fields=['sequence_last'])
+        barcode_allocator.reset()
         return self
 
     def allocate_barcode(self):
-        """Function increments last document number for this Document Type Model by int(1)"""
-        log.debug('doc_codes.models allocate_barcode. sequence_last: %s', self.sequence_last)
-        self.sequence_last += 1
-        self.save()
-        return self._generate_document_barcode(self.sequence_last)
+        """Function increments last document number for this Document Type Model by int(1)
+
+        Increment is atomic in DB, so concurrent requests never get the same barcode."""
+        number = barcode_allocator.allocate(self)
+        log.debug('doc_codes.models allocate_barcode. sequence_last: %s', number)
+        self.sequence_last = self._loaded_sequence_last = number
+        return self._generate_document_barcode(number)
 
     def show_last_allocated_barcode(self):
         """Function shows last available Document Code used for this Document Type Rule"""
-        self.sequence_last += 1
-        return self._generate_document_barcode(self.sequence_last)
+        return self._generate_document_barcode(self.sequence_last + 1)
 
     def _generate_document_barcode(self, sequence):
         """Function generates next barcode in sequence.
@@ -250,42 +290,110 @@ class DocumentTypeRule(models.Model):
             return False
 
     def get_docrule_plugin_mappings(self):
-        """Returns DocumentTypeRule Mapping for this instance"""
-        log.info('get_docrule_mapping for DocumentTypeRule : %s.' % self)
-        mapping = dms_plugins.models.DoccodePluginMapping.objects.filter(
-            doccode=str(self.pk),
-            active=True)
-        if mapping.count():
-            mapping = mapping[0]
-        else:
+        """Returns DocumentTypeRule Mapping for this instance
+
+        Memoized per process until docrules or plugin mappings change."""
+        mapping = docrule_metadata_cache.get_or_build(('mapping', self.pk), self._load_docrule_plugin_mapping)
+        if mapping is None:
             raise DmsException('Rule not found', 404)
         return mapping
 
+    def _load_docrule_plugin_mapping(self):
+        log.info('get_docrule_mapping for DocumentTypeRule : %s.' % self)
+        mappings = dms_plugins.models.DoccodePluginMapping.objects.filter(doccode=str(self.pk), active=True)[:1]
+        if mappings:
+            return mappings[0]
+        return None
+
     @property
     def uncategorized(self):
-        """Boolean function to know if a model is set as uncategorised in DMS"""
+        """Boolean function to know if a model is set as uncategorised in DMS
+
+        Memoized per process until docrules or core configuration change."""
+        return docrule_metadata_cache.get_or_build(('uncategorized', self.pk), self._load_uncategorized)
+
+    def _load_uncategorized(self):
         configs = CoreConfiguration.objects.filter(uncategorized__pk__exact=self.pk)
-        if configs.count():
+        if configs.exists():
             # this config is uncategorized
             return True
         return False
 
 
+class DocumentBarcodeAllocator(object):
+    """Hands out DocumentTypeRule sequence numbers for barcodes.
+
+    Numbers are reserved with an atomic increment of DocumentTypeRule.sequence_last in DB.
+    With block_size > 1 a process reserves that much numbers at once and hands them out from memory.
+    Numbers of a block left unused (e.g. on process restart) are skipped.
+    """
+    cache_name = 'core_barcode_blocks'
+
+    def __init__(self, block_size=1):
+        self.block_size = max(int(block_size), 1)
+        self.blocks = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def reserve(self, docrule_pk, count):
+        """Atomically adds count to docrule's sequence_last in DB and returns the new value"""
+        with transaction.atomic():
+            DocumentTypeRule.objects.filter(pk=docrule_pk).update(sequence_last=F('sequence_last') + count)
+            # Row stays locked by update until the end of transaction
+            return DocumentTypeRule.objects.filter(pk=docrule_pk).values_list('sequence_last', flat=True)[0]
+
+    def allocate(self, docrule):
+        """Returns next unused sequence number of a docrule
+
+        @param docrule: DocumentTypeRule() instance"""
+        if self.block_size == 1:
+            return self.reserve(docrule.pk, 1)
+        with self.lock:
+            version = get_cache_version(self.cache_name)
+            if version != self.version:
+                self.blocks = {}
+                self.version = version
+            block = self.blocks.get(docrule.pk, None)
+            if block is None or block[0] > block[1]:
+                last = self.reserve(docrule.pk, self.block_size)
+                block = self.blocks[docrule.pk] = [last - self.block_size + 1, last]
+            number = block[0]
+            block[0] += 1
+            return number
+
+    def reset(self):
+        """Drops reserved blocks in all processes"""
+        bump_cache_version(self.cache_name)
+        with self.lock:
+            self.blocks = {}
+
+
+barcode_allocator = DocumentBarcodeAllocator(BARCODE_BLOCK_SIZE)
+
+
 class DocumentTypeRuleManager(object):
     """Helper to handle document type rule searches and operations"""
 
+    cache_key = 'docrules_objects'
+
     def __init__(self):
         """Every manager Instance has it's own document type rules set in memory (cache), not touching the DB often."""
-        # Using cache to store DB objects.
-        cache_docrules_for = 300  # 5 minutes (new updated docrules will be stored)
-        cache = get_cache('core')
-        cache_key = 'docrules_objects'
-        cached_docrules = cache.get(cache_key, None)
-        if not cached_docrules:
-            self.docrules = DocumentTypeRule.objects.all()
-            cache.set(cache_key, self.docrules, cache_docrules_for)
-        else:
-            self.docrules = cached_docrules
+        self._docrules = None
+
+    @property
+    def docrules(self):
+        """Document type rules, loaded from cache on first usage"""
+        if self._docrules is None:
+            # Using cache to store DB objects.
+            cache_docrules_for = 300  # 5 minutes (new updated docrules will be stored)
+            cache = get_cache('core')
+            cached_docrules = cache.get(self.cache_key, None)
+            if not cached_docrules:
+                self._docrules = DocumentTypeRule.objects.all()
+                cache.set(self.cache_key, self._docrules, cache_docrules_for)
+            else:
+                self._docrules = cached_docrules
+        return self._docrules
 
     def get_uncategorized(self):
         """Returns Uncategorized document type rule (In case it is set in system) or None (In case it is not)"""
@@ -300,16 +408,10 @@ class DocumentTypeRuleManager(object):
     def find_for_string(self, string):
         """Find a DocumentType that corresponds to certain string
 
+        Uses compiled DocumentTypeRuleResolver() of this process.
+
         @param string: a string to check"""
-        res = None
-        for docrule in self.docrules:
-            if docrule.validate(string):
-                res = docrule
-                break
-        if res is None:
-            # Assigning Uncategorized doc type
-            res = self.get_uncategorized()
-        return res
+        return get_docrule_resolver().find_for_string(string)
 
     def get_docrules(self):
         """Get cached document types"""
@@ -338,6 +440,101 @@ class DocumentTypeRuleManager(object):
         return docrule_instance
 
 
+class DocumentTypeRuleResolver(object):
+    """Compiled index to find a DocumentTypeRule for a document code.
+
+    Gives the same results as validating each rule in turn, (first matching rule wins)
+    but with regexes compiled once and skipping rules with a literal prefix the code does not start with.
+    """
+    def __init__(self, docrules, uncategorized, uncategorized_ids):
+        """
+        @param docrules: iterable of DocumentTypeRule() instances in order of validation
+        @param uncategorized: DocumentTypeRule() instance to fall back to or None
+        @param uncategorized_ids: set of DocumentTypeRule() pk's set as uncategorized in CoreConfiguration
+        """
+        self.uncategorized = uncategorized
+        self.rules = []
+        for docrule in docrules:
+            regex = str(docrule.regex)
+            if docrule.pk in uncategorized_ids and regex != '':
+                # Uncategorized rule with a regex never validates a code
+                continue
+            try:
+                compiled = re.compile('^' + regex + '$')
+            except re.error, e:
+                log.error('DocumentTypeRuleResolver: wrong regex for docrule %s: %s' % (docrule, e))
+                continue
+            self.rules.append((self.literal_prefix(regex), compiled, docrule))
+        # Rules to check for a code's first character, all in original order
+        unprefixed = [rule for rule in self.rules if not rule[0]]
+        self.dispatch = {}
+        for rule in self.rules:
+            if rule[0]:
+                self.dispatch.setdefault(rule[0][0], [])
+        for char in self.dispatch:
+            self.dispatch[char] = [rule for rule in self.rules if not rule[0] or rule[0][0] == char]
+        self.unprefixed = unprefixed
+
+    @staticmethod
+    def literal_prefix(regex):
+        """Returns literal characters every string matching a regex starts with (may be empty)
+
+        @param regex: a DocumentTypeRule regex string e.g. '^ADL-[0-9]{4}$'"""
+        if '|' in regex:
+            # Alternatives may start with anything
+            return ''
+        prefix = []
+        position = 1 if regex.startswith('^') else 0
+        while position < len(regex):
+            char = regex[position]
+            if char == '\\':
+                escaped = regex[position + 1:position + 2]
+                if not escaped or escaped.isalnum():
+                    # Character classes like \d or \w
+                    break
+                char = escaped
+                next_position = position + 2
+            elif char in REGEX_SPECIAL_CHARS:
+                break
+            else:
+                next_position = position + 1
+            if regex[next_position:next_position + 1] and regex[next_position] in REGEX_QUANTIFIERS:
+                # Char is optional or repeated
+                break
+            prefix.append(char)
+            position = next_position
+        return ''.join(prefix)
+
+    def find_for_string(self, string):
+        """Returns first DocumentTypeRule() matching a code or uncategorized one
+
+        @param string: a document code to check"""
+        for prefix, compiled, docrule in self.dispatch.get(string[:1], self.unprefixed):
+            if string.startswith(prefix) and compiled.match(string):
+                return docrule
+        return self.uncategorized
+
+
+# Compiled DocumentTypeRuleResolver() of this process, rebuilt on docrules or config change
+docrule_resolver_cache = ProcessCache('core_docrule_resolver')
+
+# Uncategorized flags and active plugin mappings of docrules by pk, dropped on docrules, config or mappings change
+docrule_metadata_cache = ProcessCache('core_docrule_metadata')
+
+
+def build_docrule_resolver():
+    """Creates DocumentTypeRuleResolver() from DB data"""
+    docrules = list(DocumentTypeRule.objects.all())
+    uncategorized = DocumentTypeRuleManager().get_uncategorized()
+    uncategorized_ids = set(CoreConfiguration.objects.values_list('uncategorized__pk', flat=True))
+    return DocumentTypeRuleResolver(docrules, uncategorized, uncategorized_ids)
+
+
+def get_docrule_resolver():
+    """Returns compiled DocumentTypeRuleResolver() of this process"""
+    return docrule_resolver_cache.get_or_build('resolver', build_docrule_resolver)
+
+
 class DocumentTypeRulePermission(models.Model):
     """Proxy model for a proper admin placement. All the magic in admin.py"""
     pass
@@ -387,12 +584,18 @@ class Document(object):
         self.full_filename = None
         self.code = None
         self.thumbnail = None
+        self.thumbnail_pending = False
+        self.thumbnail_format = None
+        # Thumbnail jobs of a new file, queued by storage plugins once the file is stored
+        self.thumbnail_jobs = []
         self.revision = None
         self.hashcode = None
         self.file_revision_data = None
         self.file_revisions = {}
+        self.file_revisions_compression = {}
         self.fullpath = None
         self.file_obj = None
+        self.stream_stages = []
         self.current_file_revision_data = {}
         self.mimetype = None
         self.tags = []
@@ -461,9 +664,13 @@ class Document(object):
     def get_mimetype(self):
         if not self.mimetype and self.get_current_file_revision_data():
             self.mimetype = self.get_current_file_revision_data().get('mimetype', None)
-        if not self.mimetype and self.get_file_obj():
+        # Sniffing original file (not processed by pending stream stages)
+        file_obj = self.file_obj or self.get_file_obj()
+        if not self.mimetype and file_obj:
             mime = magic.Magic(mime=True)
-            self.mimetype = mime.from_buffer(self.get_file_obj().read())
+            file_obj.seek(0)
+            self.mimetype = mime.from_buffer(file_obj.read(MIMETYPE_SNIFF_SIZE))
+            file_obj.seek(0)
             log.debug('get_mimetype guessed mimetype: %s.' % self.mimetype)
         return self.mimetype
 
@@ -478,8 +685,34 @@ class Document(object):
         if self.get_fullpath() and not self.file_obj:
             self.file_obj = open(self.get_fullpath(), 'rb')
             self.file_obj.seek(0)
+        if self.stream_stages:
+            self.apply_stream_stages()
         return self.file_obj
 
+    def has_file_obj(self):
+        """Checks document has a file without processing it with pending stream stages"""
+        return bool(self.file_obj or self.get_fullpath())
+
+    def add_stream_stage(self, stage):
+        """Registers core.streams.StreamStage() to process document file in a single pass with other stages"""
+        self.stream_stages.append(stage)
+
+    def apply_stream_stages(self):
+        """Runs pending stream stages replacing document file object with the result"""
+        stages, self.stream_stages = self.stream_stages, []
+        if stages and self.file_obj:
+            self.file_obj = run_stream_stages(self, self.file_obj, stages)
+        else:
+            abort_stream_stages(stages)
+        return self
+
+    def discard_stream_stages(self):
+        """Drops pending stream stages and thumbnail jobs (e.g. a plugin failed and the file will not be stored)"""
+        stages, self.stream_stages = self.stream_stages, []
+        jobs, self.thumbnail_jobs = self.thumbnail_jobs, []
+        abort_stream_stages(stages + jobs)
+        return self
+
     def get_fullpath(self):
         return self.fullpath
 
@@ -692,4 +925,22 @@ class DocTags(models.Model):
         return map(lambda x: x.name, self.tags.all())
 
     def __unicode__(self):
-        return unicode(self.name)
\ No newline at end of file
+        return unicode(self.name)
+
+def invalidate_docrules(sender, **kwargs):
+    """Makes all processes reload document type rules on their change"""
+    update_fields = kwargs.get('update_fields', None)
+    if update_fields and set(update_fields) == set(['sequence_last']):
+        # Barcode sequence does not change anything cached
+        return
+    log.debug('invalidate_docrules on change of %s' % sender)
+    if sender is DocumentTypeRule and (not update_fields or 'sequence_last' in update_fields):
+        # sequence_last might have been edited
+        barcode_allocator.reset()
+    get_cache('core').delete(DocumentTypeRuleManager.cache_key)
+    docrule_resolver_cache.invalidate()
+    docrule_metadata_cache.invalidate()
+
+for model in [DocumentTypeRule, CoreConfiguration]:
+    signals.post_save.connect(invalidate_docrules, sender=model)
+    signals.post_delete.connect(invalidate_docrules, sender=model)
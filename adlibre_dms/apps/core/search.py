@@ -7,10 +7,14 @@ License: See LICENSE for license information
 Author: Iurii Garmash
 """
 
+import os
 import logging
 import datetime
+import threading
 
+from functools import partial
 from operator import itemgetter
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 
@@ -21,12 +25,43 @@ from adlibre.date_converter import str_date_to_couch
 log = logging.getLogger('dms.core.search')
 
 MUI_SEARCH_PAGINATE = getattr(settings, 'MUI_SEARCH_PAGINATE', 20)
+# Concurrent CouchDB view requests of a search (0 requests views one by one)
+SEARCH_WORKERS = getattr(settings, 'DMS_SEARCH_WORKERS', 4)
+# Found documents are checked against the rest of search keys directly if there are not more of them
+SEARCH_CANDIDATES_LIMIT = getattr(settings, 'DMS_SEARCH_CANDIDATES_LIMIT', 1000)
 
 SEARCH_ERROR_MESSAGES = {
     'wrong_date': 'Date range you have provided is wrong. FROM date should not be after TO date.',
     'wrong_indexing_date': 'Indexing Date range wrong. FROM date should not be after TO date.',
 }
 
+_view_pool = None
+_view_pool_pid = None
+_view_pool_lock = threading.Lock()
+
+
+def get_view_pool():
+    """Returns threads pool of this process for CouchDB view requests (created again in forked processes)"""
+    global _view_pool, _view_pool_pid
+    with _view_pool_lock:
+        if _view_pool is None or _view_pool_pid != os.getpid():
+            _view_pool = ThreadPool(SEARCH_WORKERS)
+            _view_pool_pid = os.getpid()
+        return _view_pool
+
+
+def query_view_rows(view_name, params):
+    """Returns rows of a CouchDB view request as is (document ids and view values, not wrapped into documents)"""
+    return list(CouchDocument.get_db().view(view_name, **params))
+
+
+def query_views(view_name, params_list):
+    """Requests a CouchDB view with each of params dicts concurrently. Returns rows lists in the same order."""
+    if SEARCH_WORKERS < 1 or len(params_list) < 2:
+        return [query_view_rows(view_name, params) for params in params_list]
+    return get_view_pool().map(partial(query_view_rows, view_name), params_list)
+
+
 class DMSSearchQuery(object):
     """
     Defined data to be queried from DMS Search Manager class
@@ -228,31 +263,20 @@ class DMSSearchManager(object):
         Converts search results from type ANY to type ALL
 
         (evey key exist in document)
-        For CouchDB documents list provided by search.
+        For CouchDB 'dmscouch/search' view rows provided by search.
+        Views are intersected from the shortest one, each next view is only matched against documents left,
+        and intersection stops as soon as no documents are left.
         """
-        set_list = []
-        all_docs = {}
-        # Extracting documents mentions ang grouping by set
-        for view_set in resp_set[docrule_id]:
-            docs_ids_mentions = []
-            for doc in view_set:
-                docname = doc.get_id
-                # Filtering documents with those keys
-                if doc['metadata_doc_type_rule_id'] == docrule_id:
-                    docs_ids_mentions.append(docname)
-                all_docs[docname] = 0
-            set_list.append(docs_ids_mentions)
-        # Counting docs mentioned in all sets
-        for doc in all_docs:
-            for set_view in set_list:
-                if doc in set_view:
-                    all_docs[doc] += 1
-        # Comparing search mentions and adding to response if all keys match
-        docs_ids_list = []
-        for key, value in all_docs.iteritems():
-            if value >= resp_set[docrule_id].__len__():
-                docs_ids_list.append(key)
-        return docs_ids_list
+        views = sorted(resp_set[docrule_id], key=len)
+        if not views:
+            return []
+        docs_ids = set([doc['id'] for doc in views[0] if doc['value']['metadata_doc_type_rule_id'] == docrule_id])
+        for view_set in views[1:]:
+            if not docs_ids:
+                break
+            # Documents left are of this docrule already
+            docs_ids = set([doc['id'] for doc in view_set if doc['id'] in docs_ids])
+        return list(docs_ids)
 
     def convert_to_search_keys_for_date_range(self, document_keys, pkey, docrule_id, end=False, date_range=False):
         """
@@ -373,37 +397,37 @@ class DMSSearchManager(object):
 
     ##################################### Search Methods ######################################
     def document_date_range_with_keys_search(self, cleaned_document_keys, docrule_ids):
+        """
+        Searches documents matching all secondary keys (and document date range if given) in Document Type Rules.
+
+        Keys are searched in order of their selectivity (see plan_search_keys()).
+        Exact values of keys are requested first, for all docrules at once.
+        Found documents are then checked against the rest of keys with one request of their indexes,
+        unless there are more of them than SEARCH_CANDIDATES_LIMIT. Those are searched by the rest of keys views.
+        Docrules with no documents found are not searched any further.
+        """
         log.debug('Date range search with additional keys specified')
-        resp_set = {}
+        keys = self.plan_search_keys(cleaned_document_keys)
+        # Searching with keys of exact values (or with the narrowest date range only)
+        first_keys = [key for key in keys if not cleaned_document_keys[key].__class__.__name__ == 'tuple'] or keys[:1]
+        other_keys = [key for key in keys if not key in first_keys]
+        resp_set = self.search_keys_views(cleaned_document_keys, first_keys, docrule_ids)
         docs_list = {}
-        # For each docrule user search is requested
         for docrule_id in docrule_ids:
-            # Getting list of date range filtered docs for each provided secondary key
-            # Except for internal keys
-            for key, value in cleaned_document_keys.iteritems():
-                if not (key == 'date') and not (key == 'end_date'):
-                    if not value.__class__.__name__ == 'tuple':
-                        # Normal search
-                        startkey = self.convert_to_search_keys_for_date_range(cleaned_document_keys, key, docrule_id)
-                        endkey = self.convert_to_search_keys_for_date_range(cleaned_document_keys, key, docrule_id, end=True)
-                    else:
-                        # Got date range key
-                        startkey = self.convert_to_search_keys_for_date_range(cleaned_document_keys, key, docrule_id, date_range=True)
-                        endkey = self.convert_to_search_keys_for_date_range(cleaned_document_keys, key, docrule_id, end=True, date_range=True)
-                    if startkey and endkey:
-                        # Appending results list to mixed set of results.
-                        search_res = CouchDocument.view(
-                            'dmscouch/search',
-                            classes={None: CouchDocument},
-                            startkey=startkey,
-                            endkey=endkey
-                        )
-                        if docrule_id in resp_set.iterkeys():
-                            resp_set[docrule_id].append(search_res)
-                        else:
-                            resp_set[docrule_id] = [search_res]
-            # Extracting documents for each CouchDB response set.
             docs_list[docrule_id] = self.convert_search_res_for_range(resp_set, cleaned_document_keys, docrule_id)
+        if other_keys:
+            candidates_cnt = sum([len(d_list) for d_list in docs_list.itervalues()])
+            if candidates_cnt <= SEARCH_CANDIDATES_LIMIT:
+                docs_list = self.filter_candidates_by_keys(docs_list, cleaned_document_keys, other_keys)
+            else:
+                # Too many documents found to check them directly. Searching with the rest of keys views.
+                found_docrule_ids = [docrule_id for docrule_id in docrule_ids if docs_list[docrule_id]]
+                other_set = self.search_keys_views(cleaned_document_keys, other_keys, found_docrule_ids)
+                for docrule_id in found_docrule_ids:
+                    resp_set[docrule_id] += other_set[docrule_id]
+                    docs_list[docrule_id] = self.convert_search_res_for_range(
+                        resp_set, cleaned_document_keys, docrule_id
+                    )
         # Listing all documents to retrieve and getting them
         retrieve_docs = []
         for d_list in docs_list.itervalues():
@@ -412,29 +436,111 @@ class DMSSearchManager(object):
                     retrieve_docs.append(item)
         log.debug(
             'Search results by date range with additional keys: "%s", docrule: "%s", documents: "%s"' %
-            (cleaned_document_keys, docrule_ids, map(lambda doc: doc, retrieve_docs))
+            (cleaned_document_keys, docrule_ids, retrieve_docs.__len__())
         )
         return retrieve_docs
 
+    def plan_search_keys(self, cleaned_document_keys):
+        """
+        Orders secondary search keys from the most selective to the least selective one.
+
+        Keys with exact values are the most selective ones, date ranges of keys follow them from the narrowest one.
+        Internal keys (document date range) are not listed. They restrict every key search request.
+        """
+        def selectivity(key):
+            value = cleaned_document_keys[key]
+            if not value.__class__.__name__ == 'tuple':
+                return 0, key
+            try:
+                start = datetime.datetime.strptime(value[0], settings.DATE_FORMAT)
+                end = datetime.datetime.strptime(value[1], settings.DATE_FORMAT)
+                days = (end - start).days
+            except ValueError:
+                # Unknown range width. Searched the last.
+                days = float('inf')
+            return 1, days, key
+        keys = [key for key in cleaned_document_keys.iterkeys() if not key in ('date', 'end_date')]
+        return sorted(keys, key=selectivity)
+
+    def search_keys_views(self, cleaned_document_keys, keys, docrule_ids):
+        """
+        Requests 'dmscouch/search' view for each of keys in each of docrules concurrently.
+
+        @return: dict of view rows lists for each key (in order of keys) by docrule, e.g.:
+            {docrule_id: [[row, row, ...], [row, ...]], ... }
+        """
+        requests = []
+        for docrule_id in docrule_ids:
+            for key in keys:
+                if not cleaned_document_keys[key].__class__.__name__ == 'tuple':
+                    # Normal search
+                    startkey = self.convert_to_search_keys_for_date_range(cleaned_document_keys, key, docrule_id)
+                    endkey = self.convert_to_search_keys_for_date_range(cleaned_document_keys, key, docrule_id, end=True)
+                else:
+                    # Got date range key
+                    startkey = self.convert_to_search_keys_for_date_range(cleaned_document_keys, key, docrule_id, date_range=True)
+                    endkey = self.convert_to_search_keys_for_date_range(cleaned_document_keys, key, docrule_id, end=True, date_range=True)
+                if startkey and endkey:
+                    requests.append((docrule_id, {'startkey': startkey, 'endkey': endkey}))
+        results = query_views('dmscouch/search', [params for docrule_id, params in requests])
+        resp_set = dict([(docrule_id, []) for docrule_id in docrule_ids])
+        for (docrule_id, params), rows in zip(requests, results):
+            resp_set[docrule_id].append(rows)
+        return resp_set
+
+    def filter_candidates_by_keys(self, docs_list, cleaned_document_keys, keys):
+        """
+        Leaves documents matching all of keys (date ranges of keys) by their indexes.
+
+        Indexes of all documents are requested at once from 'dmscouch/search_main_indexes' view.
+        @param docs_list: found document names by docrule, e.g. {docrule_id: ['ADL-0001', ...], ...}
+        """
+        candidates = []
+        for d_list in docs_list.itervalues():
+            candidates += d_list
+        if not candidates:
+            return docs_list
+        matching = set()
+        for row in query_view_rows('dmscouch/search_main_indexes', {'keys': candidates}):
+            indexes = row['value']['mdt_indexes'] or {}
+            for key in keys:
+                if not self.index_value_matches(indexes.get(key, None), cleaned_document_keys[key]):
+                    break
+            else:
+                matching.add(row['id'])
+        return dict([
+            (docrule_id, [name for name in d_list if name in matching]) for docrule_id, d_list in docs_list.iteritems()
+        ])
+
+    def index_value_matches(self, index_value, search_value):
+        """Checks document index value matches a search value (or a date range, including its finish date)"""
+        if not index_value:
+            return False
+        if not search_value.__class__.__name__ == 'tuple':
+            return index_value == search_value
+        # Date indexes are stored in CouchDB format, so they are compared as strings (like view keys are)
+        start = str_date_to_couch(search_value[0])
+        end = str_date_to_couch(self.alter_end_date(search_value[1]))
+        return start <= index_value < end
+
     def document_date_range_only_search(self, cleaned_document_keys, docrule_ids):
         log.debug('Date range search only')
         resp_list = []
+        found = set()
         startkey = [None,]
         endkey = [None,]
+        requests = []
         for docrule_id in docrule_ids:
             startkey = [docrule_id, str_date_to_couch(cleaned_document_keys["date"])]
             endkey = [docrule_id, str_date_to_couch(cleaned_document_keys["end_date"])]
-            # Getting all documents withing this date range
-            all_docs = CouchDocument.view(
-                'dmscouch/search_date',
-                classes={None: CouchDocument},
-                startkey=startkey,
-                endkey=endkey
-            )
+            requests.append({'startkey': startkey, 'endkey': endkey})
+        # Getting all documents withing this date range (ids only)
+        for all_docs in query_views('dmscouch/search_date', requests):
             # Appending to fetch docs list if not already there
             for doc in all_docs:
-                doc_name = doc.get_id
-                if not doc_name in resp_list:
+                doc_name = doc['id']
+                if not doc_name in found:
+                    found.add(doc_name)
                     resp_list.append(doc_name)
         if resp_list:
             log_data = resp_list.__len__()
@@ -0,0 +1,99 @@
+"""
+Module: DMS Core single pass file processing.
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Plugins that need to read or transform a whole document file (hash, compression) register a StreamStage()
+with Document.add_stream_stage() instead of reading the file themselves.
+Stages are run together over one chunked read of the file, each stage getting the output of the previous one.
+Result is written into a staging file (in DOCUMENT_ROOT by default, so storage can hardlink it into place)
+that becomes the document file object.
+Pending stages are run at the end of a pluginpoint or as soon as the document file object is requested.
+"""
+
+import os
+import logging
+import tempfile
+
+from django.conf import settings
+
+log = logging.getLogger('core.streams')
+
+__all__ = ['StreamStage', 'run_stream_stages', 'abort_stream_stages']
+
+CHUNK_SIZE = getattr(settings, 'DMS_FILE_CHUNK_SIZE', 64 * 1024)
+STAGING_ROOT = getattr(settings, 'DMS_STAGING_ROOT', None) or os.path.join(settings.DOCUMENT_ROOT, '.staging')
+
+
+class StreamStage(object):
+    """Base stage: passes data as is. Observers only look at chunks, transforms return other data."""
+    def process(self, chunk):
+        """Returns data to pass to the next stage for a chunk of a file"""
+        return chunk
+
+    def flush(self):
+        """Returns data left to pass to the next stage at the end of a file"""
+        return ''
+
+    def finish(self, document):
+        """Called after the whole file has passed (e.g. to store results in document)"""
+        pass
+
+    def abort(self):
+        """Called instead of finish() if the file is not processed (e.g. a plugin or another stage failed)"""
+        pass
+
+
+def get_staging_file():
+    """Returns a named temporary file that is removed on close"""
+    if not os.path.isdir(STAGING_ROOT):
+        os.makedirs(STAGING_ROOT)
+    staged = tempfile.NamedTemporaryFile(dir=STAGING_ROOT, prefix='stage_')
+    # Marks file for storage plugins, so they can link it instead of copying
+    staged.staged = True
+    return staged
+
+
+def run_stream_stages(document, file_obj, stages):
+    """Passes file through stages in one chunked read. Returns staging file with the result.
+
+    @param document: DMS Document() instance stages store their results into
+    @param file_obj: file object to read
+    @param stages: list of StreamStage() instances in order of execution"""
+    staged = get_staging_file()
+    try:
+        file_obj.seek(0)
+        chunk = file_obj.read(CHUNK_SIZE)
+        while chunk:
+            for stage in stages:
+                chunk = stage.process(chunk)
+            if chunk:
+                staged.write(chunk)
+            chunk = file_obj.read(CHUNK_SIZE)
+        # Tail of every stage passes through the stages after it
+        for position, stage in enumerate(stages):
+            tail = stage.flush()
+            for next_stage in stages[position + 1:]:
+                tail = next_stage.process(tail)
+            if tail:
+                staged.write(tail)
+        staged.flush()
+        staged.seek(0)
+    except:
+        staged.close()
+        abort_stream_stages(stages)
+        raise
+    for stage in stages:
+        stage.finish(document)
+    return staged
+
+
+def abort_stream_stages(stages):
+    """Lets stages release their resources when the file is not processed"""
+    for stage in stages:
+        try:
+            stage.abort()
+        except Exception, e:
+            log.error('Stream stage %s abort error: %s' % (stage, e))
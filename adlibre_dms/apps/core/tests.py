@@ -17,9 +17,13 @@ Author: Iurii Garmash
 
 import os
 import datetime
+import time
 import zlib
 import hashlib
 import json
+import multiprocessing
+import sqlite3
+import tempfile
 
 from couchdbkit import Server
 
@@ -27,15 +31,28 @@ from django.core.files.uploadedfile import UploadedFile
 from django.contrib.auth.models import User, Group
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.core.files.uploadedfile import UploadedFile
+from django.db import connection
 
-from adlibre.dms.base_test import DMSTestCase
+from adlibre.dms.base_test import DMSTestCase, TemporaryDirectoryTestCase
 
 from document_processor import DocumentProcessor
 from core.models import DocTags
 from core.models import CoreConfiguration
 from core.models import DocumentTypeRule
+from core.models import Document
+from core.models import DocumentTypeRuleManager, DocumentTypeRuleResolver, DocumentBarcodeAllocator
+from core.bulk_import import BulkImporter, ImportJournal
+from core.search import DMSSearchManager
+from core.cache_versions import get_cache_version, bump_cache_version, VERSIONS_TTL as CACHE_VERSIONS_TTL
+from dmscouch.models import CouchDocument
+from dmscouch.batch import couch_write_batch, get_couchdoc, get_or_create_couchdoc, save_couchdoc, delete_couchdoc
+from dms_plugins import pluginpoints
+from dms_plugins.models import DoccodePluginMapping, PluginOption
+from dms_plugins.operator import PluginsOperator, pipeline_cache
+from dms_plugins.workers.validators.hashcode import HashCodeValidationOnRetrievalPlugin
+from dms_plugins.workers.transfer.thumbnails import thumbnail_pool
 
 
 class CoreTestCase(DMSTestCase):
@@ -234,6 +251,8 @@ class CoreTestCase(DMSTestCase):
         @docrule is an instance of document's DocumentTypeRule()
         @check_exists is a task to test if this file exists in file system
         """
+        # Thumbnails are generated in background
+        thumbnail_pool.wait()
         p = self._get_thumbnail_dir(code, docrule)
         thumbnail_check_path = os.path.join(p, code) + '.pdf.png'
         if check_exists:
@@ -967,11 +986,11 @@ class DocumentProcessorTest(CoreTestCase):
         self.processor.update(code, options={'user': self.admin_user, 'new_type': u'8', 'new_indexes': indexes})
         if self.processor.errors:
             raise AssertionError('DocumentProcessor code update errors: %s' % self.processor.errors)
-        # Returning back document for tests consistency
-        self.processor.create(test_file, {'user': self.admin_user, 'barcode': code})
         thumb_path = self._chek_thumbnails_created(code, docrule, check_exists=False)
         if os.path.isfile(thumb_path):
             raise AssertionError('Thumbnail have not been deleted: %s' % thumb_path)
+        # Returning back document for tests consistency
+        self.processor.create(test_file, {'user': self.admin_user, 'barcode': code})
 
     def test_32_upload_first_revision_after_0_revisions_indexing(self):
         """Refs #1211: Indexes Missed at production
@@ -1168,6 +1187,7 @@ class DocumentProcessorTest(CoreTestCase):
         adds revisions to the document by uploading another image after another image.
         check previous image does not equal to the new generated one."""
         code = self.uncategorized_codes[0]  # Should be image (jpeg)
+        thumbnail_pool.wait()
         doc = self.processor.read(code, options={'user': self.admin_user, 'thumbnail': True})
         if self.processor.errors or not doc.thumbnail:
             raise AssertionError('DocumentProcessor errors for reading a thumbnail %s' % self.processor.errors)
@@ -1195,17 +1215,46 @@ class DocumentProcessorTest(CoreTestCase):
         )
         if os.path.isfile(path):
             raise AssertionError('Revision 3 file should be absent')
-        # Check thumbnails absent after update
+        # Check thumbnail of the new file generated after update (on first request without background workers)
         thumb_path = self._chek_thumbnails_created(code, doc.get_docrule(), check_exists=False)
         paths = os.path.split(thumb_path)
         thumb_path = os.path.join(paths[0], code) + '.png'
-        if os.path.isfile(thumb_path):
+        if thumbnail_pool.processes and not os.path.isfile(thumb_path):
+            raise AssertionError('Thumbnail have not been generated after update of a file: %s' % thumb_path)
+        if not thumbnail_pool.processes and os.path.isfile(thumb_path):
             raise AssertionError('Thumbnail have left over after update of a file: %s' % thumb_path)
         doc = self.processor.read(code, options={'user': self.admin_user, 'thumbnail': True})
         if self.processor.errors or not doc.thumbnail:
             raise AssertionError('DocumentProcessor errors for reading a thumbnail %s' % self.processor.errors)
         self.assertNotEqual(doc.thumbnail, thumbnail_1)
 
+    def test_37_indexing_only_create_couchdb_requests(self):
+        """Benchmark: CouchDB requests made by creating a document with indexes only
+
+        Was 4 for a new code (existence check GET, metadata store re-reading document GET,
+        retrieving it again GET, PUT) and more on conflicts. Now metadata is fetched once before write."""
+        code = 'CCC-0003'
+        indexes = {u'Employee': u'benchmark', u'description': u'Requests count'}
+        database = CouchDocument.get_db()
+        requests = []
+        request = database.res.request
+
+        def counting_request(method, *args, **kwargs):
+            requests.append(method)
+            return request(method, *args, **kwargs)
+        database.res.request = counting_request
+        try:
+            self.processor.create(None, {'user': self.admin_user, 'barcode': code, 'index_info': indexes})
+        finally:
+            database.res.request = request
+        if self.processor.errors:
+            raise AssertionError('Can not create document: %s %s' % (code, self.processor.errors))
+        self.assertEqual(requests, ['GET', 'GET', 'PUT'])
+        couchdoc = CouchDocument.get(docid=code)
+        self.assertEqual(couchdoc.mdt_indexes[u'Employee'], u'benchmark')
+        self.assertEqual(couchdoc.metadata_description, u'Requests count')
+        couchdoc.delete()
+
     def test_zz_cleanup(self):
         """Cleaning alll the docs and data that are touched or used in those tests"""
         for code in self.documents_pdf:
@@ -1220,6 +1269,14 @@ class DocumentProcessorTest(CoreTestCase):
             self._remove_file(code)
 
 
+def _allocate_barcodes(count):
+    """Allocates barcodes of 'Adlibre Invoices' docrule from a worker process"""
+    # Not sharing connection inherited from the parent process
+    connection.close()
+    docrule = DocumentTypeRule.objects.get(pk=2)
+    return [docrule.allocate_barcode() for i in range(count)]
+
+
 class DocCodeModelTest(TestCase):
     """DocCode Model Tests"""
     fixtures = ['initial_datas.json', 'djangoplugins.json', 'dms_plugins.json', 'core.json', ]
@@ -1256,3 +1313,307 @@ class DocCodeModelTest(TestCase):
             self.assertEquals(obj.allocate_barcode(), result)
             self.assertEquals(obj.get_last_document_number(), 1001)
 
+    def test_allocate_barcode_from_stale_instance(self):
+        """Barcode is allocated from DB sequence, not from a (cached) instance value"""
+        stale = DocumentTypeRule.objects.get(pk=2)
+        DocumentTypeRule.objects.get(pk=2).set_last_document_number(10)
+        self.assertEquals(stale.allocate_barcode(), 'ADL-0011')
+        self.assertEquals(DocumentTypeRule.objects.get(pk=2).get_last_document_number(), 11)
+
+    def test_barcode_block_reservation(self):
+        """Allocator reserves a block of numbers in DB at once and hands them out from memory"""
+        docrule = DocumentTypeRule.objects.get(pk=2)
+        docrule.set_last_document_number(100)
+        allocator = DocumentBarcodeAllocator(block_size=5)
+        self.assertEquals([allocator.allocate(docrule) for i in range(3)], [101, 102, 103])
+        self.assertEquals(DocumentTypeRule.objects.get(pk=2).get_last_document_number(), 105)
+        self.assertEquals([allocator.allocate(docrule) for i in range(3)], [104, 105, 106])
+        self.assertEquals(DocumentTypeRule.objects.get(pk=2).get_last_document_number(), 110)
+        docrule.set_last_document_number(200)
+        self.assertEquals(allocator.allocate(docrule), 201)
+
+
+class BarcodeAllocationStressTest(TransactionTestCase):
+    """Barcodes allocated from parallel processes are unique"""
+    fixtures = ['initial_datas.json', 'djangoplugins.json', 'dms_plugins.json', 'core.json', ]
+
+    def setUp(self):
+        """Copies test database into a file parallel processes can share (in memory one is per process)"""
+        connection.ensure_connection()
+        handle, self.db_path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        db = sqlite3.connect(self.db_path)
+        db.executescript('\n'.join(connection.connection.iterdump()))
+        db.close()
+        # Closing in memory database would drop it
+        self.memory_db, connection.connection = connection.connection, None
+        self.db_name, connection.settings_dict['NAME'] = connection.settings_dict['NAME'], self.db_path
+
+    def tearDown(self):
+        connection.close()
+        connection.settings_dict['NAME'], connection.connection = self.db_name, self.memory_db
+        os.remove(self.db_path)
+
+    def test_parallel_barcode_allocation(self):
+        processes, per_process = 8, 50
+        DocumentTypeRule.objects.get(pk=2).set_last_document_number(0)
+        # Worker processes must open their own DB connections
+        connection.close()
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_allocate_barcodes, [per_process] * processes)
+        finally:
+            pool.close()
+            pool.join()
+        barcodes = [barcode for result in results for barcode in result]
+        self.assertEquals(len(barcodes), processes * per_process)
+        self.assertEquals(len(set(barcodes)), processes * per_process)
+        self.assertEquals(DocumentTypeRule.objects.get(pk=2).get_last_document_number(), processes * per_process)
+
+    def test_stale_docrule_save_keeps_sequence(self):
+        """Saving a docrule loaded before barcodes were allocated does not roll its sequence back"""
+        DocumentTypeRule.objects.get(pk=2).set_last_document_number(0)
+        stale = DocumentTypeRule.objects.get(pk=2)
+        DocumentTypeRule.objects.get(pk=2).allocate_barcode()
+        stale.save()
+        self.assertEquals(DocumentTypeRule.objects.get(pk=2).get_last_document_number(), 1)
+        stale.set_last_document_number(10)
+        self.assertEquals(DocumentTypeRule.objects.get(pk=2).get_last_document_number(), 10)
+
+
+
+class PluginPipelineCacheTest(TestCase):
+    """Compiled plugin pipelines cache tests"""
+    fixtures = ['initial_datas.json', 'djangoplugins.json', 'dms_plugins.json', 'core.json', ]
+
+    def _get_document(self, docrule_id=2):
+        document = Document()
+        document.docrule = DocumentTypeRule.objects.get(pk=docrule_id)
+        return document
+
+    def test_warm_pipeline_lookup_does_not_query(self):
+        """Second plugins lookup for the same docrule and pluginpoint is served from memory"""
+        document = self._get_document()
+        pluginpoint = pluginpoints.BeforeRetrievalPluginPoint
+        cold = PluginsOperator().get_plugins_for_point(pluginpoint, document)
+        self.assertTrue(cold)
+        pipeline_cache.reset_stats()
+        with self.assertNumQueries(0):
+            warm = PluginsOperator().get_plugins_for_point(pluginpoint, document)
+        self.assertEqual([p.__class__ for p in cold], [p.__class__ for p in warm])
+        self.assertEqual(pipeline_cache.stats['misses'], 0)
+        self.assertEqual(pipeline_cache.stats['hits'], 1)
+
+    def test_pipeline_recompiled_on_mapping_change(self):
+        """Changing plugins of a mapping invalidates compiled pipelines"""
+        document = self._get_document()
+        pluginpoint = pluginpoints.BeforeRetrievalPluginPoint
+        plugins = PluginsOperator().get_plugins_for_point(pluginpoint, document)
+        mapping = DoccodePluginMapping.objects.get(doccode__pk=2)
+        removed = mapping.get_before_retrieval_plugins()[0]
+        mapping.before_retrieval_plugins.remove(removed)
+        changed = PluginsOperator().get_plugins_for_point(pluginpoint, document)
+        self.assertEqual(len(changed), len(plugins) - 1)
+        self.assertNotIn(removed.get_plugin().__class__, [p.__class__ for p in changed])
+
+    def test_configured_plugin_option(self):
+        """Plugin options set for a docrule mapping are returned from memory and reloaded on change"""
+        docrule = DocumentTypeRule.objects.get(pk=2)
+        plugin = HashCodeValidationOnRetrievalPlugin()
+        self.assertEqual(plugin.get_option('method', docrule), 'md5')
+        option = PluginOption.objects.create(
+            plugin=plugin.get_model(),
+            pluginmapping=DoccodePluginMapping.objects.get(doccode__pk=2),
+            name='method',
+            value='sha256'
+        )
+        self.assertEqual(plugin.get_option('method', docrule), 'sha256')
+        with self.assertNumQueries(0):
+            self.assertEqual(plugin.get_option('method', docrule), 'sha256')
+            self.assertEqual(plugin.get_option('policy', docrule), plugin.policy)
+        option.value = 'sha1'
+        option.save()
+        self.assertEqual(plugin.get_option('method', docrule), 'sha1')
+
+    def test_cache_version_bumped_by_another_process(self):
+        """Caches are invalidated in every process by version stamps"""
+        version = get_cache_version('test_cache')
+        process = multiprocessing.Process(target=bump_cache_version, args=('test_cache', ))
+        process.start()
+        process.join()
+        time.sleep(CACHE_VERSIONS_TTL)
+        self.assertNotEqual(get_cache_version('test_cache'), version)
+
+
+class DocumentTypeRuleResolverTest(TestCase):
+    """Compiled docrules resolver tests"""
+    fixtures = ['initial_datas.json', 'djangoplugins.json', 'dms_plugins.json', 'core.json', ]
+
+    def _find_validating(self, code):
+        """Reference implementation: validating every docrule in turn"""
+        manager = DocumentTypeRuleManager()
+        for docrule in DocumentTypeRule.objects.all():
+            if docrule.validate(code):
+                return docrule
+        return manager.get_uncategorized()
+
+    def test_literal_prefix(self):
+        for regex, prefix in [
+            ('ADL-[0-9]{4}', 'ADL-'),
+            ('^TST[0-9]{8}', 'TST'),
+            ('[a-z]{5}[0-9]{3}', ''),
+            ('AB?C', 'A'),
+            ('A\\-B[0-9]', 'A-B'),
+            ('ADL|BBB', ''),
+        ]:
+            self.assertEqual(DocumentTypeRuleResolver.literal_prefix(regex), prefix)
+
+    def test_find_for_string_same_as_validation(self):
+        manager = DocumentTypeRuleManager()
+        for code in ['ADL-0001', 'UNC-0001', 'abcde222', '2011-01-01-1', '123456', '1111-2222-3333-4444',
+                     'BBB-0001', 'CCC-0001', 'TST12345678', 'ADL-12345', 'unknown']:
+            self.assertEqual(manager.find_for_string(code), self._find_validating(code))
+
+    def test_resolver_rebuilt_on_docrule_save(self):
+        manager = DocumentTypeRuleManager()
+        self.assertNotEqual(manager.find_for_string('DDD-0001').pk, 8)
+        docrule = DocumentTypeRule.objects.get(pk=8)
+        docrule.regex = 'DDD-[0-9]{4}'
+        docrule.save()
+        self.assertEqual(DocumentTypeRuleManager().find_for_string('DDD-0001').pk, 8)
+
+    def test_docrule_metadata_memoized(self):
+        """Uncategorized flag and plugin mapping of a docrule are read from DB once"""
+        docrule = DocumentTypeRule.objects.get(pk=2)
+        uncategorized = DocumentTypeRule.objects.get(pk=10)
+        mapping = docrule.get_docrule_plugin_mappings()
+        self.assertFalse(docrule.uncategorized)
+        self.assertTrue(uncategorized.uncategorized)
+        with self.assertNumQueries(0):
+            self.assertEqual(docrule.get_docrule_plugin_mappings(), mapping)
+            self.assertFalse(docrule.uncategorized)
+            self.assertTrue(uncategorized.uncategorized)
+        config = CoreConfiguration.objects.get(pk=1)
+        config.uncategorized = docrule
+        config.save()
+        self.assertTrue(docrule.uncategorized)
+        self.assertFalse(uncategorized.uncategorized)
+
+
+class BulkImportTest(TemporaryDirectoryTestCase):
+    """Bulk importer planning and journal tests (no documents are stored)"""
+    fixtures = ['initial_datas.json', 'djangoplugins.json', 'dms_plugins.json', 'core.json', ]
+
+    def setUp(self):
+        super(BulkImportTest, self).setUp()
+        self.paths = [
+            self._file(name, name) for name in ['ADL-0001.pdf', 'ADL-0002.pdf', 'BBB-0001.pdf', 'ADL-0003.pdf']
+        ]
+
+    def test_batches_grouped_by_docrule(self):
+        importer = BulkImporter(batch_size=2, dry_run=True)
+        batches = importer.make_batches(importer.collect_files([self.root]))
+        names = [[os.path.basename(path) for path in batch] for batch in batches]
+        self.assertEqual(names, [['ADL-0001.pdf', 'ADL-0002.pdf'], ['ADL-0003.pdf'], ['BBB-0001.pdf']])
+        self.assertEqual(importer.docrule_counts, {'Adlibre Invoices': 3, 'Test Doc Type 2': 1})
+
+    def test_journal_resume(self):
+        journal_path = os.path.join(self.root, 'import.journal')
+        path = self.paths[0]
+        stat = os.stat(path)
+        journal = ImportJournal(journal_path)
+        journal.add(path, stat.st_size, int(stat.st_mtime), 'wrong hash')
+        resumed = ImportJournal(journal_path)
+        self.assertTrue(resumed.is_imported(path))
+        self.assertFalse(resumed.is_imported(self.paths[1]))
+        # Same size, touched file with other content is imported again
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        self.assertFalse(resumed.is_imported(path))
+
+
+class CouchWriteBatchTest(TestCase):
+    """CouchDB write behind batches tests"""
+    def _couchdoc(self, docid, description):
+        couchdoc = CouchDocument(metadata_description=description)
+        couchdoc._doc['_id'] = docid
+        return couchdoc
+
+    def test_batch_writes_on_exit(self):
+        codes = ['BATCH-0001', 'BATCH-0002']
+        existing = self._couchdoc(codes[0], 'old')
+        existing.save()
+        with couch_write_batch() as batch:
+            for code in codes:
+                save_couchdoc(self._couchdoc(code, 'new'), force_update=True)
+            # Pending writes are visible through the batch, but not in CouchDB yet
+            self.assertEqual(get_couchdoc(codes[1]).metadata_description, 'new')
+            self.assertEqual(CouchDocument.get(docid=codes[0]).metadata_description, 'old')
+        self.assertEqual(batch.conflicts, {})
+        for code in codes:
+            self.assertEqual(CouchDocument.get(docid=code).metadata_description, 'new')
+        with couch_write_batch() as batch:
+            for code in codes:
+                delete_couchdoc(get_couchdoc(code))
+        self.assertEqual(batch.written, 2)
+        for code in codes:
+            self.assertRaises(Exception, CouchDocument.get, docid=code)
+
+    def test_document_created_again_after_pending_deletion(self):
+        code = 'BATCH-0003'
+        self._couchdoc(code, 'old').save()
+        with couch_write_batch() as batch:
+            delete_couchdoc(get_couchdoc(code))
+            couchdoc = get_or_create_couchdoc(code)
+            # Fields of deleted document are not carried over
+            self.assertEqual(couchdoc.metadata_description, '')
+            couchdoc.metadata_description = 'new'
+            save_couchdoc(couchdoc)
+        self.assertEqual(batch.conflicts, {})
+        self.assertEqual(CouchDocument.get(docid=code).metadata_description, 'new')
+        CouchDocument.get(docid=code).delete()
+
+
+class SearchPlannerTest(TestCase):
+    """MDT search keys planning and results intersection tests"""
+    def test_keys_ordered_by_selectivity(self):
+        keys = {
+            u'date': u'01/01/2012',
+            u'end_date': u'01/01/2100',
+            u'Report Date': (u'01/01/2012', u'31/12/2012'),
+            u'Reporting Entity': u'JTG',
+            u'Invoice Date': (u'01/10/2012', u'16/10/2012'),
+        }
+        self.assertEqual(
+            DMSSearchManager().plan_search_keys(keys),
+            [u'Reporting Entity', u'Invoice Date', u'Report Date']
+        )
+
+    def test_index_value_matches(self):
+        manager = DMSSearchManager()
+        self.assertTrue(manager.index_value_matches(u'JTG', u'JTG'))
+        self.assertFalse(manager.index_value_matches(u'', u'JTG'))
+        date_range = (u'01/10/2012', u'16/10/2012')
+        self.assertTrue(manager.index_value_matches(u'2012-10-16T00:00:00Z', date_range))
+        self.assertFalse(manager.index_value_matches(u'2012-10-17T00:00:00Z', date_range))
+        self.assertFalse(manager.index_value_matches(u'2012-09-30T00:00:00Z', date_range))
+
+    def test_intersection_of_large_views(self):
+        """All keys match documents of 100k rows views in reasonable time"""
+        rows = 100000
+
+        def view(step, prefix='ADL'):
+            return [
+                {'id': '%s-%07d' % (prefix, i), 'value': {'metadata_doc_type_rule_id': '1'}}
+                for i in range(0, rows * step, step)
+            ]
+        resp_set = {'1': [view(1), view(2), view(3)]}
+        start = time.time()
+        found = DMSSearchManager().convert_search_res_for_range(resp_set, {}, '1')
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(sorted(found), ['ADL-%07d' % i for i in range(0, rows, 6)])
+        # Documents of other docrules do not match
+        resp_set['2'] = resp_set['1']
+        self.assertEqual(DMSSearchManager().convert_search_res_for_range(resp_set, {}, '2'), [])
+        # No document matches all keys
+        resp_set['1'].append(view(1, prefix='CCC'))
+        self.assertEqual(DMSSearchManager().convert_search_res_for_range(resp_set, {}, '1'), [])
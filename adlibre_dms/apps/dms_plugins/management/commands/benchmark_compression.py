@@ -0,0 +1,111 @@
+"""
+Module: Compression codecs benchmark management script for Adlibre DMS
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Description:
+
+ - compresses sample documents with every available codec and level to choose compression plugins options
+ - reports compression ratio, compression and decompression throughput and files that sampling would store as is
+
+usage:
+    $ python manage.py benchmark_compression /path/to/sample/documents --levels=1,6,9
+    Codec  Level    Ratio  Compress MB/s  Decompress MB/s  Stored raw
+    BZ2        1    0.412           11.2             35.0    41 of 120
+    ...
+"""
+
+import os
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dms_plugins.workers.transfer.compression import get_codec, get_codec_names
+from dms_plugins.workers.transfer.gzip import Gzip
+
+
+class Command(BaseCommand):
+    """Benchmarks compression codecs on document files from given files and directories"""
+    args = 'path path ...'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--codecs',
+            default=None,
+            help='Comma separated codec names (all available codecs by default)'),
+        make_option(
+            '--levels',
+            default='1,6,9',
+            help='Comma separated compression levels (1-9)'),
+        make_option(
+            '--limit',
+            default=1000,
+            type='int',
+            help='Maximum number of files to benchmark'),
+    )
+    help = "Compares compression ratio and speed of available codecs on sample document files."
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Provide files or directories with sample (uncompressed) documents')
+        codecs = options['codecs'].split(',') if options['codecs'] else get_codec_names()
+        try:
+            codecs = [get_codec(name.strip().upper()) for name in codecs]
+            levels = [int(level) for level in options['levels'].split(',')]
+        except (KeyError, ValueError), e:
+            raise CommandError('Wrong codecs or levels: %s (available codecs: %s)' % (e, ', '.join(get_codec_names())))
+        paths = self.collect_files(args, options['limit'])
+        if not paths:
+            raise CommandError('No files found')
+        self.stdout.write('%-6s %5s %8s %14s %16s %11s\n' % (
+            'Codec', 'Level', 'Ratio', 'Compress MB/s', 'Decompress MB/s', 'Stored raw'
+        ))
+        for codec in codecs:
+            for level in levels:
+                ratio, compress_speed, decompress_speed, raw = self.benchmark(codec, level, paths)
+                self.stdout.write('%-6s %5s %8.3f %14.1f %16.1f %11s\n' % (
+                    codec.name, level, ratio, compress_speed, decompress_speed, '%s of %s' % (raw, len(paths))
+                ))
+
+    def collect_files(self, args, limit):
+        paths = []
+        for arg in args:
+            if os.path.isfile(arg):
+                paths.append(arg)
+            for root, directories, files in os.walk(arg):
+                # Skipping DMS service directories (blobs, staging, journals)
+                directories[:] = [d for d in directories if not d.startswith('.')]
+                paths.extend(os.path.join(root, name) for name in files if not name.endswith('.json'))
+        return paths[:limit]
+
+    def benchmark(self, codec, level, paths):
+        """Returns compression ratio, compression and decompression throughput (MB/s) and files sampling skips"""
+        worker = Gzip(codec.name, level)
+        total = compressed_total = raw = 0
+        compress_time = decompress_time = 0.0
+        for path in paths:
+            file_obj = open(path, 'rb')
+            try:
+                if not worker.is_compressible(file_obj):
+                    raw += 1
+                data = file_obj.read()
+            finally:
+                file_obj.close()
+            start = time.time()
+            compressed = codec.compress(data, level)
+            compress_time += time.time() - start
+            start = time.time()
+            codec.decompress(compressed)
+            decompress_time += time.time() - start
+            total += len(data)
+            compressed_total += len(compressed)
+        megabytes = total / (1024.0 * 1024.0)
+        return (
+            float(compressed_total) / (total or 1),
+            megabytes / (compress_time or 1e-9),
+            megabytes / (decompress_time or 1e-9),
+            raw
+        )
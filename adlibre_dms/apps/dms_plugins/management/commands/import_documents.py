@@ -4,61 +4,77 @@ Module: Document import management script for Adlibre DMS
 Project: Adlibre DMS
 Copyright: Adlibre Pty Ltd 2013
 License: See LICENSE for license information
+
+usage:
+    $ python manage.py import_documents --workers=4 --journal=/tmp/import.journal /path/to/archive
 """
 
-import os
-import traceback
+from optparse import make_option
 
 from django.core.management.base import BaseCommand
-from django.contrib.auth.models import User
 
-from core.document_processor import DocumentProcessor
+from core.bulk_import import BulkImporter
 
 
 class Command(BaseCommand):
     """Imports the documents from specified directories"""
     args = 'directory_name directory_name ...'
 
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--workers', '-w',
+            default=1,
+            type='int',
+            help='Number of worker processes importing files. (Default: 1)'),
+        make_option(
+            '--batch-size',
+            dest='batch_size',
+            default=50,
+            type='int',
+            help='Number of files of one document type rule given to a worker at once. (Default: 50)'),
+        make_option(
+            '--journal', '-j',
+            default=None,
+            help='Journal file of imported files. Files already in it are skipped, so import can be resumed.'),
+        make_option(
+            '--dry-run',
+            dest='dry_run',
+            default=False,
+            action='store_true',
+            help='Only resolve document type rules for files without importing them.'),
+        make_option(
+            '--silent', '-s',
+            default=False,
+            action='store_true',
+            help='Hide progress output.'),
+    )
+
     def handle(self, *args, **options):
         """Main method processor
 
         @param args: directory_name directory_name ...
         @param options:
         """
-
-        silent = 'silent' in options.keys() and options['silent']
+        silent = options.get('silent', False)
         if len(args) == 0:
             self.stdout.write('No arguments specified\n')
             return
 
-        for directory in args:
-            if not os.path.exists(directory):
-                self.stderr.write('Could not import %s: no such directory\n' % directory)
-                continue
-            cnt = 0
-            admin = User.objects.filter(is_superuser=True)[0]
-            for root, dirs, files in os.walk(directory):
-                if '.svn' in dirs:
-                    dirs.remove('.svn')  # don't visit svn directories
-                for filename in files:
-                    if not silent:
-                        self.stdout.write('Importing file: "%s"\n' % filename)
-                    file_obj = open(os.path.join(root, filename))
-                    file_obj.seek(0)
-                    processor = DocumentProcessor()
-                    try:
-                        processor.create(file_obj, {'user': admin})
-                    except Exception, e:
-                        self.stderr.write(str(e))
-                        self.stderr.write(traceback.format_exc() + "\n")
-                    else:
-                        if processor.errors:
-                            self.stderr.write('\nImport error: %s\n' % processor.errors)
-                        else:
-                            cnt += 1
-                    file_obj.close()
-            if not silent:
-                if cnt:
-                    self.stdout.write('Successfully imported %s documents from directory "%s"\n' % (cnt, directory))
-                else:
-                    self.stdout.write('No documents were imported\n')
+        importer = BulkImporter(
+            workers=options.get('workers', 1),
+            batch_size=options.get('batch_size', 50),
+            journal=options.get('journal', None),
+            dry_run=options.get('dry_run', False),
+            stdout=None if silent else self.stdout,
+            stderr=self.stderr,
+        )
+        cnt = importer.run(args)
+        if not silent and not importer.dry_run:
+            if cnt:
+                self.stdout.write('Successfully imported %s documents from "%s"\n' % (cnt, ', '.join(args)))
+            else:
+                self.stdout.write('No documents were imported\n')
+            if importer.skipped:
+                self.stdout.write('Skipped %s documents imported before\n' % importer.skipped)
+            if importer.failed:
+                self.stdout.write('Failed to import %s documents\n' % len(importer.failed))
@@ -0,0 +1,48 @@
+"""
+Module: Rebuild documents manifest management script for Adlibre DMS
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Description:
+
+ - rebuilds per document type rule index of stored documents (used for documents listing) from file revision data
+
+usage:
+    $ python manage.py rebuild_index 2 3
+    Document Type Rule "Adlibre Invoices": indexed 120 documents
+    ...
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from core.models import DocumentTypeRule
+from dms_plugins.workers.storage.metadata.local_json import LocalJSONMetadata
+
+
+class Command(BaseCommand):
+    """Rebuilds documents manifests of given document type rules (all of them by default)"""
+    args = 'docrule_id docrule_id ...'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--quiet', '-q',
+            default=False,
+            action='store_true',
+            help='Hide all command output'),
+    )
+    help = "Rebuilds documents listing index of document type rules from stored file revision data."
+
+    def handle(self, *args, **options):
+        quiet = options.get('quiet', False)
+        docrules = DocumentTypeRule.objects.all()
+        if args:
+            docrules = docrules.filter(pk__in=[int(arg) for arg in args])
+        worker = LocalJSONMetadata()
+        for docrule in docrules:
+            count = worker.rebuild_index(docrule)
+            if not quiet:
+                self.stdout.write('Document Type Rule "%s": indexed %s documents\n' % (docrule.get_title(), count))
@@ -0,0 +1,43 @@
+"""
+Module: Recover interrupted document moves management script for Adlibre DMS
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Description:
+
+ - finishes moves of revision files (e.g. docrule changes) interrupted by a crash, reading their journals
+ - drops journaled moves of documents which file revision data was not migrated to the new location yet
+
+usage:
+    $ python manage.py recover_moves
+    Finished moving files of ADL-0001
+    ...
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from dms_plugins.workers.storage.local import FileMoveJournal
+
+
+class Command(BaseCommand):
+    """Finishes unfinished revision file moves of Local Storage"""
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--quiet', '-q',
+            default=False,
+            action='store_true',
+            help='Hide all command output'),
+    )
+    help = "Finishes moves of document revision files interrupted by a crash."
+
+    def handle(self, *args, **options):
+        quiet = options.get('quiet', False)
+        recovered = FileMoveJournal.recover()
+        if not quiet:
+            for name in recovered:
+                self.stdout.write('Finished moving files of %s\n' % name)
+            self.stdout.write('%s unfinished moves found\n' % len(recovered))
@@ -0,0 +1,106 @@
+"""
+Module: Verify stored files integrity management script for Adlibre DMS
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Description:
+
+ - hashes all stored revision files of document type rules (all of them by default) in chunks
+ - reports revisions that do not match their stored hash codes (or are missing) at the end
+ - stamps verified files, so retrieval with 'changed' or 'scheduled' verification policy does not hash them again
+ - removes stamps of files that do not exist anymore
+
+usage:
+    $ python manage.py verify_integrity 2 3
+    Document Type Rule "Adlibre Invoices": verified 120 revisions, 1 corrupted
+    ...
+    Corrupted revisions:
+    ADL-0012 revision 2: /opt/dms/documents/2/0000/0012/ADL-0012_r2.pdf (hash code did not validate)
+"""
+
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import DocumentTypeRule
+from dms_plugins.workers.storage.blobs import blob_store
+from dms_plugins.workers.storage.metadata.local_json import LocalJSONMetadata
+from dms_plugins.workers.transfer.compression import get_codec
+from dms_plugins.workers.transfer.gzip import DecompressingFile
+from dms_plugins.workers.validators.hashcode import HashCodeValidationOnRetrievalPlugin, HashCodeWorker, \
+    integrity_stamps
+
+
+class Command(BaseCommand):
+    """Verifies stored files of given document type rules against their hash codes"""
+    args = 'docrule_id docrule_id ...'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--quiet', '-q',
+            default=False,
+            action='store_true',
+            help='Show corrupted revisions only'),
+    )
+    help = "Verifies stored document files against their hash codes and reports corrupted revisions."
+
+    def handle(self, *args, **options):
+        quiet = options.get('quiet', False)
+        docrules = DocumentTypeRule.objects.all()
+        if args:
+            docrules = docrules.filter(pk__in=[int(arg) for arg in args])
+        metadata = LocalJSONMetadata()
+        plugin = HashCodeValidationOnRetrievalPlugin()
+        worker = HashCodeWorker(plugin.method)
+        corrupted = []
+        for docrule in docrules:
+            method = plugin.get_option('method', docrule)
+            verified = 0
+            found = len(corrupted)
+            for name, directory, revisions, created_day, created_epoch in metadata.walk_metadata(docrule):
+                for revision, data in sorted(revisions.iteritems()):
+                    if not data.get('hashcode', None):
+                        continue
+                    path, error = self.verify(worker, method, directory, data)
+                    verified += 1
+                    if error:
+                        corrupted.append((name, revision, path, error))
+            if not quiet:
+                self.stdout.write('Document Type Rule "%s": verified %s revisions, %s corrupted\n' % (
+                    docrule.get_title(), verified, len(corrupted) - found
+                ))
+        pruned = integrity_stamps.prune()
+        if not quiet:
+            self.stdout.write('Removed %s stamps of files that do not exist\n' % pruned)
+        if corrupted:
+            self.stdout.write('Corrupted revisions:\n')
+            for name, revision, path, error in corrupted:
+                self.stdout.write('%s revision %s: %s (%s)\n' % (name, revision, path, error))
+            raise CommandError('%s corrupted revisions found' % len(corrupted))
+
+    def verify(self, worker, method, directory, data):
+        """Returns stored file path and error (None for a valid file) of a revision"""
+        if 'blob' in data:
+            path = blob_store.path(data['blob'])
+        else:
+            path = os.path.join(directory, data['name'])
+        if not os.path.exists(path):
+            return path, 'file is missing'
+        file_obj = open(path, 'rb')
+        try:
+            if data.get('compression_type', None):
+                file_obj = DecompressingFile(file_obj, get_codec(data['compression_type']))
+            hashcode = worker.get_file_hash(file_obj, data.get('hashcode_method', method))
+        except Exception, e:
+            # IOError, unknown codec, zlib.error of a damaged compressed file, etc.
+            return path, 'file is not readable: %s' % e
+        finally:
+            file_obj.close()
+        if hashcode != data['hashcode']:
+            integrity_stamps.forget(path)
+            return path, 'hash code did not validate'
+        integrity_stamps.stamp(path, data['hashcode'])
+        return path, None
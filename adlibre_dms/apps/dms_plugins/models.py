@@ -7,16 +7,24 @@ License: See LICENSE for license information
 """
 
 from django.db import models
+from django.db.models import signals
 import logging
 
 from djangoplugins.fields import ManyPluginField
 from djangoplugins.models import Plugin
 
 from dms_plugins import pluginpoints
-from core.models import DocumentTypeRule
+from core.models import DocumentTypeRule, docrule_metadata_cache
+from core.cache_versions import bump_cache_version, ProcessCache
 
 log = logging.getLogger('dms_plugins.models')
 
+# Name of a per process cache of compiled plugin pipelines (see dms_plugins.operator)
+PIPELINE_CACHE_NAME = 'dms_plugins_pipelines'
+
+# Configured plugin options of active docrule mappings by docrule pk, dropped on plugin configuration change
+plugin_options_cache = ProcessCache('dms_plugins_options')
+
 
 class DoccodePluginMapping(models.Model):
     """A Relational storage for handling DocumentType <=> Plugins relations"""
@@ -148,3 +156,32 @@ class PluginOption(models.Model):
 
     def __unicode__(self):
         return "%s: %s" % (self.name, self.value)
+
+
+def get_plugin_options(docrule_id):
+    """Returns {(plugin name, option name): value} of options set for docrule's active mapping
+
+    Loaded with one query and memoized per process until plugin configuration changes."""
+    return plugin_options_cache.get_or_build(docrule_id, load_plugin_options, docrule_id)
+
+
+def load_plugin_options(docrule_id):
+    rows = PluginOption.objects.filter(
+        pluginmapping__doccode__pk=docrule_id,
+        pluginmapping__active=True
+    ).values_list('plugin__name', 'name', 'value')
+    return dict(((plugin_name, name), value) for plugin_name, name, value in rows if value != '')
+
+
+def invalidate_plugin_pipelines(sender, **kwargs):
+    """Makes all the processes recompile their plugin pipelines and docrule mappings on plugin configuration change"""
+    log.debug('invalidate_plugin_pipelines on change of %s' % sender)
+    bump_cache_version(PIPELINE_CACHE_NAME)
+    docrule_metadata_cache.invalidate()
+    plugin_options_cache.invalidate()
+
+for model in [DoccodePluginMapping, PluginOption, Plugin]:
+    signals.post_save.connect(invalidate_plugin_pipelines, sender=model)
+    signals.post_delete.connect(invalidate_plugin_pipelines, sender=model)
+for field in DoccodePluginMapping._meta.many_to_many:
+    signals.m2m_changed.connect(invalidate_plugin_pipelines, sender=field.rel.through)
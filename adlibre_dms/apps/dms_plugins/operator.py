@@ -13,17 +13,22 @@ import djangoplugins
 from django.conf import settings
 
 from core.errors import ConfigurationError
-from models import DoccodePluginMapping
+from models import DoccodePluginMapping, PIPELINE_CACHE_NAME
 from core.errors import DmsException
 from workers import PluginError, PluginWarning, BreakPluginChain
 from workers.info.tags import TagsPlugin
 from dms_plugins import pluginpoints
 from core.models import DocumentTypeRule
+from core.cache_versions import ProcessCache
 
 log = logging.getLogger('dms')
 
 # PEP method to fix out redundant imports.
-__all__ = ['PluginsOperator']
+__all__ = ['PluginsOperator', 'pipeline_cache']
+
+# Compiled plugin pipelines: Plugin() instances for (mapping pk, pluginpoint).
+# Dropped in all processes on plugin configuration changes (see dms_plugins.models signals).
+pipeline_cache = ProcessCache(PIPELINE_CACHE_NAME)
 
 
 class PluginsOperator(object):
@@ -38,6 +43,8 @@ class PluginsOperator(object):
     def __init__(self):
         self.plugin_errors = []
         self.plugin_warnings = []
+        # Cursor of the next page of last get_file_list() call
+        self.next_cursor = None
 
     def process_pluginpoint(self, pluginpoint, document=None):
         """
@@ -50,6 +57,24 @@ class PluginsOperator(object):
         """
         plugins = self.get_plugins_for_point(pluginpoint, document)
         #log.debug('process_pluginpoint: %s with %s plugins.' % (pluginpoint, plugins))
+        document = self.process_plugins(plugins, document)
+        if self.plugin_errors and hasattr(document, 'discard_stream_stages'):
+            # Also drops thumbnail jobs of a file copied before storage plugins failed
+            document.discard_stream_stages()
+        elif getattr(document, 'stream_stages', None):
+            # File processing plugins registered in this pluginpoint read the file together
+            try:
+                document.apply_stream_stages()
+            except (IOError, OSError), e:
+                self.plugin_errors.append(PluginError('File processing error: %s' % e, 500))
+        return document
+
+    def process_plugins(self, plugins, document):
+        """Executes given Plugin() objects against a document
+
+        @param plugins: list of Plugin() instances, in order of execution
+        @param document: DMS Document() instance
+        """
         for plugin in plugins:
             try:
                 #log.debug('process_pluginpoint begin processing: %s.' % plugin)
@@ -66,18 +91,57 @@ class PluginsOperator(object):
                 break
         return document
 
+    def prefetch_for_plugins(self, plugins, documents):
+        """Lets plugins load data for many documents at once before processing them one by one.
+
+        Plugin() may define a prefetch(documents) method for that. e.g. to load DB data in one request.
+
+        @param plugins: list of Plugin() instances
+        @param documents: list of DMS Document() instances of one docrule
+        """
+        for plugin in plugins:
+            if hasattr(plugin, 'prefetch'):
+                plugin.prefetch(documents)
+        return documents
+
+    def prepare_update_for_plugins(self, plugins, document, old_document):
+        """Lets plugins prepare for an update before any update plugin runs.
+
+        Plugin() may define a prepare_update(document, old_document) method for that.
+        e.g. to journal file moves before file revision data is migrated to a new docrule.
+
+        @param plugins: list of Plugin() instances
+        @param document: DMS Document() instance being updated
+        @param old_document: DMS Document() instance read before the update
+        """
+        for plugin in plugins:
+            if hasattr(plugin, 'prepare_update'):
+                plugin.prepare_update(document, old_document)
+        return document
+
     def get_plugins_from_mapping(self, mapping, pluginpoint, plugin_type):
         """Extracts and instantiates Plugin() objects from given plugin mapping.
 
+        Plugin() instances are stateless and compiled once per process for a mapping and pluginpoint.
+
         @param mapping: DocumentTYpeRulePluginMapping() instance"""
-        plugin_objects = getattr(mapping, 'get_' + pluginpoint.settings_field_name)()
-        plugins = map(lambda plugin_obj: plugin_obj.get_plugin(), plugin_objects)
+        plugins = list(pipeline_cache.get_or_build(
+            (mapping.pk, pluginpoint.settings_field_name),
+            self.compile_pipeline,
+            mapping,
+            pluginpoint
+        ))
         if plugin_type:
             plugins = filter(
                 lambda plugin: hasattr(plugin, 'plugin_type') and plugin.plugin_type == plugin_type, plugins
             )
         return plugins
 
+    def compile_pipeline(self, mapping, pluginpoint):
+        """Instantiates Plugin() objects of a pluginpoint for given mapping in order of execution."""
+        plugin_objects = getattr(mapping, 'get_' + pluginpoint.settings_field_name)()
+        return tuple(map(lambda plugin_obj: plugin_obj.get_plugin(), plugin_objects))
+
     def get_plugin_list(self):
         """Gets a list of all installed into DMS plugins."""
         all_plugins = djangoplugins.models.Plugin.objects.all().order_by('point__title', 'index')
@@ -108,9 +172,12 @@ class PluginsOperator(object):
     # e.g. DocumentProcessor().read(document, option='revision_count')
 
     def get_file_list(self, doccode_plugin_mapping, start=0, finish=None, order=None, searchword=None,
-                      tags=None, filter_date=None):
+                      tags=None, filter_date=None, cursor=None):
         """This must be a part of some retrieve workflow
-        e.g. DocumentProcessor().read(document, option='get_file_list')"""
+        e.g. DocumentProcessor().read(document, option='get_file_list')
+
+        Metadata plugins that provide get_documents_page() sort and paginate the list themselves.
+        Cursor of the following page is set into self.next_cursor then (None for the last page)."""
         # TODO: refactor this to a retrieval workflow with certain option.
         # Proper tags init according to PEP
         if not tags:
@@ -132,6 +199,19 @@ class PluginsOperator(object):
         docrule = doccode_plugin_mapping.get_docrule()
         doc_models = TagsPlugin().get_doc_models(docrule=doccode_plugin_mapping.get_docrule(), tags=tags)
         doc_names = map(lambda x: x.name, doc_models)
+        self.next_cursor = None
+        if metadata and hasattr(metadata.worker, 'get_documents_page'):
+            names, self.next_cursor = metadata.worker.get_documents_page(
+                docrule,
+                start=start,
+                finish=finish,
+                order=order,
+                searchword=searchword,
+                limit_to=doc_names,
+                filter_date=filter_date,
+                cursor=cursor,
+            )
+            return [{'name': name} for name in names]
         if metadata:
             document_directories = metadata.worker.get_directories(docrule, filter_date=filter_date)
         else:
@@ -0,0 +1,213 @@
+"""
+Module: DMS Plugins tests
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2013
+License: See LICENSE for license information
+"""
+
+import os
+import time
+import zlib
+import hashlib
+from StringIO import StringIO
+
+from django.test import TestCase
+
+from adlibre.dms.base_test import TemporaryDirectoryTestCase
+
+from core.models import Document
+from dms_plugins.workers.storage.fs_cache import FilesystemCache
+from dms_plugins.workers.storage.blobs import BlobStore
+from dms_plugins.workers.storage.local import LocalFilesystemManager, FileMoveJournal
+from dms_plugins.workers.validators.hashcode import HashCodeWorker, HashStreamStage, IntegrityStamps
+from dms_plugins.workers.transfer.gzip import CompressStage, DecompressingFile, Gzip
+from dms_plugins.workers.transfer.compression import get_codec
+from dms_plugins.workers.transfer.previews import PreviewCache, get_preview_size
+
+
+class FilesystemCacheTest(TemporaryDirectoryTestCase):
+    """Local Storage directory listing and file content cache tests"""
+    def setUp(self):
+        super(FilesystemCacheTest, self).setUp()
+        self.path = self._file('ADL-0001.json', '{"1": {}}', mtime=1000)
+
+    def test_cached_reads_are_revalidated_by_mtime(self):
+        cache = FilesystemCache(ttl=60)
+        self.assertEqual(cache.read(self.path), '{"1": {}}')
+        self.assertTrue(cache.exists(self.path))
+        self.assertEqual(cache.read(self.path), '{"1": {}}')
+        self.assertEqual(cache.stats['loads'], 2)  # File and directory listing
+        self._file('ADL-0001.json', '{"1": {}, "2": {}}', mtime=2000)
+        # Trusted within TTL, checked by mtime otherwise
+        self.assertEqual(cache.read(self.path), '{"1": {}}')
+        self.assertEqual(cache.read(self.path, max_age=0), '{"1": {}, "2": {}}')
+        cache.read(self.path, max_age=0)
+        self.assertEqual(cache.stats['revalidations'], 1)
+        # Missing files are always checked against current listing
+        other = os.path.join(self.root, 'ADL-0002.json')
+        self.assertFalse(cache.exists(other))
+        self._file('ADL-0002.json')
+        self.assertTrue(cache.exists(other))
+        os.remove(self.path)
+        cache.invalidate(self.path)
+        self.assertEqual(cache.read(self.path), None)
+        self.assertFalse(cache.exists(self.path))
+
+
+class BlobStoreTest(TemporaryDirectoryTestCase):
+    """Content addressed storage reference counting tests"""
+    def test_identical_content_is_stored_once(self):
+        store = BlobStore(self.root)
+        digest = store.put(StringIO('scanned page'))
+        self.assertEqual(store.put(StringIO('scanned page')), digest)
+        self.assertNotEqual(store.put(StringIO('other page')), digest)
+        self.assertEqual(store.refcount(digest), 2)
+        self.assertEqual(open(store.path(digest), 'rb').read(), 'scanned page')
+        store.release(digest)
+        self.assertTrue(os.path.exists(store.path(digest)))
+        store.release(digest)
+        self.assertEqual(store.refcount(digest), 0)
+        self.assertFalse(os.path.exists(store.path(digest)))
+
+
+class IntegrityStampsTest(TemporaryDirectoryTestCase):
+    """Hash verification policy tests"""
+    def setUp(self):
+        super(IntegrityStampsTest, self).setUp()
+        self.stamps = IntegrityStamps(os.path.join(self.root, 'verified.sqlite3'))
+        self.path = self._file('ADL-0001_r1.pdf', 'scanned page')
+
+    def test_file_hash_in_chunks(self):
+        worker = HashCodeWorker('md5')
+        self.assertEqual(worker.get_file_hash(open(self.path, 'rb'), 'md5'), worker.get_hash('scanned page', 'md5'))
+
+    def test_unchanged_files_are_not_verified_again(self):
+        self.assertTrue(self.stamps.needs_verification(self.path, 'hash', 'changed'))
+        self.stamps.stamp(self.path, 'hash')
+        self.assertFalse(self.stamps.needs_verification(self.path, 'hash', 'changed'))
+        self.assertTrue(self.stamps.needs_verification(self.path, 'other hash', 'changed'))
+        self.assertTrue(self.stamps.needs_verification(self.path, 'hash', 'always'))
+        self.assertFalse(self.stamps.needs_verification(self.path, 'other hash', 'requested'))
+        open(self.path, 'ab').write(' damaged')
+        self.assertTrue(self.stamps.needs_verification(self.path, 'hash', 'changed'))
+
+    def test_stamps_of_removed_files_pruned(self):
+        other = self._file('ADL-0002_r1.pdf', 'other page')
+        self.stamps.stamp(self.path, 'hash')
+        self.stamps.stamp(other, 'other hash')
+        os.remove(other)
+        self.assertEqual(self.stamps.prune(), 1)
+        self.assertEqual(self.stamps.prune(), 0)
+        self.assertFalse(self.stamps.needs_verification(self.path, 'hash', 'changed'))
+
+
+class PreviewCacheTest(TemporaryDirectoryTestCase):
+    """Page previews cache tests"""
+    def setUp(self):
+        super(PreviewCacheTest, self).setUp()
+        self.cache = PreviewCache(os.path.join(self.root, 'previews.sqlite3'), max_size=250)
+
+    def test_least_recently_used_previews_evicted(self):
+        first, second = self._file('first.png', 'x' * 100), self._file('second.png', 'x' * 100)
+        self.cache.add([first, second])
+        time.sleep(0.01)
+        self.cache.touch(first)
+        self.assertEqual(self.cache.add([self._file('third.png', 'x' * 100)]), [second])
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+
+    def test_requested_size_rounded_up(self):
+        self.assertEqual(get_preview_size(), 64)
+        self.assertEqual(get_preview_size(100), 128)
+        self.assertEqual(get_preview_size(5000), 1024)
+
+
+class LocalFilesystemTest(TemporaryDirectoryTestCase):
+    """Local Storage file writes and journaled moves tests"""
+    def setUp(self):
+        super(LocalFilesystemTest, self).setUp()
+        self.moves = [
+            [self._file(name, name), os.path.join(self.root, name.replace('ADL', 'BBB'))]
+            for name in ['ADL-0001_r1.pdf', 'ADL-0001_r2.pdf']
+        ]
+
+    def test_interrupted_moves_are_finished(self):
+        journal = FileMoveJournal('ADL-0001', root=self.root)
+        journal.write(self.moves)
+        # Crash after the first file was moved
+        LocalFilesystemManager().move_revision_file(*self.moves[0])
+        self.assertEqual(FileMoveJournal.recover(root=self.root), ['ADL-0001'])
+        for source, destination in self.moves:
+            self.assertFalse(os.path.exists(source))
+            self.assertEqual(open(destination).read(), os.path.basename(source))
+        self.assertFalse(os.path.exists(journal.path))
+        self.assertEqual(FileMoveJournal.recover(root=self.root), [])
+
+    def test_moves_of_not_migrated_metadata_are_dropped(self):
+        migrated = os.path.join(self.root, 'BBB-0001.json')
+        journal = FileMoveJournal('ADL-0001', root=self.root)
+        # Crash before file revision data was migrated
+        journal.write(self.moves, after=migrated)
+        self.assertEqual(FileMoveJournal.recover(root=self.root), [])
+        for source, destination in self.moves:
+            self.assertTrue(os.path.exists(source))
+        self.assertFalse(os.path.exists(journal.path))
+        # Crash after it was migrated
+        journal.write(self.moves, after=migrated)
+        self._file('BBB-0001.json', '{}')
+        self.assertEqual(FileMoveJournal.recover(root=self.root), ['ADL-0001'])
+        for source, destination in self.moves:
+            self.assertTrue(os.path.exists(destination))
+
+    def test_write_file_in_chunks(self):
+        destination = self.moves[0][1]
+        content = 'x' * 150000
+        size, digest = LocalFilesystemManager().write_file(StringIO(content), destination, hash_method='sha1')
+        self.assertEqual((size, digest), (len(content), hashlib.sha1(content).hexdigest()))
+        self.assertEqual(open(destination).read(), content)
+        # No temporary files left
+        self.assertEqual(len(os.listdir(self.root)), 3)
+
+    def test_move_across_devices_copies_file(self):
+        source, destination = self.moves[0]
+        LocalFilesystemManager().move_file_across_devices(source, destination)
+        self.assertFalse(os.path.exists(source))
+        self.assertEqual(open(destination).read(), 'ADL-0001_r1.pdf')
+
+
+class StreamStagesTest(TestCase):
+    """Single pass file processing tests"""
+    def test_hash_and_compression_in_one_pass(self):
+        content = ''.join(str(i) for i in range(100000))
+        document = Document()
+        document.set_file_obj(StringIO(content))
+        document.add_stream_stage(HashStreamStage('md5'))
+        document.add_stream_stage(CompressStage(get_codec('GZIP')))
+        self.assertEqual(document.get_hashcode(), None)
+        staged = document.get_file_obj()
+        self.assertTrue(staged.staged)
+        self.assertEqual(zlib.decompress(staged.read()), content)
+        self.assertEqual(document.get_hashcode(), HashCodeWorker('md5').get_hash(content, 'md5'))
+        self.assertEqual(document.get_current_file_revision_data()['hashcode'], document.get_hashcode())
+        staged.close()
+
+    def test_lazy_decompression(self):
+        content = ''.join(str(i) for i in range(100000))
+        decompressed = DecompressingFile(StringIO(zlib.compress(content)), get_codec('GZIP'), chunk_size=1024)
+        self.assertEqual(decompressed.read(10), content[:10])
+        decompressed.seek(5000)
+        self.assertEqual(decompressed.read(10), content[5000:5010])
+        decompressed.seek(20)
+        self.assertEqual(decompressed.read(10), content[20:30])
+        decompressed.seek(0, os.SEEK_END)
+        self.assertEqual(decompressed.tell(), len(content))
+        decompressed.seek(0)
+        self.assertEqual(decompressed.read(), content)
+
+    def test_codecs_and_incompressible_files(self):
+        content = ''.join(str(i) for i in range(10000))
+        bz2_file = Gzip('BZ2').compress_file(StringIO(content))
+        self.assertEqual(DecompressingFile(bz2_file, get_codec('BZ2')).read(), content)
+        self.assertTrue(Gzip().is_compressible(StringIO(content)))
+        self.assertFalse(Gzip().is_compressible(StringIO(os.urandom(100000))))
@@ -10,7 +10,7 @@ from djangoplugins.models import Plugin as DjangoPlugin, ENABLED
 from djangoplugins.utils import get_plugin_name
 
 from core.errors import DmsException
-from dms_plugins.models import PluginOption
+from dms_plugins.models import PluginOption, get_plugin_options
 
 
 class Plugin(object):
@@ -65,16 +65,11 @@ class Plugin(object):
         return self.title + ": " + self.description
 
     def get_option(self, option, docrule):
+        """Returns option value set for docrule's plugin mapping (class attribute if it is not set)"""
         value = getattr(self, option, None)
-        try:
-            PluginOption.objects.filter(
-                plugin=self.get_model(),
-                pluginmapping__doccode=docrule.get_id(),
-                name=option
-            )
-        except PluginOption.DoesNotExist:
-            pass
-        return value
+        if docrule is None:
+            return value
+        return get_plugin_options(docrule.get_id()).get((get_plugin_name(self.__class__), option), value)
 
 
 class PluginError(DmsException):
@@ -17,13 +17,16 @@ from dms_plugins.pluginpoints import DatabaseUpdatePluginPoint
 from dms_plugins.pluginpoints import DatabaseStoragePluginPoint
 from core.models import DocTags
 from dms_plugins.workers import Plugin, PluginError
-from core.document_processor import DocumentProcessor
 from dmscouch.models import CouchDocument
+from dmscouch.batch import get_couchdoc, get_or_create_couchdoc, save_couchdoc, delete_couchdoc, get_active_batch
 
-from couchdbkit.resource import ResourceNotFound
+from couchdbkit.resource import ResourceNotFound, ResourceConflict
 
 log = logging.getLogger('plugins.workers.database.couchdb')
 
+# Attempts to write merged metadata in case CouchDB document is changed by somebody else in between
+UPSERT_RETRIES = 3
+
 class CouchDBMetadataWorker(object):
     """Stores metadata in CouchDB DatabaseManager.
 
@@ -38,70 +41,100 @@ class CouchDBMetadataWorker(object):
         @param document: is a DMS Document() instance
         """
         # FIXME: Refactor me. We should upload new "secondary_indexes" or metatags with update() workflow,
-        # not a create(), like it is now. Because this method is a mess.
+        # not a create(), like it is now.
         docrule = document.get_docrule()
         # doing nothing for no docrule documents
         if docrule.uncategorized:
             return document
         else:
             user = self.check_user(document)
-            processor = DocumentProcessor()
             # FIXME: there might be more than one mapping
             mapping = docrule.get_docrule_plugin_mappings()
             # doing nothing for documents without mapping has DB plugins
             if not mapping.get_database_storage_plugins():
                 return document
             else:
-                # if not exists all required metadata getting them from docrule retrieve sequence
-                if not document.file_revision_data:
-                    # HACK: Preserving db_info here... (May be Solution!!!)
-                    db_info = document.get_db_info()
-                    document = processor.read(document.file_name, options={
-                        'only_metadata': True,
-                        'user': document.user
-                    })
-
-                    # saving NEW file_revision_data ONLY if they exist in new uploaded doc (Preserving old indexes)
-                    if db_info:
-                        # Storing new indexes
-                        document.set_db_info(db_info)
-                    else:
-                        # TODO: move this code into a proper place (UPDATE method)
-                        # Asking couchdb about if old file_revision_data exists and updating them properly
-                        current_revisions = document.file_revision_data
-                        try:
-                            # Only if document exists in DB. Falling gracefully if not.
-                            temp_doc = self.retrieve(document)
-                            old_metadata = temp_doc.get_db_info()
-                            old_index_revisions = None
-                            if old_metadata['mdt_indexes']:
-                                # Preserving Description, User, Created Date, indexes revisions
-                                if temp_doc.index_revisions:
-                                    old_index_revisions = temp_doc.index_revisions
-                                old_metadata['mdt_indexes']['description'] = old_metadata['description']
-                                old_metadata['mdt_indexes']['metadata_user_name'] = old_metadata['metadata_user_name']
-                                old_metadata['mdt_indexes']['metadata_user_id'] = old_metadata['metadata_user_id']
-                                old_cr_date = datetime.datetime.strftime(
-                                    old_metadata['metadata_created_date'],
-                                    settings.DATE_FORMAT
-                                )
-                                old_metadata['mdt_indexes']['date'] = old_cr_date
-                                document.set_db_info(old_metadata['mdt_indexes'])
-                                document.set_index_revisions(old_index_revisions)
-                                document.set_file_revisions_data(current_revisions)
-                            else:
-                                # Preserving set revisions anyway.
-                                document.set_file_revisions_data(current_revisions)
-                        except ResourceNotFound:
-                            pass
-                # updating tags to sync with Django DB
-                self.sync_document_tags(document)
-                # assuming no document with this _id exists. SAVING or overwriting existing
-                couchdoc = CouchDocument()
+                return self.upsert(document, user, merge=not document.file_revision_data)
 
-                couchdoc.populate_from_dms(user, document)
-                couchdoc.save(force_update=True)
+    def upsert(self, document, user, merge=True):
+        """Writes document metadata into CouchDB fetching existing CouchDB document at most once per attempt.
+
+        With merge existing file revisions, index revisions, tags and (if document has no new indexes)
+        description and indexes are preserved. Write uses fetched _rev and is retried on conflict.
+        Without merge existing CouchDB document is overwritten.
+
+        @param document: is a DMS Document() instance
+        @param user: Django User() instance storing metadata
+        @param merge: preserve metadata of existing CouchDB document
+        """
+        if not merge:
+            # updating tags to sync with Django DB
+            self.sync_document_tags(document)
+            couchdoc = CouchDocument()
+            couchdoc.populate_from_dms(user, document)
+            save_couchdoc(couchdoc, force_update=True)
+            return document
+        # Indexes of a new uploaded doc (taking a copy as populate_from_dms() cleans them up)
+        db_info = dict(document.get_db_info() or {})
+        # Set by metadata storage plugins, that run before database ones
+        file_revisions = dict(document.get_file_revisions_data() or {})
+        for attempt in range(UPSERT_RETRIES):
+            existing = None
+            try:
+                existing = get_couchdoc(document.get_code())
+            except ResourceNotFound:
+                pass
+            self.merge_existing(document, existing, db_info, file_revisions)
+            # updating tags to sync with Django DB
+            self.sync_document_tags(document)
+            couchdoc = CouchDocument()
+            couchdoc.populate_from_dms(user, document)
+            if get_active_batch() is not None:
+                # Batch resolves revisions itself
+                save_couchdoc(couchdoc, force_update=True)
                 return document
+            if existing is not None:
+                couchdoc._doc['_rev'] = existing._doc['_rev']
+            try:
+                couchdoc.save()
+                return document
+            except ResourceConflict:
+                log.debug('CouchDBMetadataWorker.upsert conflict for %s, attempt %s' % (document.get_code(), attempt))
+        raise PluginError('CouchDB error: could not store %s. Conflict.' % document.get_code(), 409)
+
+    def merge_existing(self, document, existing, db_info, file_revisions):
+        """Merges metadata of an existing CouchDB document into DMS Document() that is going to be stored
+
+        File revisions are taken from the document (CouchDB ones are kept only if the document has none),
+        CouchDB document provides tags and indexes.
+
+        @param document: is a DMS Document() instance
+        @param existing: CouchDocument() instance or None
+        @param db_info: indexes of a new uploaded document
+        @param file_revisions: file revisions data of the document"""
+        document.set_file_revisions_data(file_revisions)
+        if existing is None:
+            document.set_db_info(dict(db_info))
+            return document
+        if not file_revisions and existing.revisions:
+            # No metadata storage plugin in the mapping
+            document.set_file_revisions_data(dict(existing.revisions))
+        if existing.tags:
+            document.tags = existing.tags
+        if existing.index_revisions:
+            document.set_index_revisions(existing.index_revisions)
+        if db_info:
+            # Storing new indexes
+            document.set_db_info(dict(db_info))
+        else:
+            # Preserving indexes, Description, User, Created Date
+            mdt_indexes = dict(existing.mdt_indexes or {})
+            mdt_indexes['description'] = existing.metadata_description
+            mdt_indexes['metadata_user_name'] = existing.metadata_user_name
+            mdt_indexes['metadata_user_id'] = existing.metadata_user_id
+            mdt_indexes['date'] = datetime.datetime.strftime(existing.metadata_created_date, settings.DATE_FORMAT)
+            document.set_db_info(mdt_indexes)
+        return document
 
     def update_document_metadata(self, document):
         """Updates document with new indexes and stores old one into another revision.
@@ -112,32 +145,32 @@ class CouchDBMetadataWorker(object):
         if 'update_file' in document.options and document.options['update_file']:
             name = document.get_code()
             # We need to create couchdb document in case it does not exists in database.
-            couchdoc = CouchDocument.get_or_create(docid=name)
+            couchdoc = get_or_create_couchdoc(name)
             couchdoc.update_file_revisions_metadata(document)
-            couchdoc.save()
+            save_couchdoc(couchdoc)
         if document.old_docrule:
             old_couchdoc = None
-            couchdoc = CouchDocument.get_or_create(docid=document.file_name)
+            couchdoc = get_or_create_couchdoc(document.file_name)
             try:
-                old_couchdoc = CouchDocument.get(docid=document.old_name_code)
+                old_couchdoc = get_couchdoc(document.old_name_code)
             except Exception, e:
                 log.error('%s' % e)
                 pass
             if old_couchdoc:
                 # Migrate from existing CouchDB document
                 couchdoc.migrate_metadata_for_docrule(document, old_couchdoc)
-                couchdoc.save()
-                old_couchdoc.delete()
+                save_couchdoc(couchdoc)
+                delete_couchdoc(old_couchdoc)
             else:
                 # store from current Document() instance
                 user = document.user
                 couchdoc.populate_from_dms(user, document)
-                couchdoc.save()
+                save_couchdoc(couchdoc)
         # We have to do it after moving document names.
         if document.new_indexes and document.file_name:
-            couchdoc = CouchDocument.get(docid=document.file_name)
+            couchdoc = get_couchdoc(document.file_name)
             couchdoc.update_indexes_revision(document)
-            couchdoc.save()
+            save_couchdoc(couchdoc)
             document = couchdoc.populate_into_dms(document)
         return document
 
@@ -149,10 +182,10 @@ class CouchDBMetadataWorker(object):
         """
         # Doing nothing for mark deleted call
         code = document.get_code()
-        couchdoc = CouchDocument.get(docid=code)
+        couchdoc = get_couchdoc(code)
         if 'mark_deleted' in document.options.iterkeys():
             couchdoc['deleted'] = 'deleted'
-            couchdoc.save()
+            save_couchdoc(couchdoc)
             return document
         if 'mark_revision_deleted' in document.options.iterkeys():
             mark_revision = document.options['mark_revision_deleted']
@@ -160,16 +193,16 @@ class CouchDBMetadataWorker(object):
                 couchdoc.revisions[mark_revision]['deleted'] = True
             else:
                 raise PluginError('Object has no revision: %s' % mark_revision, 404)
-            couchdoc.save()
+            save_couchdoc(couchdoc)
             return document
         if 'delete_revision' in document.options.iterkeys():
             revision = document.options['delete_revision']
             del couchdoc.revisions[revision]
-            couchdoc.save()
+            save_couchdoc(couchdoc)
             return document
         if not document.get_file_obj():
             #doc is fully deleted from fs
-            couchdoc.delete()
+            delete_couchdoc(couchdoc)
         return document
 
     def retrieve(self, document):
@@ -190,17 +223,50 @@ class CouchDBMetadataWorker(object):
                 self.check_user(document)
                 doc_name = document.get_code()
                 couchdoc = CouchDocument()
-                try:
-                    couchdoc = CouchDocument.get(docid=doc_name)
-                except Exception, e:
-                    # Skip deleted errors (they are not used in DMS)
-                    e_message = str(e)
-                    if not e_message in ['deleted', 'missing']:
-                        raise PluginError('CouchDB error: %s' % e, e)
-                    pass
+                if 'couchdoc' in document.options:
+                    # Loaded already with prefetch()
+                    couchdoc = document.get_option('couchdoc') or couchdoc
+                else:
+                    try:
+                        couchdoc = get_couchdoc(doc_name)
+                    except Exception, e:
+                        # Skip deleted errors (they are not used in DMS)
+                        e_message = str(e)
+                        if not e_message in ['deleted', 'missing']:
+                            raise PluginError('CouchDB error: %s' % e, e)
+                        pass
                 document = couchdoc.populate_into_dms(document)
                 return document
 
+    def prefetch(self, documents):
+        """Loads CouchDB documents for many DMS Document()'s with one _all_docs request.
+
+        Loaded CouchDB document is stored into 'couchdoc' option of each Document() (None for missing ones)
+        so retrieve() does not query CouchDB for it again.
+
+        @param documents: list of DMS Document() instances
+        """
+        if not documents:
+            return documents
+        docrule = documents[0].get_docrule()
+        if docrule.uncategorized or not docrule.get_docrule_plugin_mappings().get_database_storage_plugins():
+            return documents
+        names = [document.get_code() for document in documents]
+        couchdocs = {}
+        try:
+            rows = CouchDocument.get_db().all_docs(keys=names, include_docs=True)
+            for row in rows:
+                # Missing and deleted documents have no 'doc' in response
+                if row.get('doc', None):
+                    couchdocs[row['key']] = CouchDocument.wrap(row['doc'])
+        except Exception, e:
+            # Falling back to one request per document in retrieve()
+            log.error('CouchDBMetadataWorker.prefetch error: %s' % e)
+            return documents
+        for document in documents:
+            document.set_option('couchdoc', couchdocs.get(document.get_code(), None))
+        return documents
+
     ####################################################################################################################
     #############################################   Helper managers: ###################################################
     ####################################################################################################################
@@ -243,6 +309,12 @@ class CouchDBMetadataRetrievalPlugin(Plugin, BeforeRetrievalPluginPoint):
         @param document: is a DMS Document() instance"""
         return self.worker.retrieve(document)
 
+    def prefetch(self, documents):
+        """Loads metadata of many documents at once
+
+        @param documents: list of DMS Document() instances"""
+        return self.worker.prefetch(documents)
+
 
 class CouchDBMetadataStoragePlugin(Plugin, DatabaseStoragePluginPoint):
     title = "CouchDB Metadata Storage"
@@ -0,0 +1,277 @@
+"""
+Module: Content Addressed Storage
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Stores revision files once per content. File is named by sha256 digest of the stored (e.g. compressed) bytes
+and kept in DMS_BLOB_ROOT with a reference count. Revision is mapped to its blob with 'blob' key
+in file revision data, so metadata plugins must be mapped too (they store it):
+
+    Storage:        Content Addressed Storage (index 44), runs before metadata storage (index 45)
+    Before Update:  Content Addressed Storage on update (index 90), runs after compression
+    Update:         Content Addressed Update (index 10), runs after metadata update (index 0)
+    Retrieval:      Content Addressed Retrieval (index 50), runs after metadata retrieval (index 45)
+    Removal:        Content Addressed Removal (index 20), runs before metadata removal (index 30)
+                    and releases blobs listed in file revision data read before removal
+
+Docrule changes and renames do not copy any bytes: blobs stay in place and only file revision data changes.
+Revisions stored before the plugin was mapped (no 'blob' key) are handled as Local Storage files.
+"""
+
+import os
+import uuid
+import sqlite3
+import logging
+
+from django.conf import settings
+
+from dms_plugins.pluginpoints import StoragePluginPoint, BeforeRetrievalPluginPoint, BeforeRemovalPluginPoint,\
+    BeforeUpdatePluginPoint, UpdatePluginPoint
+from dms_plugins.workers import Plugin, PluginError
+from dms_plugins.workers.storage.local import Local, LocalFilesystemManager
+from dms_plugins.workers.storage.fs_cache import fs_cache
+
+log = logging.getLogger('dms_plugins.workers.storage.blobs')
+
+__all__ = ['BlobStore', 'ContentAddressedStorage', 'blob_store']
+
+BLOB_ROOT = getattr(settings, 'DMS_BLOB_ROOT', None) or os.path.join(settings.DOCUMENT_ROOT, '.blobs')
+
+REFCOUNTS_FILENAME = 'refcounts.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL
+);
+"""
+
+
+class BlobStore(object):
+    """Files named by their content sha256 digest with reference counts kept in an SQLite database"""
+    def __init__(self, root=BLOB_ROOT):
+        self.root = root
+        self.db_path = os.path.join(root, REFCOUNTS_FILENAME)
+        self.filesystem = LocalFilesystemManager()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def connect(self):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        # Transactions are started explicitly with BEGIN IMMEDIATE to serialize reference counting of processes
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.executescript(SCHEMA)
+        return connection
+
+    def execute_locked(self, function, *args):
+        """Runs function(connection, *args) in a write locked transaction"""
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = function(connection, *args)
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+            return result
+        finally:
+            connection.close()
+
+    def put(self, file_obj):
+        """Stores content of a file object (or references an existing copy of it). Returns its digest."""
+        tmp_dir = os.path.join(self.root, 'tmp')
+        if not os.path.isdir(tmp_dir):
+            os.makedirs(tmp_dir)
+        tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+        try:
+            size, digest = self.filesystem.write_file(file_obj, tmp_path, hash_method='sha256')
+            self.execute_locked(self._reference, digest, size, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest
+
+    def _reference(self, connection, digest, size, tmp_path):
+        path = self.path(digest)
+        row = connection.execute('SELECT refcount FROM blobs WHERE digest = ?', (digest, )).fetchone()
+        if row is None or not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(tmp_path, path)
+            fs_cache.invalidate(path)
+        if row is None:
+            connection.execute('INSERT INTO blobs (digest, size, refcount) VALUES (?, ?, 1)', (digest, size))
+        else:
+            connection.execute('UPDATE blobs SET refcount = refcount + 1 WHERE digest = ?', (digest, ))
+
+    def release(self, digest):
+        """Drops a reference to a blob. Blob file is removed with the last one."""
+        if self.execute_locked(self._release, digest):
+            # File is removed after the release is committed, so a rolled back release does not lose it.
+            # Locked again, as the same content may be stored meanwhile.
+            self.execute_locked(self._remove_unreferenced, digest)
+
+    def _release(self, connection, digest):
+        """Returns True if the last reference was dropped"""
+        row = connection.execute('SELECT refcount FROM blobs WHERE digest = ?', (digest, )).fetchone()
+        if row is None:
+            log.warning('BlobStore: releasing unknown blob %s' % digest)
+            return False
+        if row[0] > 1:
+            connection.execute('UPDATE blobs SET refcount = refcount - 1 WHERE digest = ?', (digest, ))
+            return False
+        connection.execute('DELETE FROM blobs WHERE digest = ?', (digest, ))
+        return True
+
+    def _remove_unreferenced(self, connection, digest):
+        if connection.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest, )).fetchone() is None:
+            path = self.path(digest)
+            if os.path.exists(path):
+                os.remove(path)
+            fs_cache.invalidate(path)
+
+    def refcount(self, digest):
+        connection = self.connect()
+        try:
+            row = connection.execute('SELECT refcount FROM blobs WHERE digest = ?', (digest, )).fetchone()
+        finally:
+            connection.close()
+        return row[0] if row else 0
+
+blob_store = BlobStore()
+
+
+class ContentAddressedStorage(Local):
+    """Local storage worker keeping revision files in a BlobStore()"""
+    def __init__(self):
+        super(ContentAddressedStorage, self).__init__()
+        self.blobs = blob_store
+
+    def store(self, document):
+        if not document.get_option('only_metadata'):
+            self.store_new_file(document)
+        return document
+
+    def store_new_file(self, document):
+        try:
+            digest = self.blobs.put(document.get_file_obj())
+        except (OSError, IOError, sqlite3.Error), e:
+            raise PluginError("File storing problem: %s" % e, 500)
+        document.update_current_file_revision_data({'blob': digest})
+
+    def retrieve(self, document):
+        if document.get_option('only_metadata') or document.get_option('indexing_data'):
+            return document
+        digest = (document.get_current_file_revision_data() or {}).get('blob', None)
+        if not digest:
+            return super(ContentAddressedStorage, self).retrieve(document)
+        fullpath = self.blobs.path(digest)
+        if not fs_cache.exists(fullpath):
+            raise PluginError("No such document: %s" % fullpath, 404)
+        document.set_fullpath(fullpath)
+        return document
+
+    def get_legacy_revisions(self, file_revision_data):
+        """Returns file revision data of revisions stored as Local Storage files"""
+        return dict((key, value) for key, value in file_revision_data.iteritems() if 'blob' not in value)
+
+    def update(self, document):
+        """Moves only revisions stored as Local Storage files. Blobs are referenced by file revision data."""
+        if document.old_docrule:
+            legacy = self.get_legacy_revisions(document.get_file_revisions_data())
+            if legacy:
+                self.move_files(document, legacy)
+        return document
+
+    def remove(self, document):
+        # Doing nothing for mark deleted call
+        if 'mark_deleted' in document.options or 'mark_revision_deleted' in document.options:
+            return document
+        # Loaded by metadata retrieval plugins before removal
+        revisions = document.get_file_revisions_data() or {}
+        revision = document.get_revision()
+        if revision:
+            removed = [revisions.get(str(revision), {})]
+        else:
+            removed = revisions.values()
+        for value in removed:
+            if 'blob' in value:
+                self.blobs.release(value['blob'])
+        if revision and 'blob' in removed[0]:
+            # Nothing else to remove for this revision
+            return document
+        return super(ContentAddressedStorage, self).remove(document)
+
+
+class ContentAddressedStoragePlugin(Plugin, StoragePluginPoint):
+    title = "Content Addressed Storage"
+    description = "Saves document file once per content (deduplicates files)"
+    index = 44
+
+    plugin_type = 'storage'
+    worker = ContentAddressedStorage()
+
+    def work(self, document, **kwargs):
+        return self.worker.store(document)
+
+
+class ContentAddressedStorageOnUpdatePlugin(Plugin, BeforeUpdatePluginPoint):
+    title = "Content Addressed Storage on update"
+    description = "Saves new revision file once per content (deduplicates files)"
+    index = 90
+
+    plugin_type = 'update_processing'
+    worker = ContentAddressedStorage()
+
+    def work(self, document, **kwargs):
+        if document.get_option('update_file') is not None:
+            self.worker.store_new_file(document)
+        return document
+
+
+class ContentAddressedRetrievalPlugin(Plugin, BeforeRetrievalPluginPoint):
+    title = "Content Addressed Retrieval"
+    description = "Loads document file stored once per content"
+    index = 50
+
+    plugin_type = 'storage'
+    worker = ContentAddressedStorage()
+
+    def work(self, document, **kwargs):
+        return self.worker.retrieve(document)
+
+
+class ContentAddressedRemovalPlugin(Plugin, BeforeRemovalPluginPoint):
+    title = "Content Addressed Removal"
+    description = "Releases document files stored once per content"
+    index = 20
+
+    plugin_type = 'storage'
+    worker = ContentAddressedStorage()
+
+    def work(self, document, **kwargs):
+        return self.worker.remove(document)
+
+
+class ContentAddressedUpdatePlugin(Plugin, UpdatePluginPoint):
+    title = "Content Addressed Update"
+    description = "Updates document file revisions stored once per content"
+    index = 10
+
+    plugin_type = 'storage'
+    worker = ContentAddressedStorage()
+
+    def work(self, document, **kwargs):
+        return self.worker.update(document)
+
+    def prepare_update(self, document, old_document):
+        """Journals moves of revisions stored as Local Storage files before file revision data is migrated"""
+        if document.old_docrule:
+            legacy = self.worker.get_legacy_revisions(old_document.get_file_revisions_data() or {})
+            if legacy:
+                self.worker.journal_moves(document, legacy)
@@ -0,0 +1,111 @@
+"""
+Module: Local Storage directory listing and file content cache
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Saves filesystem round trips (expensive with NFS mounted DOCUMENT_ROOT) of frequent read requests,
+e.g. revision count polling. Cached entries are trusted for DMS_FILESYSTEM_CACHE_TTL seconds,
+then revalidated with a single stat() call: entry is reloaded only if mtime (and size) changed.
+Writes of this process drop the entries at once. Writes of other processes are seen within TTL.
+"""
+
+import os
+import time
+import logging
+import threading
+
+from django.conf import settings
+
+log = logging.getLogger('dms_plugins.workers.storage.fs_cache')
+
+__all__ = ['FilesystemCache', 'fs_cache']
+
+CACHE_TTL = getattr(settings, 'DMS_FILESYSTEM_CACHE_TTL', 2)
+CACHE_SIZE = getattr(settings, 'DMS_FILESYSTEM_CACHE_SIZE', 10000)
+
+# Entries loaded within this number of seconds after their mtime can not be validated by mtime
+# (filesystem mtime granularity is up to 1 second, NFS server clock may differ a bit).
+RACY_WINDOW = 2
+
+
+class FilesystemCache(object):
+    """Per process cache of directory listings and small files content (e.g. JSON file revision data)"""
+    def __init__(self, ttl=CACHE_TTL, size=CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'revalidations': 0, 'loads': 0}
+
+    def get(self, key, path, loader, max_age):
+        """Returns cached value of a path or loads it with loader(path)
+
+        @param key: (kind, path) cache key
+        @param max_age: seconds an entry is used without stat() (0 to always check mtime)"""
+        now = time.time()
+        entry = self.entries.get(key, None)
+        if entry is not None and now - entry[0] < max_age:
+            self.stats['hits'] += 1
+            return entry[2]
+        stat = os.stat(path)
+        signature = (stat.st_mtime, stat.st_size)
+        if entry is not None and entry[1] == signature and entry[0] - stat.st_mtime >= RACY_WINDOW:
+            self.stats['revalidations'] += 1
+            self.entries[key] = (now, signature, entry[2])
+            return entry[2]
+        self.stats['loads'] += 1
+        value = loader(path)
+        with self.lock:
+            if len(self.entries) >= self.size:
+                self.entries.clear()
+            self.entries[key] = (now, signature, value)
+        return value
+
+    def listdir(self, directory, max_age=None):
+        """Returns frozenset of names in a directory. Raises OSError for missing directories."""
+        if max_age is None:
+            max_age = self.ttl
+        return self.get(('dir', directory), directory, lambda path: frozenset(os.listdir(path)), max_age)
+
+    def exists(self, path):
+        """Checks a file exists with a cached listing of its directory
+
+        Missing files are always checked against the current directory listing."""
+        directory, name = os.path.split(path)
+        try:
+            return name in self.listdir(directory) or name in self.listdir(directory, max_age=0)
+        except OSError:
+            return False
+
+    def read(self, path, max_age=None):
+        """Returns content of a file or None if it does not exist
+
+        @param max_age: use 0 for reads that are followed by a write (e.g. next revision calculation)"""
+        if max_age is None:
+            max_age = self.ttl
+        try:
+            return self.get(('file', path), path, self.read_file, max_age)
+        except (OSError, IOError):
+            self.invalidate(path)
+            return None
+
+    def read_file(self, path):
+        file_obj = open(path, 'rb')
+        try:
+            return file_obj.read()
+        finally:
+            file_obj.close()
+
+    def invalidate(self, path):
+        """Drops cached data of a file (or a directory) and listing of its parent directory"""
+        path = path.rstrip(os.sep)
+        with self.lock:
+            for key in (('file', path), ('dir', path), ('dir', os.path.dirname(path))):
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+fs_cache = FilesystemCache()
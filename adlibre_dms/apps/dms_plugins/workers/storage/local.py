@@ -7,17 +7,34 @@ License: See LICENSE for license information
 
 import datetime
 import os
+import json
+import errno
 import shutil
+import hashlib
 import logging
+import tempfile
 
 from django.conf import settings
 
 from dms_plugins.pluginpoints import StoragePluginPoint, BeforeRetrievalPluginPoint, BeforeRemovalPluginPoint,\
     UpdatePluginPoint
 from dms_plugins.workers import Plugin, PluginError, BreakPluginChain
+from dms_plugins.workers.storage.fs_cache import fs_cache
 
 log = logging.getLogger('dms')
 
+# Journals of revision files moves (docrule changes) that are not finished yet
+MOVE_JOURNAL_DIRECTORY = '.move_journal'
+
+CHUNK_SIZE = getattr(settings, 'DMS_FILE_CHUNK_SIZE', 64 * 1024)
+# 'none', 'file' (file is synced before it is renamed into place) or 'full' (directory is synced after rename too)
+FSYNC_POLICY = getattr(settings, 'DMS_STORAGE_FSYNC', 'file')
+
+# Stored files get usual permissions (temporary files are created readable by owner only)
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0666 & ~_umask
+
 class NoRevisionError(Exception):
     def __str__(self):
         return "NoRevisionError - No such revision number"
@@ -57,37 +74,208 @@ class LocalFilesystemManager(object):
 
     def store_file(self, file_obj, fpath):
         """Filesystem worker to store a file from one given object to destination path."""
+        if getattr(file_obj, 'staged', False) and self.link_staged_file(file_obj, fpath):
+            return True
         try:
-            destination = open(fpath, 'wb+')
-            file_obj.seek(0)
-            destination.write(file_obj.read())
-            destination.close()
+            self.write_file(file_obj, fpath)
         except Exception, e:
             log.error("LocalFilesystemManager. File storing Error: %s", e)
             return False
         return True
 
+    def link_staged_file(self, file_obj, fpath):
+        """Hardlinks a staging file of core.streams into place instead of copying it.
+
+        Returns False if it is not possible (e.g. staging directory is on another filesystem)."""
+        try:
+            file_obj.flush()
+            if FSYNC_POLICY != 'none':
+                os.fsync(file_obj.fileno())
+            os.chmod(file_obj.name, FILE_MODE)
+            os.link(file_obj.name, fpath)
+        except (OSError, AttributeError), e:
+            log.debug("LocalFilesystemManager. Can not link staged file %s: %s" % (getattr(file_obj, 'name', ''), e))
+            return False
+        if FSYNC_POLICY == 'full':
+            self.fsync_directory(os.path.dirname(fpath))
+        fs_cache.invalidate(fpath)
+        return True
+
+    def fsync_directory(self, directory):
+        """Flushes directory entries (e.g. a renamed or linked file) to disk"""
+        directory_handle = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_handle)
+        finally:
+            os.close(directory_handle)
+
+    def write_file(self, file_obj, fpath, hash_method=None, fsync_policy=None):
+        """Writes a file object to a path in chunks, so memory usage does not depend on file size
+
+        Data is written into a temporary file in the destination directory that is renamed into place,
+        so a crash never leaves a truncated file at the path.
+
+        @param hash_method: hashlib method name to calculate a hash of data in the same pass e.g. 'sha256'
+        @param fsync_policy: 'none', 'file' or 'full' (DMS_STORAGE_FSYNC by default)
+        @return (size, hex digest or None)"""
+        fsync_policy = fsync_policy or FSYNC_POLICY
+        content_hash = hashlib.new(hash_method) if hash_method else None
+        size = 0
+        directory = os.path.dirname(fpath)
+        handle, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_')
+        try:
+            destination = os.fdopen(handle, 'wb')
+            try:
+                file_obj.seek(0)
+                chunk = file_obj.read(CHUNK_SIZE)
+                while chunk:
+                    if content_hash is not None:
+                        content_hash.update(chunk)
+                    destination.write(chunk)
+                    size += len(chunk)
+                    chunk = file_obj.read(CHUNK_SIZE)
+                if fsync_policy != 'none':
+                    destination.flush()
+                    os.fsync(destination.fileno())
+            finally:
+                destination.close()
+            os.chmod(tmp_path, FILE_MODE)
+            os.rename(tmp_path, fpath)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if fsync_policy == 'full':
+            self.fsync_directory(directory)
+        fs_cache.invalidate(fpath)
+        return size, content_hash.hexdigest() if content_hash is not None else None
+
     def move_file(self, source_path, destination_path):
         """Filesystem worker to move file from one path to another."""
         try:
             os.rename(source_path, destination_path)
+            fs_cache.invalidate(source_path)
+            fs_cache.invalidate(destination_path)
         except Exception, e:
             log.error("LocalFilesystemManager. File moving Error: %s", e)
             return False
         return True
 
+    def move_file_across_devices(self, source_path, destination_path):
+        """Copies a file in chunks to destination and removes the source"""
+        source = open(source_path, 'rb')
+        try:
+            # Source is removed, so copy must be on disk whatever the policy is
+            self.write_file(source, destination_path, fsync_policy='full')
+        finally:
+            source.close()
+        os.remove(source_path)
+
+    def move_revision_file(self, source_path, destination_path):
+        """Moves a revision file without reading it (copies it only if paths are on different devices)
+
+        Can be repeated after a crash: already moved file is not touched."""
+        if not os.path.exists(source_path) and os.path.exists(destination_path):
+            return
+        try:
+            os.rename(source_path, destination_path)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+            self.move_file_across_devices(source_path, destination_path)
+        fs_cache.invalidate(source_path)
+        fs_cache.invalidate(destination_path)
+
     def remove_file(self, path_with_file):
         try:
             os.remove(path_with_file)
+            fs_cache.invalidate(path_with_file)
             return True
         except Exception, e:
             log.error("LocalFilesystemManager. File removal error: %s" % e)
             return False
 
 
+class FileMoveJournal(object):
+    """Crash safe journal of revision files being moved to another location (e.g. on docrule change)
+
+    Moves are written into a journal file before file revision data is migrated and before any file is touched.
+    The journal is removed when all of them are done. Unfinished moves are finished (not reverted) with recover()
+    once migrated file revision data (the journal's 'after' file) is written. Moves of a document which metadata
+    was not migrated before a crash are dropped, as its files are still where the metadata points."""
+    def __init__(self, name, root=None):
+        self.directory = os.path.join(root or settings.DOCUMENT_ROOT, MOVE_JOURNAL_DIRECTORY)
+        self.path = os.path.join(self.directory, '%s.json' % name)
+
+    def write(self, moves, after=None):
+        """Writes list of (source path, destination path) moves to the journal
+
+        @param after: path of a file that must exist for moves to be recovered (None if moves are due already)"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp_path = self.path + '.tmp'
+        journal = open(tmp_path, 'w')
+        try:
+            json.dump({'moves': moves, 'after': after}, journal)
+            journal.flush()
+            os.fsync(journal.fileno())
+        finally:
+            journal.close()
+        os.rename(tmp_path, self.path)
+
+    def read(self):
+        """Returns (moves, path of a file that must exist for moves to be recovered or None)"""
+        journal = open(self.path, 'r')
+        try:
+            data = json.load(journal)
+        finally:
+            journal.close()
+        if isinstance(data, list):
+            # Written by older version
+            return data, None
+        return data['moves'], data.get('after', None)
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def execute(self, moves, filesystem=None):
+        """Moves files journaling them. Journal stays in place if a move fails."""
+        filesystem = filesystem or LocalFilesystemManager()
+        self.write(moves)
+        for source_path, destination_path in moves:
+            filesystem.move_revision_file(source_path, destination_path)
+        self.finish()
+
+    @classmethod
+    def recover(cls, root=None):
+        """Finishes all unfinished moves. Returns list of recovered journal names."""
+        directory = os.path.join(root or settings.DOCUMENT_ROOT, MOVE_JOURNAL_DIRECTORY)
+        recovered = []
+        if not os.path.isdir(directory):
+            return recovered
+        filesystem = LocalFilesystemManager()
+        for filename in sorted(os.listdir(directory)):
+            name, extension = os.path.splitext(filename)
+            if extension != '.json':
+                continue
+            journal = cls(name, root)
+            moves, after = journal.read()
+            if after and not os.path.exists(after):
+                log.warning('FileMoveJournal: %s metadata was not migrated, files are not moved' % name)
+                journal.finish()
+                continue
+            for source_path, destination_path in moves:
+                if os.path.exists(source_path):
+                    filesystem.move_revision_file(source_path, destination_path)
+            journal.finish()
+            recovered.append(name)
+        return recovered
+
+
 def file_present(file_name, directory):
     """Determine if file is present in directory"""
-    return file_name in os.listdir(directory)
+    return fs_cache.exists(os.path.join(directory, file_name))
 
 
 def filecount(directory):
@@ -113,7 +301,7 @@ class Local(object):
             return document
         directory = self.filesystem.get_document_directory(document)
         fullpath = os.path.join(directory, document.get_current_file_revision_data()['name'])
-        if not os.path.exists(fullpath):
+        if not fs_cache.exists(fullpath):
             raise PluginError("No such document: %s" % fullpath, 404)
         document.set_fullpath(fullpath)
 
@@ -128,29 +316,68 @@ class Local(object):
         if 'update_file' in document.options.iterkeys() and document.options['update_file'] is not None:
             self.store_new_file(document)
         if document.old_docrule:
-            # Renaming and moving files to new location files
-            new_directory = self.filesystem.get_or_create_document_directory(document)
-            new_name = document.get_filename()
-            file_revision_data = document.get_file_revisions_data()
-            # Making new document OLD one for retrieving data purposes
-            document.docrule = None
-            document.set_filename(document.old_name_code)
-            old_directory = self.filesystem.get_or_create_document_directory(document)
-            old_code = document.old_name_code
-            # Returning document back to normal
-            document.docrule = None
-            document.set_filename(new_name)
-            for key, value in file_revision_data.iteritems():
-                new_file_revision = value['name']
-                new_path = os.path.join(new_directory, new_file_revision)
-                old_rev_name = self.convert_metadata_for_revision(new_file_revision, old_code, key)
-                old_path = os.path.join(old_directory, old_rev_name)
-                f = document.file_revisions[key]
-                status_store = self.filesystem.store_file(f, new_path)
-                f.close()
-                status_remove = self.filesystem.remove_file(old_path)
-                if not status_store or not status_remove:
-                    raise PluginError("File moving problem. From: %s to: %s" % (old_path, new_path), 500)
+            self.move_files(document, document.get_file_revisions_data())
+        return document
+
+    def get_move_directories(self, document):
+        """Returns (old directory, new directory) of a document changing its docrule"""
+        new_directory = self.filesystem.get_or_create_document_directory(document)
+        new_name = document.get_filename()
+        # Making new document OLD one for retrieving data purposes
+        document.docrule = None
+        document.set_filename(document.old_name_code)
+        old_directory = self.filesystem.get_or_create_document_directory(document)
+        # Returning document back to normal
+        document.docrule = None
+        document.set_filename(new_name)
+        return old_directory, new_directory
+
+    def journal_moves(self, document, file_revision_data):
+        """Journals revision file moves of a document changing its docrule before its metadata is migrated
+
+        Revisions given in document.file_revisions are stored again, not moved.
+
+        @param file_revision_data: file revision data of the document under its old docrule"""
+        old_directory, new_directory = self.get_move_directories(document)
+        new_name = document.get_filename()
+        moves = []
+        for key, value in file_revision_data.iteritems():
+            if key not in document.file_revisions:
+                old_path = os.path.join(old_directory, value['name'])
+                new_path = os.path.join(new_directory, self.convert_metadata_for_revision(value['name'], new_name, key))
+                moves.append((old_path, new_path))
+        if moves:
+            # Recovered only after the migrated file revision data is written
+            migrated = os.path.join(new_directory, '%s.json' % document.get_code())
+            FileMoveJournal(document.old_name_code).write(moves, after=migrated)
+
+    def move_files(self, document, file_revision_data):
+        """Renames and moves revision files of a document changing its docrule
+
+        Revisions given in document.file_revisions (processed for the new docrule) are stored from them.
+        Other revision files are moved as is with a FileMoveJournal() (written by journal_moves() already)."""
+        old_directory, new_directory = self.get_move_directories(document)
+        old_code = document.old_name_code
+        moves = []
+        for key, value in file_revision_data.iteritems():
+            new_file_revision = value['name']
+            new_path = os.path.join(new_directory, new_file_revision)
+            old_rev_name = self.convert_metadata_for_revision(new_file_revision, old_code, key)
+            old_path = os.path.join(old_directory, old_rev_name)
+            if key not in document.file_revisions:
+                moves.append((old_path, new_path))
+                continue
+            f = document.file_revisions[key]
+            status_store = self.filesystem.store_file(f, new_path)
+            f.close()
+            status_remove = self.filesystem.remove_file(old_path)
+            if not status_store or not status_remove:
+                raise PluginError("File moving problem. From: %s to: %s" % (old_path, new_path), 500)
+        if moves:
+            try:
+                FileMoveJournal(old_code).execute(moves, self.filesystem)
+            except (OSError, IOError), e:
+                raise PluginError("File moving problem: %s. Run 'recover_moves' command to finish it." % e, 500)
         return document
 
     def document_matches_search(self, metadata_info, searchword):
@@ -231,6 +458,7 @@ class Local(object):
             #print "In directory: ", directory
             try:
                 os.unlink(os.path.join(directory, filename))
+                fs_cache.invalidate(os.path.join(directory, filename))
             except Exception, e:
                 raise PluginError(str(e), 500)
 
@@ -238,6 +466,7 @@ class Local(object):
         if not filename:
             try:
                 shutil.rmtree(directory)
+                fs_cache.clear()
             except Exception, e:
                 log.error('LocalFileStorage delete exception %s' % e)
                 pass
@@ -246,7 +475,13 @@ class Local(object):
         return document
 
     def get_revision_count(self, document):
-        """Hacky way, but faster than reading the revs from the file revision data"""
+        """Returns number of document revisions
+
+        Counted in file revision data loaded by metadata plugins already.
+        Revision files are counted only for documents without it."""
+        revisions = document.get_file_revisions_data()
+        if revisions:
+            return len(revisions)
         directory = self.filesystem.get_document_directory(document)
         file_count = 0
         if document.get_docrule().uncategorized:
@@ -309,3 +544,8 @@ class LocalUpdatePlugin(Plugin, UpdatePluginPoint):
 
     def work(self, document, **kwargs):
         return self.worker.update(document)
+
+    def prepare_update(self, document, old_document):
+        """Journals file moves of a docrule change before metadata update plugins migrate file revision data"""
+        if document.old_docrule:
+            self.worker.journal_moves(document, old_document.get_file_revisions_data() or {})
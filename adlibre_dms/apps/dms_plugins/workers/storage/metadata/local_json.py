@@ -1,5 +1,8 @@
 import json
 import os
+import sqlite3
+import logging
+import calendar
 from datetime import datetime
 
 from django.conf import settings
@@ -8,7 +11,11 @@ from dms_plugins.pluginpoints import StoragePluginPoint, BeforeRetrievalPluginPo
     BeforeRemovalPluginPoint, UpdatePluginPoint
 from dms_plugins.workers import Plugin, PluginError
 from dms_plugins.workers.storage.local import LocalFilesystemManager
+from dms_plugins.workers.storage.fs_cache import fs_cache
+from dms_plugins.workers.storage.metadata.manifest import MetadataManifest, ORDER_COLUMNS,\
+    encode_cursor, decode_cursor
 
+log = logging.getLogger('dms_plugins.workers.storage.metadata.local_json')
 
 class LocalJSONMetadata(object):
     """Stores file revision data in the same directory as document revisions in JSON format."""
@@ -58,7 +65,7 @@ class LocalJSONMetadata(object):
             revision = mark_revision
         if revision:
             directory = self.filesystem.get_or_create_document_directory(document)
-            fileinfo_db, new_revision = self.load_metadata(document.get_code(), directory)
+            fileinfo_db, new_revision = self.load_metadata(document.get_code(), directory, max_age=0)
             if not mark_revision:
                 del fileinfo_db[str(revision)]
             else:
@@ -71,7 +78,8 @@ class LocalJSONMetadata(object):
             if not fileinfo_db:
                 self.remove_metadata_file(directory, document)
         else:
-            pass  # our directory with all file revision data has just been deleted %)
+            # our directory with all file revision data has just been deleted %)
+            self.unindex_document(document.get_docrule(), document.get_code())
         return document
 
     def update(self, document):
@@ -85,13 +93,12 @@ class LocalJSONMetadata(object):
         return document
 
     """Internal manager methods"""
-    def load_from_file(self, json_file):
-        if os.path.exists(json_file):
+    def load_from_file(self, json_file, max_age=None):
+        """Reads file revision data through fs_cache (see fs_cache.read() for max_age)"""
+        content = fs_cache.read(json_file, max_age=max_age)
+        if content is not None:
             revisions = []
-            json_handler = open(json_file , mode='r+')
-#            if settings.DEBUG:
-#                print json_file
-            fileinfo_db = json.load(json_handler)
+            fileinfo_db = json.loads(content)
             revisions_unsorted = fileinfo_db.keys()
             for rev in revisions_unsorted:
                 revisions.append(int(rev))
@@ -119,9 +126,9 @@ class LocalJSONMetadata(object):
             revisions[rev_key] = revision
         return revisions
 
-    def load_metadata(self, document_name, directory):
+    def load_metadata(self, document_name, directory, max_age=None):
         json_file = os.path.join(directory, '%s.json' % (document_name,))
-        _file = self.load_from_file(json_file)
+        _file = self.load_from_file(json_file, max_age=max_age)
         return _file
 
     def date_to_string(self, date):
@@ -137,7 +144,8 @@ class LocalJSONMetadata(object):
         return date
 
     def save_metadata(self, document, directory):
-        fileinfo_db, revision = self.load_metadata(document.get_code(), directory)
+        # Next revision number must be calculated from current data
+        fileinfo_db, revision = self.load_metadata(document.get_code(), directory, max_age=0)
         document.set_revision(revision)
 
         fileinfo = {
@@ -167,6 +175,86 @@ class LocalJSONMetadata(object):
         json_file = os.path.join(directory, '%s.json' % (document.get_code(),))
         json_handler = open(json_file, mode='w')
         json.dump(fileinfo_db, json_handler, indent=4)
+        json_handler.close()
+        fs_cache.invalidate(json_file)
+        self.index_document(document.get_docrule(), document.get_code(), directory, fileinfo_db)
+
+    def get_first_metadata(self, metadatas):
+        """Returns file revision data of the first revision of a document"""
+        keys = metadatas.keys()
+        keys.sort()
+        return metadatas[keys[0]]
+
+    def get_created(self, metadatas):
+        """Returns (ISO date, epoch seconds) of document's first revision creation
+
+        Used to filter and sort documents by created date."""
+        created = self.string_to_date(self.get_first_metadata(metadatas)['created_date'])
+        return created.date().isoformat(), calendar.timegm(created.timetuple())
+
+    def index_document(self, docrule, code, directory, fileinfo_db):
+        """Updates docrule's MetadataManifest() with document file revision data"""
+        manifest = MetadataManifest(docrule)
+        if manifest.is_rebuilding():
+            # This directory may be walked already. Change is applied after the rebuild.
+            manifest.record_change(code, directory)
+        if not manifest.exists():
+            # Will be built from all the files on first listing
+            return
+        try:
+            if fileinfo_db:
+                manifest.add(code, directory, fileinfo_db, *self.get_created(fileinfo_db))
+            else:
+                manifest.remove(code)
+        except (sqlite3.Error, OSError, KeyError, ValueError), e:
+            self.manifest_write_failed(manifest, code, directory, e)
+
+    def unindex_document(self, docrule, code):
+        """Removes a document from docrule's MetadataManifest()"""
+        manifest = MetadataManifest(docrule)
+        if manifest.is_rebuilding():
+            manifest.record_change(code, None)
+        if not manifest.exists():
+            return
+        try:
+            manifest.remove(code)
+        except (sqlite3.Error, OSError), e:
+            self.manifest_write_failed(manifest, code, None, e)
+
+    def manifest_write_failed(self, manifest, code, directory, error):
+        log.error('LocalJSONMetadata: can not update %s in %s: %s' % (code, manifest.path, error))
+        if not manifest.is_rebuilding():
+            # Manifest will be rebuilt from files on next listing.
+            # While it is being rebuilt the change is journaled already and the manifest is replaced anyway.
+            manifest.drop()
+
+    def read_manifest_entry(self, code, directory):
+        """Returns MetadataManifest() entry of a document from its file (None if it is removed)"""
+        if directory is None:
+            return None
+        metadatas = self.load_from_file(os.path.join(directory, '%s.json' % code), max_age=0)[0]
+        if not metadatas:
+            return None
+        return (code, directory, metadatas) + self.get_created(metadatas)
+
+    def walk_metadata(self, docrule):
+        """Reads file revision data of all documents of a docrule from files
+
+        Yields tuples (name, directory, metadatas, created_day, created_epoch) to build a MetadataManifest()"""
+        doccode_directory = os.path.join(settings.DOCUMENT_ROOT, docrule.get_directory_name())
+        for root, dirs, files in os.walk(doccode_directory):
+            for fil in files:
+                doc, extension = os.path.splitext(fil)
+                if extension == '.json':
+                    metadatas = self.load_from_file(os.path.join(root, fil), max_age=0)[0]
+                    if metadatas:
+                        yield (doc, root, metadatas) + self.get_created(metadatas)
+
+    def rebuild_index(self, docrule, only_missing=False):
+        """Rebuilds docrule's MetadataManifest() from files. Returns number of indexed documents.
+
+        @param only_missing: do nothing if manifest is built by another process meanwhile (returns None)"""
+        return MetadataManifest(docrule).rebuild(self.walk_metadata(docrule), self.read_manifest_entry, only_missing)
 
     def get_fake_metadata(self, root, fil):
         current_date = datetime.strftime(datetime.now(), settings.DATETIME_FORMAT)
@@ -178,35 +266,61 @@ class LocalJSONMetadata(object):
         }
 
     def get_directories(self, docrule, filter_date = None):
-        """Return List of directories with document files"""
-        #FIXME: seems to be rather slow for large number of docs :(
-        root = settings.DOCUMENT_ROOT
-        doccode_directory = os.path.join(root, docrule.get_directory_name())
-
+        """Return List of directories with document files
+
+        Read from docrule's MetadataManifest(), that is built from files in case it does not exist yet."""
+        manifest = MetadataManifest(docrule)
+        if not manifest.exists():
+            self.rebuild_index(docrule, only_missing=True)
+        created_day = None
+        if filter_date:
+            created_day = self.string_to_date(filter_date).date().isoformat()
         directories = []
-        for root, dirs, files in os.walk(doccode_directory):
-            for fil in files:
-                doc, extension = os.path.splitext(fil)
-                metadatas = None
-                first_metadata = None
-                if extension == '.json':
-                        metadatas = self.load_from_file(os.path.join(root, fil))[0]
-                        keys = metadatas.keys()
-                        keys.sort()
-                        first_metadata = metadatas[keys[0]]
-                if filter_date and first_metadata and first_metadata and \
-                        self.string_to_date(first_metadata['created_date']).date() != self.string_to_date(filter_date).date():
-                            continue
-                if metadatas and first_metadata:
-                    directories.append(
-                        (root, {
-                            'document_name': doc,
-                            'metadatas': metadatas,
-                            'first_metadata': first_metadata,
-                        })
-                    )
+        for root, doc, metadatas in manifest.documents(created_day=created_day):
+            directories.append(
+                (root, {
+                    'document_name': doc,
+                    'metadatas': metadatas,
+                    'first_metadata': self.get_first_metadata(metadatas),
+                })
+            )
         return directories
 
+    def get_documents_page(self, docrule, start=0, finish=None, order=None, searchword=None, limit_to=None,
+                           filter_date=None, cursor=None):
+        """Returns (names, next page cursor) of a sorted and filtered documents list
+
+        Sorting, filtering and pagination are done by docrule's MetadataManifest() query,
+        so only the requested page is read. Next page cursor is None for the last page.
+
+        @param start: number of documents to skip (ignored with cursor)
+        @param finish: index of document to stop at, page size is finish - start
+        @param order: 'created_date', 'name' or 'natural' (name with numbers compared by value)
+        @param limit_to: list of names to limit documents to (e.g. names of tagged documents)
+        @param cursor: next page cursor returned with previous page (raises ValueError if wrong)
+        Raises ValueError for unknown order too."""
+        if order not in ORDER_COLUMNS:
+            raise ValueError('Unknown documents list order: %s' % order)
+        manifest = MetadataManifest(docrule)
+        if not manifest.exists():
+            self.rebuild_index(docrule, only_missing=True)
+        created_day = None
+        if filter_date:
+            created_day = self.string_to_date(filter_date).date().isoformat()
+        after = None
+        if cursor:
+            after = decode_cursor(cursor, order)
+            start = 0
+        limit = None
+        if finish is not None:
+            limit = max(finish - start, 0)
+        rows = manifest.page(order=order, created_day=created_day, searchword=searchword, names=limit_to,
+                             offset=start, limit=limit, after=after)
+        next_cursor = None
+        if rows and limit and len(rows) == limit:
+            next_cursor = encode_cursor(order, rows[-1][1], rows[-1][0])
+        return [row[0] for row in rows], next_cursor
+
     def get_metadatas(self, docrule):
         """
         Return List of directories with document files
@@ -232,7 +346,8 @@ class LocalJSONMetadata(object):
         document.set_filename(document.old_name_code)
         # Converting file revision data for new document name
         old_directory = self.filesystem.get_or_create_document_directory(document)
-        fileinfo_db, new_revision = self.load_metadata(document.get_code(), old_directory)
+        old_docrule = document.get_docrule()
+        fileinfo_db, new_revision = self.load_metadata(document.get_code(), old_directory, max_age=0)
         new_metadata = self.convert_metadata_for_docrules(fileinfo_db, new_name)
         # Moving document object back
         document.docrule = None
@@ -244,14 +359,25 @@ class LocalJSONMetadata(object):
                 if k == 'compression_type':
                     new_metadata[str(new_revision - 1)][u'compression_type'] = v
                     fileinfo_db[str(new_revision - 1)][u'compression_type'] = v
+        # Revision files stored from document.file_revisions are processed by the new docrule plugins
+        for key in document.file_revisions:
+            if key in fileinfo_db:
+                compression_type = document.file_revisions_compression.get(key, None)
+                for metadata in (new_metadata[key], fileinfo_db[key]):
+                    if compression_type:
+                        metadata[u'compression_type'] = compression_type
+                    else:
+                        metadata.pop(u'compression_type', None)
         document.set_file_revisions_data(new_metadata.copy())
         self.write_metadata(fileinfo_db, document, new_directory)
         self.filesystem.remove_file(os.path.join(old_directory, document.old_name_code + '.json'))
+        self.unindex_document(old_docrule, document.old_name_code)
         return document
 
     def remove_metadata_file(self, directory, document):
         json_file = os.path.join(directory, '%s.json' % (document.get_code(),))
         self.filesystem.remove_file(json_file)
+        self.unindex_document(document.get_docrule(), document.get_code())
 
 class LocalJSONMetadataRetrievalPlugin(Plugin, BeforeRetrievalPluginPoint):
     title = "Filesystem Metadata Retrieval"
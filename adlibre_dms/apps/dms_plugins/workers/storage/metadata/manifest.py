@@ -0,0 +1,297 @@
+"""
+Module: Local file revision data manifest
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Index of documents stored with LocalJSONMetadata, kept in an SQLite database in the root directory of a docrule.
+Used to list documents of a docrule without walking the whole directory tree and reading every JSON file.
+It is maintained by LocalJSONMetadata on every write/removal and can be rebuilt with 'rebuild_index' command.
+
+Rebuild writes a new manifest into a temporary file and renames it into place, so readers never see it partly built.
+Documents changed while the manifest is being rebuilt (or is locked) are journaled and applied after the rebuild.
+"""
+
+import re
+import os
+import json
+import errno
+import fcntl
+import base64
+import sqlite3
+import logging
+import tempfile
+
+from django.conf import settings
+
+log = logging.getLogger('dms_plugins.workers.storage.metadata.manifest')
+
+__all__ = ['MetadataManifest', 'natural_key', 'encode_cursor', 'decode_cursor']
+
+MANIFEST_FILENAME = '.manifest.sqlite3'
+# Names of documents changed while manifest could not be updated, one JSON [name, directory] per line
+CHANGES_SUFFIX = '.changes'
+# Serializes rebuilds of a manifest
+LOCK_SUFFIX = '.lock'
+
+# Manifests with other schema version are rebuilt
+SCHEMA_VERSION = 2
+
+# Manifest files (path, inode) checked to have current schema in this process.
+# Manifests are created with schema by rebuild only, so it is not created on connect.
+_current_schema = set()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    name TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    created_day TEXT,
+    created_epoch REAL,
+    natural_key TEXT,
+    metadatas TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_created_day ON documents (created_day);
+CREATE INDEX IF NOT EXISTS documents_created_epoch ON documents (created_epoch, name);
+CREATE INDEX IF NOT EXISTS documents_natural_key ON documents (natural_key, name);
+"""
+
+INSERT = """INSERT OR REPLACE INTO documents (name, directory, created_day, created_epoch, natural_key, metadatas)
+VALUES (?, ?, ?, ?, ?, ?)"""
+
+# Available orders of documents list and their sort columns. Ties are ordered by name.
+ORDER_COLUMNS = {
+    None: 'name',
+    'name': 'name',
+    'created_date': 'created_epoch',
+    'natural': 'natural_key',
+}
+
+
+def natural_key(name):
+    """Returns a string that sorts names naturally, e.g. 'ADL-2' before 'ADL-10'"""
+    return re.sub(r'[0-9]+', lambda match: match.group(0).zfill(20), name)
+
+
+def encode_cursor(order, value, name):
+    """Returns opaque cursor of a position in a documents list"""
+    return base64.urlsafe_b64encode(json.dumps([order, value, name]))
+
+
+def decode_cursor(cursor, order):
+    """Returns (sort value, name) of a cursor. Raises ValueError for wrong cursors."""
+    try:
+        cursor_order, value, name = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('Wrong cursor: %s' % cursor)
+    if cursor_order != order:
+        raise ValueError('Cursor is made for other order: %s' % cursor_order)
+    return value, name
+
+
+class MetadataManifest(object):
+    """Documents index of a docrule"""
+    def __init__(self, docrule):
+        self.directory = os.path.join(settings.DOCUMENT_ROOT, docrule.get_directory_name())
+        self.path = os.path.join(self.directory, MANIFEST_FILENAME)
+
+    def exists(self):
+        """Checks manifest is built and has current schema (read once per manifest file)"""
+        try:
+            key = (self.path, os.stat(self.path).st_ino)
+        except OSError:
+            return False
+        if key in _current_schema:
+            return True
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            connection.close()
+        if version != SCHEMA_VERSION:
+            return False
+        _current_schema.add(key)
+        return True
+
+    def is_rebuilding(self):
+        """Checks manifest is being rebuilt (by this or another process)"""
+        try:
+            lock = open(self.path + LOCK_SUFFIX, 'r')
+        except IOError:
+            return False
+        try:
+            fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return True
+            raise
+        finally:
+            lock.close()
+        return False
+
+    def connect(self):
+        """Opens existing manifest (call exists() first)"""
+        return sqlite3.connect(self.path, timeout=30)
+
+    def drop(self):
+        """Removes manifest (e.g. when it can not be updated). It will be rebuilt on next listing."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def add(self, name, directory, metadatas, created_day, created_epoch):
+        """Adds or replaces a document in index
+
+        @param name: document code
+        @param directory: full path of document directory
+        @param metadatas: file revision data of a document
+        @param created_day: ISO date of the first revision of a document e.g. '2014-01-25'
+        @param created_epoch: creation time of the first revision of a document in seconds"""
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(INSERT, self.make_row(name, directory, metadatas, created_day, created_epoch))
+        finally:
+            connection.close()
+
+    def make_row(self, name, directory, metadatas, created_day, created_epoch):
+        return name, directory, created_day, created_epoch, natural_key(name), json.dumps(metadatas)
+
+    def remove(self, name):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM documents WHERE name = ?', (name, ))
+        finally:
+            connection.close()
+
+    def documents(self, created_day=None):
+        """Returns list of (directory, name, metadatas) of indexed documents
+
+        @param created_day: ISO date to filter documents by their first revision creation"""
+        connection = self.connect()
+        try:
+            query = 'SELECT directory, name, metadatas FROM documents'
+            params = ()
+            if created_day:
+                query += ' WHERE created_day = ?'
+                params = (created_day, )
+            return [(row[0], row[1], json.loads(row[2])) for row in connection.execute(query, params)]
+        finally:
+            connection.close()
+
+    def page(self, order=None, created_day=None, searchword=None, names=None, offset=0, limit=None, after=None):
+        """Returns a page of documents list as [(name, sort value), ...]
+
+        @param order: one of ORDER_COLUMNS keys
+        @param created_day: ISO date to filter documents by their first revision creation
+        @param searchword: part of document name (case insensitive)
+        @param names: list names to limit documents to
+        @param offset: number of documents to skip
+        @param limit: page size (None for all the documents)
+        @param after: (sort value, name) of the last document of previous page (keyset pagination)"""
+        column = ORDER_COLUMNS[order]
+        conditions, params = [], []
+        connection = self.connect()
+        try:
+            if created_day:
+                conditions.append('created_day = ?')
+                params.append(created_day)
+            if searchword:
+                conditions.append("name LIKE ? ESCAPE '\\'")
+                escaped = searchword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                params.append('%' + escaped + '%')
+            if names:
+                connection.execute('CREATE TEMP TABLE limit_names (name TEXT PRIMARY KEY)')
+                connection.executemany('INSERT OR IGNORE INTO limit_names VALUES (?)', ((n, ) for n in names))
+                conditions.append('name IN (SELECT name FROM limit_names)')
+            if after is not None:
+                conditions.append('(%s > ? OR (%s = ? AND name > ?))' % (column, column))
+                params.extend([after[0], after[0], after[1]])
+            query = 'SELECT name, %s FROM documents' % column
+            if conditions:
+                query += ' WHERE ' + ' AND '.join(conditions)
+            query += ' ORDER BY %s, name LIMIT ? OFFSET ?' % column
+            params.extend([-1 if limit is None else limit, offset])
+            return connection.execute(query, params).fetchall()
+        finally:
+            connection.close()
+
+    def record_change(self, name, directory):
+        """Journals a document change that is not written into manifest. Applied on next rebuild.
+
+        @param directory: full path of document directory (None for removed documents)"""
+        journal = open(self.path + CHANGES_SUFFIX, 'a')
+        try:
+            journal.write(json.dumps([name, directory]) + '\n')
+        finally:
+            journal.close()
+
+    def take_changes(self):
+        """Returns journaled changes [(name, directory), ...] and clears the journal"""
+        changes_path = self.path + CHANGES_SUFFIX
+        taken_path = changes_path + '.%s' % os.getpid()
+        try:
+            # Changes journaled from now on are left for the next rebuild
+            os.rename(changes_path, taken_path)
+        except OSError:
+            return []
+        changes = []
+        try:
+            for line in open(taken_path).read().splitlines():
+                try:
+                    name, directory = json.loads(line)
+                except ValueError:
+                    continue
+                if not (name, directory) in changes:
+                    changes.append((name, directory))
+        finally:
+            os.remove(taken_path)
+        return changes
+
+    def rebuild(self, entries, reload_entry, only_missing=False):
+        """Replaces index with a new one built from entries. Returns number of documents (None if not rebuilt).
+
+        @param entries: iterable of (name, directory, metadatas, created_day, created_epoch)
+        @param reload_entry: callable(name, directory) returning entry of a changed document or None if it is removed
+        @param only_missing: skip rebuild if a manifest is built by another process meanwhile"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        lock = open(self.path + LOCK_SUFFIX, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if only_missing and self.exists():
+                return None
+            count = self.build(entries)
+            # Documents written while the manifest was being built (after their directory was walked)
+            for name, directory in self.take_changes():
+                entry = reload_entry(name, directory)
+                if entry:
+                    self.add(*entry)
+                else:
+                    self.remove(name)
+        finally:
+            lock.close()
+        log.info('Manifest %s rebuilt with %s documents' % (self.path, count))
+        return count
+
+    def build(self, entries):
+        """Writes a new manifest into a temporary file and renames it into place"""
+        handle, tmp_path = tempfile.mkstemp(prefix=MANIFEST_FILENAME + '.', suffix='.building', dir=self.directory)
+        os.close(handle)
+        try:
+            connection = sqlite3.connect(tmp_path)
+            try:
+                connection.executescript(SCHEMA)
+                with connection:
+                    connection.executemany(INSERT, (self.make_row(*entry) for entry in entries))
+                connection.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+                count = connection.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+            finally:
+                connection.close()
+            os.rename(tmp_path, self.path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return count
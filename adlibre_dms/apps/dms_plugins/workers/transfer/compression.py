@@ -0,0 +1,153 @@
+"""
+Module: Compression codecs
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Registry of compression codecs used by compression plugins.
+Codec name is stored as 'compression_type' in file revision data, so retrieval always uses the codec
+a revision was compressed with, whatever the current plugin configuration is.
+
+GZIP (zlib, default) and BZ2 come with Python. ZSTD and LZ4 are registered if 'zstandard' or 'lz4'
+packages are installed.
+"""
+
+import bz2
+import zlib
+import logging
+
+log = logging.getLogger('dms_plugins.workers.transfer.compression')
+
+__all__ = ['Codec', 'register_codec', 'get_codec', 'get_codec_names', 'DEFAULT_CODEC']
+
+DEFAULT_CODEC = 'GZIP'
+
+CODECS = {}
+
+
+class Codec(object):
+    """Streaming compression codec. Levels are 1 (fastest) to 9 (best compression) for every codec."""
+    name = None
+    description = ''
+
+    def compressobj(self, level):
+        """Returns an object with compress(data) and flush() methods"""
+        raise NotImplementedError
+
+    def decompressobj(self):
+        """Returns an object with decompress(data) and flush() methods"""
+        raise NotImplementedError
+
+    def compress(self, data, level):
+        compressor = self.compressobj(level)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = self.decompressobj()
+        return decompressor.decompress(data) + decompressor.flush()
+
+
+class NoFlushDecompressor(object):
+    """Adds flush() to decompressor objects that return all data from decompress()"""
+    def __init__(self, decompressor):
+        self.decompressor = decompressor
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        return ''
+
+
+class ZlibCodec(Codec):
+    # Name kept for revisions stored by older versions of Gzip plugin
+    name = 'GZIP'
+    description = 'zlib (deflate), moderate speed and ratio'
+
+    def compressobj(self, level):
+        return zlib.compressobj(level)
+
+    def decompressobj(self):
+        return zlib.decompressobj()
+
+
+class Bz2Codec(Codec):
+    name = 'BZ2'
+    description = 'bzip2, slow, better ratio for text documents'
+
+    def compressobj(self, level):
+        return bz2.BZ2Compressor(level)
+
+    def decompressobj(self):
+        return NoFlushDecompressor(bz2.BZ2Decompressor())
+
+
+class ZstdCodec(Codec):
+    name = 'ZSTD'
+    description = 'Zstandard, fast with good ratio'
+
+    def __init__(self, module):
+        self.module = module
+
+    def compressobj(self, level):
+        return self.module.ZstdCompressor(level=level).compressobj()
+
+    def decompressobj(self):
+        return NoFlushDecompressor(self.module.ZstdDecompressor().decompressobj())
+
+
+class Lz4Compressor(object):
+    """LZ4 frame compressor with the compressobj() interface"""
+    def __init__(self, module, level):
+        self.compressor = module.LZ4FrameCompressor(compression_level=level)
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, ''
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+
+class Lz4Codec(Codec):
+    name = 'LZ4'
+    description = 'LZ4 frame, fastest, lower ratio'
+
+    def __init__(self, module):
+        self.module = module
+
+    def compressobj(self, level):
+        return Lz4Compressor(self.module, level)
+
+    def decompressobj(self):
+        return NoFlushDecompressor(self.module.LZ4FrameDecompressor())
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    """Returns codec registered with a name. Raises KeyError for unknown (or not installed) codecs."""
+    return CODECS[name]
+
+
+def get_codec_names():
+    return sorted(CODECS.keys())
+
+
+register_codec(ZlibCodec())
+register_codec(Bz2Codec())
+
+try:
+    import zstandard
+    register_codec(ZstdCodec(zstandard))
+except ImportError:
+    log.debug('zstandard is not installed, ZSTD codec is disabled')
+
+try:
+    import lz4.frame
+    register_codec(Lz4Codec(lz4.frame))
+except ImportError:
+    log.debug('lz4 is not installed, LZ4 codec is disabled')
@@ -5,36 +5,83 @@ Copyright: Adlibre Pty Ltd 2013
 License: See LICENSE for license information
 """
 
-import zlib
+import os
+import logging
 import tempfile
 
+from django import forms
+from django.conf import settings
+
 from dms_plugins.pluginpoints import BeforeStoragePluginPoint, BeforeRetrievalPluginPoint, BeforeUpdatePluginPoint
-from dms_plugins.workers import Plugin
+from dms_plugins.workers import Plugin, PluginError
+from dms_plugins.workers.transfer.compression import get_codec, get_codec_names, DEFAULT_CODEC
+from core.streams import StreamStage
+
+log = logging.getLogger('dms_plugins.workers.transfer.gzip')
+
+CHUNK_SIZE = getattr(settings, 'DMS_FILE_CHUNK_SIZE', 64 * 1024)
+# Files are stored uncompressed if compression of their first SAMPLE_SIZE bytes saves less than MIN_SAVING of it
+SAMPLE_SIZE = getattr(settings, 'DMS_COMPRESSION_SAMPLE_SIZE', 64 * 1024)
+MIN_SAVING = getattr(settings, 'DMS_COMPRESSION_MIN_SAVING', 0.1)
+
+# zlib.compress() default (levels are 1-9 for every codec)
+DEFAULT_LEVEL = 6
+
+
+class CompressionForm(forms.Form):
+    """Form for configuration of compression plugins options in DMS config"""
+    CODECS = [(name, name) for name in get_codec_names()]
+    LEVELS = [(str(level), str(level)) for level in range(1, 10)]
+    codec = forms.ChoiceField(choices=CODECS, help_text='Codec new files are compressed with')
+    level = forms.ChoiceField(choices=LEVELS, help_text='1 is the fastest, 9 compresses best')
+
+    def __init__(self, options, *args, **kwargs):
+        self.options = options
+        super(CompressionForm, self).__init__(*args, **kwargs)
+
+    def save(self, commit=True):
+        """Stores settings for a plugin
+        @param commit: execute save()"""
+        for option in self.options:
+            option.value = self.cleaned_data[option.name]
+            if commit:
+                option.save()
+        return self.options
 
 
 class GzipOnStorePlugin(Plugin, BeforeStoragePluginPoint):
     title = 'Gzip Plugin on storage'
-    has_configuration = True  # TODO: configure
-    description = "Compresses files before storing"
+    has_configuration = True
+    description = "Compresses files before storing (with a configurable codec)"
     plugin_type = "storage_processing"
+    codec = DEFAULT_CODEC
+    level = DEFAULT_LEVEL
+    configurable_fields = ['codec', 'level', ]
+    form = CompressionForm
 
     def work(self, document):
-        return Gzip().work_store(document)
+        docrule = document.get_docrule()
+        return Gzip(self.get_option('codec', docrule), self.get_option('level', docrule)).work_store(document)
 
 
 class GzipOnUpdatePlugin(Plugin, BeforeUpdatePluginPoint):
     title = 'Gzip Plugin on update'
-    has_configuration = True  # TODO: configure
-    description = "Compresses files on updating file"
+    has_configuration = True
+    description = "Compresses files on updating file (with a configurable codec)"
     plugin_type = "update_processing"
+    codec = DEFAULT_CODEC
+    level = DEFAULT_LEVEL
+    configurable_fields = ['codec', 'level', ]
+    form = CompressionForm
 
     def work(self, document):
-        return Gzip().work_store(document)
+        docrule = document.get_docrule()
+        return Gzip(self.get_option('codec', docrule), self.get_option('level', docrule)).work_store(document)
 
 
 class GzipOnRetrievePlugin(Plugin, BeforeRetrievalPluginPoint):
     title = 'Gzip Plugin on retrieval'
-    has_configuration = True  # TODO: configure
+    has_configuration = False
     description = "Decompresses files on retrieval"
     plugin_type = "retrieval_processing"
 
@@ -42,41 +89,154 @@ class GzipOnRetrievePlugin(Plugin, BeforeRetrievalPluginPoint):
         return Gzip().work_retrieve(document)
 
 
+class CompressStage(StreamStage):
+    """Compresses file chunks with a codec"""
+    def __init__(self, codec, level=DEFAULT_LEVEL):
+        self.compressor = codec.compressobj(level)
+        self.size = 0
+
+    def process(self, chunk):
+        self.size += len(chunk)
+        return self.compressor.compress(chunk)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self, document):
+        # Lets retrieval tell file size without decompressing it
+        document.update_current_file_revision_data({'uncompressed_size': self.size})
+
+
+class DecompressingFile(object):
+    """Read only file object decompressing a compressed file object on the fly.
+
+    Only the data being read is decompressed, so memory usage does not depend on file size.
+    Seeking backwards restarts decompression from the beginning of the file."""
+    def __init__(self, file_obj, codec, size=None, chunk_size=CHUNK_SIZE):
+        """
+        @param file_obj: compressed file object
+        @param codec: compression.Codec() file is compressed with
+        @param size: uncompressed size if known (calculated by decompressing file otherwise)"""
+        self.file_obj = file_obj
+        self.codec = codec
+        self.size = size
+        self.chunk_size = chunk_size
+        self.name = getattr(file_obj, 'name', None)
+        self.rewind()
+
+    def rewind(self):
+        self.file_obj.seek(0)
+        self.decompressor = self.codec.decompressobj()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+    def fill(self, size):
+        """Decompresses data into buffer till it has size bytes or file ends"""
+        while not self.eof and (size is None or len(self.buffer) < size):
+            chunk = self.file_obj.read(self.chunk_size)
+            if chunk:
+                data = self.decompressor.decompress(chunk)
+            else:
+                data = self.decompressor.flush()
+                self.eof = True
+            self.buffer += data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = None
+        self.fill(size)
+        if size is None:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            if self.size is None:
+                self.size = self.skip_to(None)
+            offset += self.size
+        elif whence == os.SEEK_CUR:
+            offset += self.position
+        if offset < self.position:
+            self.rewind()
+        self.skip_to(offset)
+
+    def skip_to(self, offset):
+        """Decompresses and drops data till offset (or end of file for None). Returns the new position."""
+        while offset is None or self.position < offset:
+            size = self.chunk_size if offset is None else min(self.chunk_size, offset - self.position)
+            if not self.read(size):
+                break
+        return self.position
+
+    def close(self):
+        self.file_obj.close()
+
+    def __iter__(self):
+        chunk = self.read(self.chunk_size)
+        while chunk:
+            yield chunk
+            chunk = self.read(self.chunk_size)
+
+
 class Gzip(object):
-    compression_type = 'GZIP'
+    """Compression worker. Named after its original (and default) codec."""
+    def __init__(self, codec=DEFAULT_CODEC, level=DEFAULT_LEVEL):
+        self.compression_type = codec or DEFAULT_CODEC
+        self.level = int(level or DEFAULT_LEVEL)
 
-    def _work(self, file_obj, method):
+    def get_codec(self, compression_type=None):
+        try:
+            return get_codec(compression_type or self.compression_type)
+        except KeyError:
+            raise PluginError("Compression codec %s is not available" % (compression_type or self.compression_type), 500)
+
+    def is_compressible(self, file_obj):
+        """Checks compression of the start of a file saves enough to be worth it (e.g. not a JPEG or a PDF)"""
+        file_obj.seek(0)
+        sample = file_obj.read(SAMPLE_SIZE)
         file_obj.seek(0)
+        if not sample:
+            return False
+        compressed = self.get_codec().compress(sample, self.level)
+        return len(compressed) <= len(sample) * (1 - MIN_SAVING)
+
+    def compress_file(self, file_obj):
+        """Returns temporary file with compressed content of a file object. Compressed in chunks."""
+        compressor = self.get_codec().compressobj(self.level)
         tmp_file_obj = tempfile.TemporaryFile()
-        if method == 'STORAGE':
-            compressed_file = zlib.compress(file_obj.read())
-            tmp_file_obj.write(compressed_file)
-            tmp_file_obj.seek(0)
-        elif method == 'RETRIEVAL':
-            content = file_obj.read()
-            before = len(content)
-            decompressed = zlib.decompress(content)
-            after = len(decompressed)
-            tmp_file_obj.write(decompressed)
-            tmp_file_obj.seek(0)
+        file_obj.seek(0)
+        chunk = file_obj.read(CHUNK_SIZE)
+        while chunk:
+            tmp_file_obj.write(compressor.compress(chunk))
+            chunk = file_obj.read(CHUNK_SIZE)
+        tmp_file_obj.write(compressor.flush())
+        tmp_file_obj.seek(0)
         return tmp_file_obj
 
     def work_store(self, document):
         # Treating as multiple revisions object
         if document.file_revisions:
-            processing_document = None
             compressed_file_revisions = {}
             # Updating document to be compressed from an old document
             for file_revision, file_obj in document.file_revisions.iteritems():
-                compressed_file = self._work(file_obj, method='STORAGE')
-                compressed_file_revisions[file_revision] = compressed_file
+                compressed_file_revisions[file_revision] = self.compress_file(file_obj)
+                # Recorded for each of these revisions on metadata migration (current file may be stored raw)
+                document.file_revisions_compression[file_revision] = self.compression_type
             document.file_revisions = compressed_file_revisions
-            document.file_revisions['compression_type'] = self.compression_type
-            document.update_current_file_revision_data({'compression_type': self.compression_type})
-        processing_document = document.get_file_obj()
-        if processing_document:
-            compressed_file = self._work(processing_document, method='STORAGE')
-            document.set_file_obj(compressed_file)
+        # Compressed in a single pass over the file with other stream stages
+        if document.has_file_obj():
+            # Sampling original file (not processed by pending stream stages)
+            file_obj = document.file_obj or document.get_file_obj()
+            if not self.is_compressible(file_obj):
+                log.debug('Gzip: storing %s uncompressed, compression ratio is poor' % document.get_code())
+                return document
+            document.add_stream_stage(CompressStage(self.get_codec(), self.level))
             document.update_current_file_revision_data({'compression_type': self.compression_type})
         return document
 
@@ -84,12 +244,16 @@ class Gzip(object):
         # Doing nothing for only_metadata option
         if document.get_option('only_metadata') or document.get_option('indexing_data'):
             return document
-        if document.get_current_file_revision_data().get('compression_type', None) == self.compression_type:
-            try:
-                decompressed_file = self._work(document.get_file_obj(), method='RETRIEVAL')
-            except:
-                raise
-                #raise PluginError("Couldn't decompress file: was it compressed when stored?")
+        revision_data = document.get_current_file_revision_data() or {}
+        compression_type = revision_data.get('compression_type', None)
+        if compression_type:
+            if not document.get_file_obj():
+                raise PluginError("No file to decompress for %s" % document.get_code(), 404)
+            decompressed_file = DecompressingFile(
+                document.get_file_obj(),
+                self.get_codec(compression_type),
+                size=revision_data.get('uncompressed_size', None)
+            )
             document.set_file_obj(decompressed_file)
             document.decompressed_file = decompressed_file
         return document
@@ -0,0 +1,210 @@
+"""
+Module: DMS page previews rendering and cache
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Page previews are rendered once per (page, format) at the largest of DMS_PREVIEW_SIZES,
+every other size is scaled down from that raster. Requested sizes are rounded up to a configured size,
+so previews of a document are limited to a known set of files.
+
+Previews are stored in 'thumbnails_storage' directory of a document (removed with document changes)
+and listed in an SQLite index with their last access time. Least recently used previews are removed
+when total size of previews is over DMS_PREVIEW_CACHE_SIZE bytes.
+Access times are collected in memory and written in one transaction every TOUCH_INTERVAL seconds (or with new previews).
+"""
+
+import os
+import math
+import time
+import sqlite3
+import logging
+import threading
+import subprocess
+
+import ghostscript
+from django.conf import settings
+
+log = logging.getLogger('dms_plugins.workers.transfer.previews')
+
+__all__ = ['PreviewCache', 'preview_cache', 'render_previews', 'get_preview_size', 'negotiate_preview_format']
+
+# Longest side of previews in pixels. First one is the default (search results thumbnail).
+PREVIEW_SIZES = getattr(settings, 'DMS_PREVIEW_SIZES', (64, 128, 256, 512, 1024))
+# Image formats previews are available in. First one is the default. 'webp' needs ImageMagick built with WebP.
+PREVIEW_FORMATS = getattr(settings, 'DMS_PREVIEW_FORMATS', ('png', 'jpeg'))
+CACHE_SIZE = getattr(settings, 'DMS_PREVIEW_CACHE_SIZE', 512 * 1024 * 1024)
+CACHE_DB = getattr(settings, 'DMS_PREVIEW_CACHE_DB', None) or os.path.join(settings.DOCUMENT_ROOT, '.previews.sqlite3')
+# Seconds access times of previews are collected before they are written (saves a write per request)
+TOUCH_INTERVAL = 60
+# Long side of a Letter page in points (A4 is longer). PDF pages are rasterized at a resolution fitting it into
+# the largest preview size, so previews of common pages are scaled down and keep the page aspect ratio.
+PAGE_LONG_SIDE = 792
+
+MIMETYPES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS previews (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS previews_accessed ON previews (accessed);
+"""
+
+
+def get_preview_size(size=None):
+    """Returns smallest configured size that is not less than requested one (largest one for bigger sizes)"""
+    sizes = sorted(PREVIEW_SIZES)
+    if size is None:
+        return PREVIEW_SIZES[0]
+    for preview_size in sizes:
+        if preview_size >= size:
+            return preview_size
+    return sizes[-1]
+
+
+def negotiate_preview_format(accept=''):
+    """Returns first configured format a client accepts by its HTTP Accept header (default format otherwise)"""
+    accept = accept or ''
+    for preview_format in PREVIEW_FORMATS:
+        if MIMETYPES[preview_format] in accept:
+            return preview_format
+    return PREVIEW_FORMATS[0]
+
+
+def render_previews(source_path, mimetype, page, outputs, raster_path):
+    """Rasterizes a page of a source file once and writes previews of all sizes from it
+
+    @param source_path: PDF or image file
+    @param page: page number starting from 1 (images have only one)
+    @param outputs: list of (size, path) of previews to write. Format is taken from path extension.
+    @param raster_path: temporary file for page raster at the largest size"""
+    largest = max(size for size, path in outputs)
+    try:
+        if mimetype == 'application/pdf':
+            args = [
+                'gs',
+                '-q',  # Quiet
+                '-dSAFER',
+                '-sDEVICE=png16m',  # Type. PNG used
+                '-r%s' % int(math.ceil(largest * 72.0 / PAGE_LONG_SIDE)),  # Page size kept, scaled by resolution
+                '-dBATCH',  # Quit GS after converting
+                '-dNOPAUSE',  # Do not stop on pages
+                '-dFirstPage=%s' % page,
+                '-dLastPage=%s' % page,
+                '-sOutputFile=%s' % raster_path,  # Destination
+                '%s' % source_path,  # Source
+            ]
+            ghostscript.Ghostscript(*args)
+        elif page == 1:
+            subprocess.check_call(['convert', source_path + '[0]', '-resize', '%sx%s>' % (largest, largest), raster_path])
+        if not os.path.exists(raster_path):
+            raise ValueError('No page %s in %s' % (page, source_path))
+        for size, path in outputs:
+            tmp_path = path + '.part'
+            # Explicit format prefix as temporary file has no image extension
+            destination = '%s:%s' % (os.path.splitext(path)[1][1:], tmp_path)
+            subprocess.check_call(['convert', raster_path, '-resize', '%sx%s>' % (size, size), '-strip', destination])
+            # Preview appears complete for readers
+            os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(raster_path):
+            os.unlink(raster_path)
+    return [path for size, path in outputs]
+
+
+class PreviewCache(object):
+    """Index of preview files removing least recently used ones over a total size budget"""
+    def __init__(self, db_path=CACHE_DB, max_size=CACHE_SIZE):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.schema_ready = False
+        # Access times not written yet {path: time}
+        self.accessed = {}
+        self.written = time.time()
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # Transactions are started explicitly with BEGIN IMMEDIATE to serialize writes of processes
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        if not self.schema_ready:
+            connection.executescript(SCHEMA)
+            self.schema_ready = True
+        return connection
+
+    def execute_locked(self, function, *args):
+        """Runs function(connection, *args) in a write locked transaction"""
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = function(connection, *args)
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+            return result
+        finally:
+            connection.close()
+
+    def add(self, paths):
+        """Indexes new preview files and removes least recently used ones over the budget"""
+        now = time.time()
+        rows = [(path, os.path.getsize(path), now) for path in paths if os.path.exists(path)]
+        return self.execute_locked(self._add, rows, self.take_access_times())
+
+    def _add(self, connection, rows, accessed):
+        self._write_access_times(connection, accessed)
+        connection.executemany('INSERT OR REPLACE INTO previews (path, size, accessed) VALUES (?, ?, ?)', rows)
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM previews').fetchone()[0]
+        evicted = []
+        if total > self.max_size:
+            for path, size in connection.execute('SELECT path, size FROM previews ORDER BY accessed').fetchall():
+                if total <= self.max_size:
+                    break
+                evicted.append(path)
+                total -= size
+            connection.executemany('DELETE FROM previews WHERE path = ?', [(path, ) for path in evicted])
+        for path in evicted:
+            if os.path.exists(path):
+                os.unlink(path)
+        return evicted
+
+    def take_access_times(self):
+        with self.lock:
+            accessed, self.accessed, self.written = self.accessed, {}, time.time()
+        return accessed
+
+    def _write_access_times(self, connection, accessed):
+        connection.executemany(
+            'UPDATE previews SET accessed = ? WHERE path = ?', [(when, path) for path, when in accessed.iteritems()]
+        )
+
+    def touch(self, path):
+        """Marks preview used. Access times are written together at most once in TOUCH_INTERVAL per process."""
+        now = time.time()
+        with self.lock:
+            self.accessed[path] = now
+            if now - self.written < TOUCH_INTERVAL:
+                return
+        accessed = self.take_access_times()
+        try:
+            self.execute_locked(self._write_access_times, accessed)
+        except sqlite3.Error, e:
+            # Access time is a hint only
+            log.warning('PreviewCache: can not update access times of %s previews: %s' % (len(accessed), e))
+
+    def forget_directory(self, directory):
+        """Drops index entries of previews in a removed directory"""
+        prefix = directory.rstrip(os.sep) + os.sep
+        self.execute_locked(lambda connection: connection.execute(
+            'DELETE FROM previews WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)
+        ))
+
+preview_cache = PreviewCache()
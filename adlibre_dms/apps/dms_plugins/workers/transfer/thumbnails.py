@@ -5,57 +5,247 @@ Project: Adlibre DMS
 Copyright: Adlibre Pty Ltd 2013
 License: See LICENSE for license information
 Author: Iurii Garmash
+
+Thumbnails (page previews of DMS_PREVIEW_SIZES in DMS_PREVIEW_FORMATS, see previews.py) are generated
+in background by a pool of DMS_THUMBNAIL_WORKERS processes (per web process) if it is configured,
+within requests otherwise.
+With workers configured, default previews of new files are copied while the file is stored (before storage
+and update plugins) and queued once it is stored (storage and update plugins), so they are usually ready
+before first request. Without workers they are generated on first request, not within uploads.
+Requests for a preview that is not ready yet get a placeholder image at once and queue it if needed.
+
+A '.pending' marker file exists while previews of a page are queued, so other processes do not queue them again.
+Previews that failed are not retried till the document changes.
 """
 import os
+import time
+import errno
+import base64
 import shutil
-import ghostscript
+import sqlite3
 import logging
+import threading
 import traceback
+import multiprocessing
+
+from django.conf import settings
 
 from dms_plugins.workers.storage.local import LocalFilesystemManager
 
-from dms_plugins.pluginpoints import BeforeRetrievalPluginPoint, BeforeRemovalPluginPoint, BeforeUpdatePluginPoint
+from dms_plugins.pluginpoints import BeforeRetrievalPluginPoint, BeforeRemovalPluginPoint, BeforeUpdatePluginPoint,\
+    BeforeStoragePluginPoint, StoragePluginPoint, UpdatePluginPoint
 from dms_plugins.workers import Plugin, PluginError
+from dms_plugins.workers.transfer.previews import render_previews, preview_cache, get_preview_size, \
+    PREVIEW_SIZES, PREVIEW_FORMATS
+from core.streams import StreamStage
 
 log = logging.getLogger('dms')
 
+CHUNK_SIZE = getattr(settings, 'DMS_FILE_CHUNK_SIZE', 64 * 1024)
+# Background thumbnail generation processes (0 to generate thumbnails in request)
+POOL_SIZE = getattr(settings, 'DMS_THUMBNAIL_WORKERS', 0)
+# Maximum of thumbnails queued by a process. Thumbnails over it are queued again on request.
+QUEUE_SIZE = getattr(settings, 'DMS_THUMBNAIL_QUEUE_SIZE', 100)
+# Seconds a pending thumbnail is waited for before it is queued again (e.g. process generating it was killed)
+PENDING_TIMEOUT = getattr(settings, 'DMS_THUMBNAIL_TIMEOUT', 120)
+
+SUPPORTED_MIMETYPES = ('application/pdf', 'image/jpeg')
+
+# Transparent 1x1 PNG returned while thumbnail is generated
+PLACEHOLDER = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAAC0lEQVR4nGNgAAIAAAUAAXpeqz8AAAAASUVORK5CYII=')
+
+
+def generate_previews(job, source_path, remove_source, mimetype, page, outputs):
+    """Renders previews of a document page and indexes them in preview cache. Runs in a pool process.
+
+    Marks previews failed (job + '.failed') if rendering fails.
+    @param job: path prefix of the page previews in a format (pending and failed markers names)
+    @param remove_source: source is a temporary copy of a document file"""
+    try:
+        try:
+            paths = render_previews(source_path, mimetype, page, outputs, job + '.raster.png')
+            preview_cache.add(paths)
+            return paths
+        except Exception, e:
+            log.error('Thumbnail generation error for %s: %s' % (job, e))
+            try:
+                open(job + '.failed', 'w').close()
+            except IOError:
+                # Thumbnails directory removed meanwhile (document changed)
+                pass
+    finally:
+        discard_job(job, source_path, remove_source)
+
+
+def discard_job(job, source_path, remove_source):
+    """Removes pending marker and temporary source copy of a job"""
+    paths = [job + '.pending']
+    if remove_source:
+        paths.append(source_path)
+    for path in paths:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+class ThumbnailPool(object):
+    """Bounded pool of processes generating thumbnails in background"""
+    def __init__(self, processes=POOL_SIZE, queue_size=QUEUE_SIZE):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.pool = None
+        self.pid = None
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        # Pool of a parent process is not usable in a forked process
+        if self.pool is None or self.pid != os.getpid():
+            self.pool = multiprocessing.Pool(self.processes)
+            self.pid = os.getpid()
+            self.pending = {}
+        return self.pool
+
+    def submit(self, job, *args):
+        """Queues generate_previews(job, *args). Generates previews at once without workers configured.
+
+        Returns False (and discards the job) if queue is full."""
+        if not self.processes:
+            generate_previews(job, *args)
+            return True
+        with self.lock:
+            pool = self.get_pool()
+            self.forget_finished()
+            if job in self.pending:
+                return True
+            if len(self.pending) >= self.queue_size:
+                log.warning('Thumbnail queue is full, skipping %s' % job)
+                discard_job(job, args[0], args[1])
+                return False
+            self.pending[job] = pool.apply_async(generate_previews, (job, ) + args)
+        return True
+
+    def forget_finished(self):
+        for job, result in self.pending.items():
+            if result.ready():
+                del self.pending[job]
+
+    def wait(self, timeout=None):
+        """Waits for thumbnails queued by this process (e.g. in tests or management commands)"""
+        with self.lock:
+            results = self.pending.values()
+        for result in results:
+            result.wait(timeout)
+        with self.lock:
+            self.forget_finished()
+
+thumbnail_pool = ThumbnailPool()
+
+
+class ThumbnailSourceStage(StreamStage):
+    """Saves a copy of document file for thumbnail generation while the file is processed for storage
+
+    Job is queued with submit() by storage plugins once the file is stored, aborted if it is not."""
+    def __init__(self, handler, job, page, outputs):
+        self.handler = handler
+        self.job = job
+        self.page = page
+        self.outputs = outputs
+        self.source_path = job + '.src'
+        self.mimetype = None
+        # Opened with the first chunk, so nothing is left behind if stages are not run
+        self.source = None
+
+    def process(self, chunk):
+        if self.source is None:
+            self.source = open(self.source_path, 'wb')
+        self.source.write(chunk)
+        return chunk
+
+    def finish(self, document):
+        if self.source is None:
+            # Empty file
+            self.abort()
+            return
+        self.source.close()
+        self.mimetype = document.get_mimetype()
+        document.thumbnail_jobs.append(self)
+
+    def submit(self):
+        self.handler.pool.submit(self.job, self.source_path, True, self.mimetype, self.page, self.outputs)
+
+    def abort(self):
+        if self.source is not None:
+            self.source.close()
+        discard_job(self.job, self.source_path, True)
+
 
 class ThumbnailsFilesystemHandler(object):
     """Handles a thumbnails interaction
 
-    Implemented in a lazy way.
-    Thumbnail is created on first request
+    Thumbnail is queued for generation on storage (or first request)
     and stored for farther usage afterwards withing that code directory
     """
 
     def __init__(self):
         self.filesystem = LocalFilesystemManager()
         self.thumbnail_folder = 'thumbnails_storage'
-        self.thumb_size = (64, 64)  # px, px (pixels size - width, height)
+        self.pool = thumbnail_pool
 
     def retrieve_thumbnail(self, document):
-        """Handles retrieval of thumbnail and optional generation of it"""
-        thumbnail_location, thumbnail_directory = self.get_thumbnail_path(document)
-        if not os.path.exists(thumbnail_location + '.png'):
-            # TODO: remove this try/except block and stabilize
-            # Operations are not stable due to plugin usage of external tools that are under testing now
-            try:
-                # To write a mimetype thumbnail handler add similar code  and create your function
-                log.debug('mimetype for thumbnail: %s' % document.mimetype)
-                if not document.mimetype:
-                    raise PluginError('ThumbnailsFilesystemHandler missconfiguration. Mimetype = None', 404)
-                if document.mimetype == 'application/pdf':
-                    self.generate_thumbnail_from_pdf(document)
-                if document.mimetype == 'image/jpeg':
-                    self.generate_thumbnail_from_jpeg(document)
-                document.thumbnail = open(thumbnail_location + '.png').read()
-            except Exception, e:
-                traceback.print_exc()
-                error = 'ThumbnailsFilesystemHandler.generate_thumbnail method error: %s' % e
-                log.error(error)
-                raise PluginError(error, 404)
-        else:
-            document.thumbnail = open(thumbnail_location + '.png').read()
+        """Handles retrieval of a preview, returning a placeholder if it is not generated yet
+
+        Preview is selected with 'preview_size', 'preview_page' and 'preview_format' document options."""
+        size = get_preview_size(document.get_option('preview_size'))
+        page = document.get_option('preview_page') or 1
+        preview_format = document.get_option('preview_format') or PREVIEW_FORMATS[0]
+        job, paths = self.get_preview_paths(document, page, preview_format, self.is_current_revision(document))
+        path = paths[size]
+        if not os.path.exists(path):
+            if os.path.exists(job + '.failed'):
+                raise PluginError('ThumbnailsFilesystemHandler failed to generate thumbnail of %s' % document.get_code(), 404)
+            if not self.is_pending(job):
+                # TODO: remove this try/except block and stabilize
+                # Operations are not stable due to plugin usage of external tools that are under testing now
+                try:
+                    self.queue_previews(document, job, page, paths)
+                except Exception, e:
+                    traceback.print_exc()
+                    error = 'ThumbnailsFilesystemHandler.generate_thumbnail method error: %s' % e
+                    log.error(error)
+                    raise PluginError(error, 404)
+                if os.path.exists(job + '.failed'):
+                    # Generated within request
+                    raise PluginError('ThumbnailsFilesystemHandler failed to generate thumbnail of %s' % document.get_code(), 404)
+            if not os.path.exists(path):
+                document.thumbnail = PLACEHOLDER
+                document.thumbnail_format = 'png'
+                document.thumbnail_pending = True
+                return document
+        preview_cache.touch(path)
+        document.thumbnail = open(path, 'rb').read()
+        document.thumbnail_format = preview_format
+        return document
+
+    def pregenerate_thumbnail(self, document):
+        """Copies a new document file for its default previews while the file is processed for storage
+
+        Previews are queued with queue_stored_thumbnails() once the file is stored.
+        Without background workers previews are generated on first request instead of within the upload."""
+        if not self.pool.processes:
+            return document
+        if not document.has_file_obj() or document.get_mimetype() not in SUPPORTED_MIMETYPES:
+            return document
+        job, paths = self.get_preview_paths(document, 1, PREVIEW_FORMATS[0])
+        if not self.mark_pending(job):
+            return document
+        document.add_stream_stage(ThumbnailSourceStage(self, job, 1, sorted(paths.items())))
+        return document
+
+    def queue_stored_thumbnails(self, document):
+        """Queues default previews copied by pregenerate_thumbnail() after document file is stored"""
+        jobs, document.thumbnail_jobs = document.thumbnail_jobs, []
+        for job in jobs:
+            job.submit()
         return document
 
     def remove_thumbnails(self, document):
@@ -63,50 +253,92 @@ class ThumbnailsFilesystemHandler(object):
         thumbnail_location, thumbnail_directory = self.get_thumbnail_path(document, filename=False)
         if os.path.isdir(thumbnail_directory):
             shutil.rmtree(thumbnail_directory)
+            try:
+                preview_cache.forget_directory(thumbnail_directory)
+            except sqlite3.Error, e:
+                # Evicted with the least recently used ones later
+                log.warning('Can not remove previews of %s from preview cache: %s' % (thumbnail_directory, e))
         return document
 
     # ******************************************************************************************************************
     # ****************************************** Helper methods (Internal) *********************************************
     # ******************************************************************************************************************
 
-    def generate_thumbnail_from_pdf(self, document):
-        """Generating a thumbnail based on document first file"""
-        thumbnail_temporary, thumbnail_directory = self.get_thumbnail_path(document)
-        # Creating directory for thumbnail if not exists
-        if not os.path.exists(thumbnail_directory):
-            os.makedirs(thumbnail_directory)
-        # Storing temporary PDF file for converting
-        tmp_pdf = open(thumbnail_temporary, 'w')
-        tmp_pdf.write(document.get_file_obj().read())
-        tmp_pdf.close()
-        args = [
-            'gs',
-            '-q',  # Quiet
-            '-dSAFER',
-            '-sDEVICE=png16m',  # Type. PNG used
-            '-r10',  # resolution of the thumbnail
-            '-dBATCH',  # Quit GS after converting
-            '-dNOPAUSE',  # Do not stop on pages
-            '-dFirstPage=1',
-            '-dLastPage=1',
-            '-sOutputFile=%s.png' % thumbnail_temporary,  # Destination
-            '%s' % thumbnail_temporary,  # Source
-        ]
-        ghostscript.Ghostscript(*args)
-        # Deleting the temp PDF
-        os.unlink(thumbnail_temporary)
-
-    def generate_thumbnail_from_jpeg(self, document):
-        """Generating a thumbnail based on document first file"""
-        thumbnail_temporary, thumbnail_directory = self.get_thumbnail_path(document)
-        # Creating directory for thumbnail if not exists
+    def get_preview_paths(self, document, page, preview_format, current=True):
+        """Returns job name (path prefix) and {size: path} dict of all size previews of a document page
+
+        Default thumbnail (first size of the first page in PNG) keeps its original name '<filename>.png'.
+        Previews of revisions older than the current one have revision in their name."""
+        thumbnail_location, thumbnail_directory = self.get_thumbnail_path(document)
         if not os.path.exists(thumbnail_directory):
             os.makedirs(thumbnail_directory)
-        tmp_jpg = open(thumbnail_temporary + '.jpg', 'w')
-        tmp_jpg.write(document.get_file_obj().read())
-        tmp_jpg.close()
-        os.system('convert %s.jpg -resize 65x65 %s.png' % (thumbnail_temporary, thumbnail_temporary))
-        os.unlink(thumbnail_temporary + '.jpg')
+        prefix = thumbnail_location
+        if not current:
+            prefix += '_r%s' % document.get_revision()
+        prefix += '_p%s' % page
+        paths = {}
+        for size in PREVIEW_SIZES:
+            if current and page == 1 and size == PREVIEW_SIZES[0] and preview_format == 'png':
+                paths[size] = thumbnail_location + '.png'
+            else:
+                paths[size] = '%s_%s.%s' % (prefix, size, preview_format)
+        return '%s.%s' % (prefix, preview_format), paths
+
+    def is_current_revision(self, document):
+        revisions = document.get_file_revisions_data()
+        if not revisions or not document.get_revision():
+            return True
+        return document.get_revision() >= max(int(revision) for revision in revisions.iterkeys())
+
+    def is_pending(self, job):
+        """Checks previews are queued (by any process) and not abandoned"""
+        try:
+            return time.time() - os.path.getmtime(job + '.pending') < PENDING_TIMEOUT
+        except OSError:
+            return False
+
+    def mark_pending(self, job):
+        """Creates pending marker of a job. Returns False if other process has just created it."""
+        marker = job + '.pending'
+        if os.path.exists(marker) and not self.is_pending(job):
+            # Abandoned
+            os.unlink(marker)
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        return True
+
+    def queue_previews(self, document, job, page, paths):
+        """Queues all size previews of a document page, copying document file if it is processed (e.g. compressed)"""
+        log.debug('mimetype for thumbnail: %s' % document.mimetype)
+        if not document.mimetype:
+            raise PluginError('ThumbnailsFilesystemHandler missconfiguration. Mimetype = None', 404)
+        if document.mimetype not in SUPPORTED_MIMETYPES:
+            raise PluginError('ThumbnailsFilesystemHandler does not support %s files' % document.mimetype, 404)
+        if not self.mark_pending(job):
+            return
+        file_obj = document.get_file_obj()
+        if document.get_fullpath() and getattr(file_obj, 'name', None) == document.get_fullpath():
+            # Stored file is readable as is
+            source_path, remove_source = document.get_fullpath(), False
+        else:
+            source_path, remove_source = job + '.src', True
+            source = open(source_path, 'wb')
+            try:
+                file_obj.seek(0)
+                chunk = file_obj.read(CHUNK_SIZE)
+                while chunk:
+                    source.write(chunk)
+                    chunk = file_obj.read(CHUNK_SIZE)
+            except:
+                source.close()
+                discard_job(job, source_path, remove_source)
+                raise
+            source.close()
+        self.pool.submit(job, source_path, remove_source, document.mimetype, page, sorted(paths.items()))
 
     def get_thumbnail_path(self, document, filename=True):
         """Produces 2 path of tmp thumbnail file and a directory for thumbnails storage"""
@@ -145,6 +377,26 @@ class ThumbnailsLocalRetrievalPlugin(Plugin, BeforeRetrievalPluginPoint):
         return document
 
 
+class ThumbnailsLocalStoragePlugin(Plugin, BeforeStoragePluginPoint):
+
+    title = "Thumbnails Handler"
+    description = "Copies a new document for its thumbnail while it is processed for storage"
+    plugin_type = "storage_processing"
+
+    def work(self, document):
+        return ThumbnailsFilesystemHandler().pregenerate_thumbnail(document)
+
+
+class ThumbnailsLocalQueuePlugin(Plugin, StoragePluginPoint):
+
+    title = "Thumbnails Queue"
+    description = "Queues generation of a thumbnail of a stored document"
+    plugin_type = "storage_processing"
+
+    def work(self, document):
+        return ThumbnailsFilesystemHandler().queue_stored_thumbnails(document)
+
+
 class ThumbnailsLocalRemovalPlugin(Plugin, BeforeRemovalPluginPoint):
 
     title = "Thumbnails Handler"
@@ -158,8 +410,22 @@ class ThumbnailsLocalRemovalPlugin(Plugin, BeforeRemovalPluginPoint):
 class ThumbnailsLocalUpdatePlugin(Plugin, BeforeUpdatePluginPoint):
 
     title = "Thumbnails Handler"
-    description = "Removes thumbnails of the document"
+    description = "Removes thumbnails of the document and queues a thumbnail of a new file"
     plugin_type = "retrieval_processing"
 
     def work(self, document):
-        return ThumbnailsFilesystemHandler().remove_thumbnails(document)
+        handler = ThumbnailsFilesystemHandler()
+        document = handler.remove_thumbnails(document)
+        if document.get_option('update_file'):
+            document = handler.pregenerate_thumbnail(document)
+        return document
+
+
+class ThumbnailsLocalUpdateQueuePlugin(Plugin, UpdatePluginPoint):
+
+    title = "Thumbnails Queue"
+    description = "Queues generation of a thumbnail of a stored new file of the document"
+    plugin_type = "storage_processing"
+
+    def work(self, document):
+        return ThumbnailsFilesystemHandler().queue_stored_thumbnails(document)
@@ -3,9 +3,29 @@ Module: Hashcode Plugin
 Project: Adlibre DMS
 Copyright: Adlibre Pty Ltd 2013
 License: See LICENSE for license information
+
+Retrieval plugin verifies document file against its stored hash code according to a 'policy' option:
+
+    requested:  only if a hash code is given with the request (default, files are not read otherwise)
+    always:     on every retrieval
+    sampled:    on one of DMS_HASH_VERIFY_SAMPLE_RATE retrievals
+    scheduled:  if file was not verified for DMS_HASH_VERIFY_INTERVAL seconds (or has changed)
+    changed:    only if stored file mtime or size has changed since it was verified
+
+Verified files are stamped with their mtime and size in an SQLite database.
+Stamps of removed files are pruned by 'verify_integrity' command.
+Hash code given with a request is always checked, but against the stored one while the file is trusted.
+Policies other than 'requested' hash files for retrievals without a hash code too, and answer 500 on a mismatch.
+'verify_integrity' management command hashes all stored files (e.g. nightly) to find corruption policies skip.
 """
 
+import os
+import time
+import random
+import sqlite3
 import hashlib
+import logging
+import threading
 
 from django import forms
 from django.conf import settings
@@ -15,6 +35,25 @@ from dms_plugins.pluginpoints import BeforeStoragePluginPoint
 from dms_plugins.pluginpoints import BeforeUpdatePluginPoint
 from dms_plugins.workers import Plugin
 from dms_plugins.workers import PluginError
+from core.streams import StreamStage
+
+log = logging.getLogger('dms_plugins.workers.validators.hashcode')
+
+CHUNK_SIZE = getattr(settings, 'DMS_FILE_CHUNK_SIZE', 64 * 1024)
+VERIFY_POLICY = getattr(settings, 'DMS_HASH_VERIFY_POLICY', 'requested')
+VERIFY_SAMPLE_RATE = getattr(settings, 'DMS_HASH_VERIFY_SAMPLE_RATE', 100)
+VERIFY_INTERVAL = getattr(settings, 'DMS_HASH_VERIFY_INTERVAL', 24 * 60 * 60)
+VERIFY_DB = getattr(settings, 'DMS_HASH_VERIFY_DB', None) or os.path.join(settings.DOCUMENT_ROOT, '.verified.sqlite3')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS verified (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    hashcode TEXT NOT NULL,
+    verified REAL NOT NULL
+);
+"""
 
 
 class HashForm(forms.Form):
@@ -44,6 +83,27 @@ class HashForm(forms.Form):
         return method
 
 
+class VerificationForm(HashForm):
+    """Form for configuration of retrieval verification plugin options in DMS config"""
+    POLICY = (
+        ('requested', 'requested'),
+        ('always', 'always'),
+        ('sampled', 'sampled'),
+        ('scheduled', 'scheduled'),
+        ('changed', 'changed'),
+    )
+    policy = forms.ChoiceField(choices=POLICY, help_text='When file is hashed on retrieval')
+
+    def save(self, commit=True):
+        """Stores settings for a plugin
+        @param commit: execute save()"""
+        for option in self.options:
+            option.value = self.cleaned_data[option.name]
+            if commit:
+                option.save()
+        return self.options
+
+
 class HashCodeValidationOnStoragePlugin(Plugin, BeforeStoragePluginPoint):
     """Validates hash codes on storing a file for code"""
     title = 'Hash'
@@ -84,15 +144,37 @@ class HashCodeValidationOnRetrievalPlugin(Plugin, BeforeRetrievalPluginPoint):
     description = 'Hash code validation on retrieval'
     plugin_type = "retrieval_validation"
     method = 'md5'
+    policy = VERIFY_POLICY
     has_configuration = True
-    configurable_fields = ['method', ]
-    form = HashForm
-    
+    configurable_fields = ['method', 'policy', ]
+    form = VerificationForm
+
     def work(self, document):
         """Main plugin method
         @param document: DMS Document() instance"""
-        method = self.get_option('method', document.get_docrule())
-        return HashCodeWorker(self.method).work_retrieve(document, method)
+        docrule = document.get_docrule()
+        method = self.get_option('method', docrule)
+        return HashCodeWorker(self.method).work_retrieve(document, method, self.get_option('policy', docrule))
+
+
+class HashStreamStage(StreamStage):
+    """Calculates the same hash as HashCodeWorker.get_hash() over file chunks and stores it in document"""
+    def __init__(self, method, salt=settings.SECRET_KEY):
+        self.method = method
+        self.hash = hashlib.new(method)
+        self.salt = salt
+
+    def process(self, chunk):
+        self.hash.update(chunk)
+        return chunk
+
+    def finish(self, document):
+        self.hash.update(self.salt)
+        new_hashcode = self.hash.hexdigest()
+        document.set_hashcode(new_hashcode)
+        document.save_hashcode(new_hashcode)
+        # Verification uses the method a revision was hashed with, even if plugin configuration changes later
+        document.update_current_file_revision_data({'hashcode_method': self.method})
 
 
 class HashCodeWorker(object):
@@ -114,23 +196,155 @@ class HashCodeWorker(object):
     def work_store(self, document, method):
         """Stores hash for given document
 
+        Hash is calculated in a single pass over the file with other stream stages.
+
         @param document: is a DMS Document() instance
         @param method: is a str() method of hash code checking. e.g. 'md5'
         """
-        new_hashcode = self.get_hash(document.get_file_obj().read(), method)
-        document.set_hashcode(new_hashcode)
-        document.save_hashcode(new_hashcode)
+        if document.has_file_obj():
+            document.add_stream_stage(HashStreamStage(method))
         return document
 
-    def work_retrieve(self, document, method):
-        """Reads hash for given document
+    def get_file_hash(self, file_obj, method, salt=settings.SECRET_KEY):
+        """Returns the same hash as get_hash() for a file object, reading it in chunks"""
+        h = hashlib.new(method)
+        file_obj.seek(0)
+        chunk = file_obj.read(CHUNK_SIZE)
+        while chunk:
+            h.update(chunk)
+            chunk = file_obj.read(CHUNK_SIZE)
+        file_obj.seek(0)
+        h.update(salt)
+        return h.hexdigest()
+
+    def work_retrieve(self, document, method, policy='always'):
+        """Verifies file of given document against its hash code according to verification policy
 
         @param document: is a DMS Document() instance
         @param method: is a str() method of hash code checking. e.g. 'md5'
+        @param policy: 'requested', 'always', 'sampled', 'scheduled' or 'changed' (see module docstring)
         """
-        if document.get_file_obj():
-            hashcode = document.get_hashcode()
-            new_hashcode = self.get_hash(document.get_file_obj().read(), method)
-            if hashcode and not (new_hashcode == hashcode):
-                raise PluginError("Hashcode did not validate.", 500)
+        if document.get_option('only_metadata') or document.get_option('indexing_data'):
+            return document
+        revision_data = document.get_current_file_revision_data() or {}
+        requested = document.get_hashcode()
+        stored = revision_data.get('hashcode', None)
+        method = revision_data.get('hashcode_method', method)
+        if requested and stored and requested != stored:
+            raise PluginError("Hashcode did not validate.", 500)
+        if not requested and policy == 'requested':
+            return document
+        hashcode = requested or stored
+        if not hashcode or not document.get_file_obj():
+            return document
+        path = document.get_fullpath()
+        if path and not requested and not integrity_stamps.needs_verification(path, hashcode, policy):
+            return document
+        if path and requested and stored and not integrity_stamps.needs_verification(path, hashcode, 'changed'):
+            # Requested hash code matches the stored one of an unchanged file
+            return document
+        new_hashcode = self.get_file_hash(document.get_file_obj(), method)
+        if new_hashcode != hashcode:
+            if path:
+                integrity_stamps.forget(path)
+            log.error('Hashcode of %s revision %s did not validate' % (document.get_code(), document.get_revision()))
+            raise PluginError("Hashcode did not validate.", 500)
+        if path:
+            integrity_stamps.stamp(path, hashcode)
         return document
+
+
+class IntegrityStamps(object):
+    """Stored files verified against their hash codes with file mtime and size at the time
+
+    Every thread keeps its own connection to the database."""
+    def __init__(self, db_path=VERIFY_DB, sample_rate=VERIFY_SAMPLE_RATE, interval=VERIFY_INTERVAL):
+        self.db_path = db_path
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.schema_pid = None
+        self.local = threading.local()
+
+    def connect(self):
+        """Returns connection of this thread (opened again in a forked process)"""
+        pid = os.getpid()
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != pid:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            if self.schema_pid != pid:
+                connection.executescript(SCHEMA)
+                self.schema_pid = pid
+            self.local.connection, self.local.pid = connection, pid
+        return connection
+
+    def disconnect(self):
+        """Drops connection of this thread after an error"""
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except sqlite3.Error:
+                pass
+
+    def needs_verification(self, path, hashcode, policy):
+        if policy == 'requested':
+            return False
+        if policy == 'sampled':
+            return random.randint(1, self.sample_rate) == 1
+        if policy not in ('scheduled', 'changed'):
+            return True
+        try:
+            stat = os.stat(path)
+            row = self.connect().execute(
+                'SELECT mtime, size, hashcode, verified FROM verified WHERE path = ?', (path, )
+            ).fetchone()
+        except OSError, e:
+            log.warning('IntegrityStamps: can not check %s: %s' % (path, e))
+            return True
+        except sqlite3.Error, e:
+            log.warning('IntegrityStamps: can not check %s: %s' % (path, e))
+            self.disconnect()
+            return True
+        if row is None or row[:3] != (stat.st_mtime, stat.st_size, hashcode):
+            return True
+        return policy == 'scheduled' and time.time() - row[3] > self.interval
+
+    def stamp(self, path, hashcode):
+        """Records file is verified in its current state"""
+        try:
+            stat = os.stat(path)
+            connection = self.connect()
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO verified (path, mtime, size, hashcode, verified) VALUES (?, ?, ?, ?, ?)',
+                    (path, stat.st_mtime, stat.st_size, hashcode, time.time())
+                )
+        except OSError, e:
+            # File is verified again next time
+            log.warning('IntegrityStamps: can not stamp %s: %s' % (path, e))
+        except sqlite3.Error, e:
+            log.warning('IntegrityStamps: can not stamp %s: %s' % (path, e))
+            self.disconnect()
+
+    def forget(self, path):
+        try:
+            connection = self.connect()
+            with connection:
+                connection.execute('DELETE FROM verified WHERE path = ?', (path, ))
+        except sqlite3.Error, e:
+            log.warning('IntegrityStamps: can not remove stamp of %s: %s' % (path, e))
+            self.disconnect()
+
+    def prune(self):
+        """Removes stamps of files that do not exist anymore (removed or moved documents). Returns their number."""
+        connection = self.connect()
+        missing = [
+            (path, ) for path, in connection.execute('SELECT path FROM verified').fetchall()
+            if not os.path.exists(path)
+        ]
+        with connection:
+            connection.executemany('DELETE FROM verified WHERE path = ?', missing)
+        return len(missing)
+
+integrity_stamps = IntegrityStamps()
@@ -0,0 +1,230 @@
+"""Module: DMS CouchDB write behind batches
+
+Project: Adlibre DMS
+Copyright: Adlibre Pty Ltd 2014
+License: See LICENSE for license information
+
+Bulk operations (import, purge) collect CouchDocument writes in a batch and flush them with one _bulk_docs request:
+
+    with couch_write_batch() as batch:
+        for code in codes:
+            processor.delete(code, {'user': user})
+    print batch.conflicts
+
+Without an active batch (interactive requests) every write is sent to CouchDB at once.
+"""
+
+import logging
+import threading
+
+from collections import OrderedDict
+
+from django.conf import settings
+from couchdbkit.exceptions import BulkSaveError, ResourceNotFound
+
+from dmscouch.models import CouchDocument
+
+log = logging.getLogger('dmscouch.batch')
+
+__all__ = [
+    'CouchWriteBatch',
+    'couch_write_batch',
+    'get_active_batch',
+    'get_couchdoc',
+    'get_or_create_couchdoc',
+    'save_couchdoc',
+    'delete_couchdoc',
+]
+
+BATCH_SIZE = getattr(settings, 'DMS_COUCHDB_BATCH_SIZE', 100)
+
+_local = threading.local()
+
+
+class CouchWriteBatch(object):
+    """Collects CouchDocument saves and deletions and writes them with _bulk_docs.
+
+    Only the last write of a document id is sent. Documents saved with force_update overwrite
+    the current CouchDB revision (like CouchDocument.save(force_update=True) does).
+    Ids that could not be written are reported in self.conflicts {docid: error}.
+    """
+    def __init__(self, size=BATCH_SIZE):
+        self.size = max(int(size), 1)
+        self.pending = OrderedDict()
+        self.force_update = set()
+        self.deleted = set()
+        self.conflicts = {}
+        self.written = 0
+
+    def __enter__(self):
+        stack = getattr(_local, 'batches', None)
+        if stack is None:
+            stack = _local.batches = []
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.batches.remove(self)
+        # Flushing anyway. Files of pending documents are stored already.
+        if exc_type is None:
+            self.flush()
+            return False
+        try:
+            self.flush()
+        except Exception, e:
+            # Original exception is the one to report
+            log.error('CouchWriteBatch: flush after %s failed: %s' % (exc_type.__name__, e))
+        return False
+
+    def get(self, docid):
+        """Returns pending CouchDocument for an id or None.
+
+        Raises ResourceNotFound if the document is pending deletion."""
+        if docid in self.deleted:
+            raise ResourceNotFound('deleted')
+        return self.pending.get(docid, None)
+
+    def save(self, couchdoc, force_update=False):
+        docid = couchdoc._doc.get('_id', None)
+        if not docid:
+            # CouchDB must generate an id for this one
+            couchdoc.save(force_update=force_update)
+            return
+        self.pending.pop(docid, None)
+        self.pending[docid] = couchdoc
+        self.deleted.discard(docid)
+        if force_update:
+            self.force_update.add(docid)
+        if len(self.pending) >= self.size:
+            self.flush()
+
+    def delete(self, couchdoc):
+        docid = couchdoc._doc['_id']
+        self.pending.pop(docid, None)
+        self.pending[docid] = couchdoc
+        self.deleted.add(docid)
+        if len(self.pending) >= self.size:
+            self.flush()
+
+    def get_revisions(self, docids):
+        """Returns current CouchDB revisions {docid: rev} of existing documents"""
+        revisions = {}
+        if docids:
+            for row in CouchDocument.get_db().all_docs(keys=docids):
+                value = row.get('value', None)
+                if value and not value.get('deleted', False):
+                    revisions[row['key']] = value['rev']
+        return revisions
+
+    def flush(self):
+        """Writes pending documents. Returns {docid: error} for documents that were not written."""
+        if not self.pending:
+            return {}
+        pending, deleted, force_update = self.pending, self.deleted, self.force_update
+        self.pending, self.deleted, self.force_update = OrderedDict(), set(), set()
+        revisions = self.get_revisions(
+            [docid for docid, couchdoc in pending.iteritems()
+             if docid in force_update or (docid in deleted and not couchdoc._doc.get('_rev', None))]
+        )
+        docids, payload = [], []
+        for docid, couchdoc in pending.iteritems():
+            if docid in deleted:
+                rev = couchdoc._doc.get('_rev', None) or revisions.get(docid, None)
+                if rev:
+                    body = {'_id': docid, '_rev': rev, '_deleted': True}
+                else:
+                    # Nothing to delete
+                    continue
+            else:
+                body = couchdoc.to_json()
+                if docid in force_update:
+                    if docid in revisions:
+                        body['_rev'] = revisions[docid]
+                    else:
+                        body.pop('_rev', None)
+            docids.append(docid)
+            payload.append(body)
+        try:
+            results = CouchDocument.get_db().bulk_save(payload, use_uuids=False)
+        except BulkSaveError, e:
+            results = e.results
+        errors = {}
+        for docid, result in zip(docids, results):
+            if 'error' in result:
+                errors[docid] = result['error']
+            elif docid not in deleted:
+                pending[docid]._doc['_rev'] = result['rev']
+        for docid in list(errors):
+            if docid in force_update and errors[docid] == 'conflict':
+                # Written by somebody else in between. Overwriting, like a single force_update save does.
+                try:
+                    pending[docid].save(force_update=True)
+                    del errors[docid]
+                except Exception, e:
+                    errors[docid] = str(e)
+        for docid, error in errors.iteritems():
+            log.error('CouchWriteBatch: could not write document %s: %s' % (docid, error))
+        self.written += len(payload) - len(errors)
+        self.conflicts.update(errors)
+        return errors
+
+
+def couch_write_batch(size=BATCH_SIZE):
+    """Returns a batch to use in 'with' statement. Writes inside it are flushed on exit (or every size documents)"""
+    return CouchWriteBatch(size)
+
+
+def get_active_batch():
+    """Returns CouchWriteBatch() active in current thread or None"""
+    stack = getattr(_local, 'batches', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+def get_couchdoc(docid):
+    """Returns CouchDocument taking pending writes of an active batch into account"""
+    batch = get_active_batch()
+    if batch is not None:
+        couchdoc = batch.get(docid)
+        if couchdoc is not None:
+            return couchdoc
+    return CouchDocument.get(docid=docid)
+
+
+def get_or_create_couchdoc(docid):
+    """Same as CouchDocument.get_or_create() taking pending writes of an active batch into account"""
+    batch = get_active_batch()
+    if batch is not None:
+        try:
+            couchdoc = batch.get(docid)
+        except ResourceNotFound:
+            # Document pending deletion is replaced with a new one, not read back from CouchDB
+            deleted = batch.pending.pop(docid)
+            batch.deleted.discard(docid)
+            rev = deleted._doc.get('_rev', None) or batch.get_revisions([docid]).get(docid, None)
+            couchdoc = CouchDocument()
+            couchdoc._doc['_id'] = docid
+            if rev:
+                couchdoc._doc['_rev'] = rev
+        if couchdoc is not None:
+            return couchdoc
+    return CouchDocument.get_or_create(docid=docid)
+
+
+def save_couchdoc(couchdoc, force_update=False):
+    """Saves CouchDocument with an active batch or at once"""
+    batch = get_active_batch()
+    if batch is not None:
+        batch.save(couchdoc, force_update=force_update)
+    else:
+        couchdoc.save(force_update=force_update)
+
+
+def delete_couchdoc(couchdoc):
+    """Deletes CouchDocument with an active batch or at once"""
+    batch = get_active_batch()
+    if batch is not None:
+        batch.delete(couchdoc)
+    else:
+        couchdoc.delete()
@@ -8,6 +8,8 @@ Author: Iurii Garmash
 
 import os
 import base64
+import shutil
+import tempfile
 
 from couchdbkit import Server
 
@@ -18,7 +20,28 @@ from django.test import TestCase
 from django.test.client import Client
 from django.test.client import encode_multipart
 
-__all__ = ['DMSTestCase', 'DMSBasicAuthenticatedTestCase']
+__all__ = ['DMSTestCase', 'DMSBasicAuthenticatedTestCase', 'TemporaryDirectoryTestCase']
+
+
+class TemporaryDirectoryTestCase(TestCase):
+    """Test Case with a temporary directory (self.root) removed after each test"""
+    def setUp(self):
+        super(TemporaryDirectoryTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        super(TemporaryDirectoryTestCase, self).tearDown()
+
+    def _file(self, name, content='', mtime=None):
+        """Writes file into temporary directory and returns its path"""
+        path = os.path.join(self.root, name)
+        f = open(path, 'wb')
+        f.write(content)
+        f.close()
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
 
 
 class DMSTestCase(TestCase):
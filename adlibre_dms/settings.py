@@ -392,6 +392,7 @@ if not DEBUG:
             'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
             'LOCATION': 'memory_cache'
         },
+        # Per process. DMS in memory caches are invalidated across processes with DMS_CACHE_VERSIONS_ROOT stamp files.
         'core': {
             'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
             'LOCATION': 'memory_cache'
@@ -411,6 +412,7 @@ else:
             'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
             'LOCATION': 'memory_cache'
         },
+        # Per process. DMS in memory caches are invalidated across processes with DMS_CACHE_VERSIONS_ROOT stamp files.
         'core': {
             'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
             'LOCATION': 'memory_cache'
@@ -462,6 +464,73 @@ DATE_COUCHDB_FORMAT = "%Y-%m-%dT00:00:00Z"
 MUI_SEARCH_PAGINATE = 20
 MUI_SEARCH_PAGINATOR_PAGE_SEPARATOR = '...'
 
+# Document downloads are streamed to the client in chunks of this size (bytes)
+DMS_FILE_CHUNK_SIZE = 64 * 1024
+# Offload sending of unmodified stored files to the front end web server.
+# None (disabled), 'X-Sendfile' (Apache mod_xsendfile, Lighttpd) or 'X-Accel-Redirect' (Nginx)
+DMS_SENDFILE_HEADER = None
+# Nginx 'internal' location mapped to DOCUMENT_ROOT (used with 'X-Accel-Redirect' only)
+DMS_SENDFILE_URL_PREFIX = '/protected_documents/'
+# Directory of version stamp files of in memory caches (plugin pipelines, docrules, barcode blocks, plugin options).
+# Must be shared by all DMS processes (None for '.cache_versions' in DOCUMENT_ROOT).
+DMS_CACHE_VERSIONS_ROOT = None
+# Seconds a process trusts cache versions without checking stamp files (changes made by other processes are seen
+# after this delay)
+DMS_CACHE_VERSIONS_TTL = 1
+# Barcodes a process reserves at once for a Document Type Rule (saves a DB round trip per allocated barcode).
+# Values > 1 make barcodes unique but not strictly sequential across processes.
+DMS_BARCODE_BLOCK_SIZE = 1
+# Maximum number of CouchDB documents bulk operations (import, purge) write with one _bulk_docs request
+DMS_COUCHDB_BATCH_SIZE = 100
+# Seconds Local Storage plugins use cached directory listings and file revision data without checking the filesystem.
+# Saves NFS round trips of frequent read requests. Changes made by other processes are seen after this delay.
+DMS_FILESYSTEM_CACHE_TTL = 2
+# Maximum number of cached directory listings and files (per process)
+DMS_FILESYSTEM_CACHE_SIZE = 10000
+# Directory of 'Content Addressed Storage' plugins files (None for '.blobs' in DOCUMENT_ROOT)
+DMS_BLOB_ROOT = None
+# Durability of stored files: 'none' (leave it to OS), 'file' (sync file data before it is renamed into place)
+# or 'full' (sync containing directory too, so the rename survives power loss)
+DMS_STORAGE_FSYNC = 'file'
+# Directory of files processed by storage plugins before they are stored (None for '.staging' in DOCUMENT_ROOT).
+# Should be on the same filesystem as DOCUMENT_ROOT, so processed files are linked into place instead of copying.
+DMS_STAGING_ROOT = None
+# Compression plugins store a file uncompressed if compressing its first DMS_COMPRESSION_SAMPLE_SIZE bytes
+# saves less than DMS_COMPRESSION_MIN_SAVING of them (already compressed PDFs, JPEGs, etc.)
+DMS_COMPRESSION_SAMPLE_SIZE = 64 * 1024
+DMS_COMPRESSION_MIN_SAVING = 0.1
+# Processes generating thumbnails in background (per web process), also pre-generating them for uploaded files.
+# 0 generates thumbnails within the request asking for them (never within uploads).
+# Workers are forked from each web process on first use. They do not use its DB or CouchDB connections.
+DMS_THUMBNAIL_WORKERS = 0
+# Maximum number of thumbnails queued by a web process
+DMS_THUMBNAIL_QUEUE_SIZE = 100
+# Seconds a pending thumbnail is waited for before it is queued again
+DMS_THUMBNAIL_TIMEOUT = 120
+# Sizes (longest side in px) of document page previews (thumbnails). First one is the default thumbnail size.
+DMS_PREVIEW_SIZES = (64, 128, 256, 512, 1024)
+# Formats of previews clients may request. First one is the default. 'webp' needs ImageMagick with WebP support.
+DMS_PREVIEW_FORMATS = ('png', 'jpeg')
+# Total size (bytes) of previews kept. Least recently used previews are removed over it.
+DMS_PREVIEW_CACHE_SIZE = 512 * 1024 * 1024
+# Index of cached previews (None for '.previews.sqlite3' in DOCUMENT_ROOT)
+DMS_PREVIEW_CACHE_DB = None
+# When Hash plugin verifies document files on retrieval (default for its 'policy' option):
+# 'requested' (only retrievals with a hash code given), 'always', 'sampled' (1 of DMS_HASH_VERIFY_SAMPLE_RATE
+# retrievals), 'scheduled' (every DMS_HASH_VERIFY_INTERVAL seconds) or 'changed' (stored file mtime or size changed).
+# Policies other than 'requested' also hash files retrieved without a hash code and fail them (500) on a mismatch.
+# Use 'verify_integrity' command to check all files.
+DMS_HASH_VERIFY_POLICY = 'requested'
+DMS_HASH_VERIFY_SAMPLE_RATE = 100
+DMS_HASH_VERIFY_INTERVAL = 24 * 60 * 60
+# Verified files stamps (None for '.verified.sqlite3' in DOCUMENT_ROOT)
+DMS_HASH_VERIFY_DB = None
+# CouchDB view requests a search runs concurrently (per process). 0 requests search views one by one.
+DMS_SEARCH_WORKERS = 4
+# Documents found by the most selective search keys are checked against the rest of keys directly
+# (with one request of their indexes) if there are not more of them than this
+DMS_SEARCH_CANDIDATES_LIMIT = 1000
+
 DEMO = True
 NEW_SYSTEM = False
 STAGE_KEYWORD = False